@@ -1,12 +1,9 @@
-import redis
-import os
-
-REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
-r = redis.Redis.from_url(REDIS_URL)
+# Совместимость со старым модулем: вся работа с Redis теперь в redis_client
+# (один пул, REDIS_URL или REDIS_HOST/PORT), авторизация хранится в hash user:{id}.
+from redis_client import r, authorize_user, get_order_id
 
 def save_user_auth(user_id, order_id):
-    r.set(f"user:{user_id}", order_id)
+    authorize_user(user_id, order_id)
 
 def get_order_id_by_user_id(user_id):
-    order_id = r.get(f"user:{user_id}")
-    return order_id.decode() if order_id else None
+    return get_order_id(user_id)
@@ -0,0 +1,45 @@
+import random
+import asyncio
+from collections import Counter
+
+from aiohttp import web
+
+# Заглушка API СДЭК v2 для прогонов и ручной проверки tracking.py: выдаёт OAuth-токен
+# и отвечает на GET /v2/orders?cdek_number= детерминированной историей статусов.
+ROUTE = [("CREATED", "Создан", "Москва"), ("RECEIVED_AT_SHIPMENT_WAREHOUSE", "Принят на склад отправителя", "Москва"),
+         ("SENT_TO_TRANSIT_CITY", "Отправлен в г. транзит", "Москва"), ("ACCEPTED_AT_TRANSIT_WAREHOUSE", "Принят на склад транзита", "Казань"),
+         ("ACCEPTED_AT_PICK_UP_POINT", "Принят на склад до востребования", "Екатеринбург"), ("DELIVERED", "Вручен", "Екатеринбург")]
+
+class FakeCDEK:
+    def __init__(self, latency_ms: float = 80.0, token: str = "bench-token"):
+        self.latency_ms = latency_ms
+        self.token = token
+        self.calls = Counter()
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/v2/oauth/token", self.oauth)
+        app.router.add_get("/v2/orders", self.order)
+        return app
+
+    async def oauth(self, request: web.Request):
+        self.calls["oauth"] += 1
+        return web.json_response({"access_token": self.token, "token_type": "bearer", "expires_in": 3600})
+
+    async def order(self, request: web.Request):
+        self.calls["orders"] += 1
+        await asyncio.sleep(self.latency_ms / 1000.0)
+        if request.headers.get("Authorization") != f"Bearer {self.token}":
+            return web.json_response({"requests": [{"state": "INVALID", "errors": [{"code": "v2_token_expired"}]}]}, status=401)
+        number = request.query.get("cdek_number", "")
+        if not number.startswith("CDEK") and not number.isdigit():
+            return web.json_response({"requests": [{"state": "INVALID", "errors": [{"code": "v2_entity_not_found"}]}]},
+                                     status=400)
+        steps = random.Random(number).randint(1, len(ROUTE))
+        statuses = [{"code": code, "name": name, "city": city, "date_time": f"2024-05-{10 + i:02d}T1{i}:30:00+0300"}
+                    for i, (code, name, city) in enumerate(ROUTE[:steps])]
+        return web.json_response({"entity": {"uuid": f"uuid-{number}", "cdek_number": number,
+                                             "statuses": list(reversed(statuses))}})
+
+    def stats(self) -> dict:
+        return {"calls": sum(self.calls.values()), "by_endpoint": dict(self.calls)}
@@ -0,0 +1,175 @@
+import random
+import asyncio
+from collections import Counter
+
+from aiohttp import web
+
+# Заглушка RetailCRM API v5 для нагрузочных прогонов: отвечает на те запросы,
+# которые делает бот, с настраиваемой задержкой, долей ошибок и размером базы.
+STATUSES = [("new", "Новый"), ("assembling", "Комплектуется"), ("send-to-delivery", "Передан в доставку"),
+            ("delivering", "Доставляется"), ("complete", "Выполнен"), ("cancel-other", "Отменён")]
+STATUS_GROUPS = {"new": "new", "assembling": "assembling", "send-to-delivery": "delivery",
+                 "delivering": "delivery", "complete": "complete", "cancel-other": "cancel"}
+
+def make_dataset(customers: int, orders_per_customer: int = 2, seed: int = 1) -> dict:
+    rnd = random.Random(seed)
+    data = {"customers": {}, "orders": {}}
+    order_id = 1000
+    for cid in range(1, customers + 1):
+        phone = "+79%09d" % cid
+        data["customers"][cid] = {
+            "id": cid,
+            "firstName": f"Клиент{cid}",
+            "lastName": "Тестовый",
+            "phones": [{"number": phone}],
+        }
+        for n in range(rnd.randint(1, orders_per_customer)):
+            order_id += 1
+            status, comment = rnd.choice(STATUSES)
+            o = {
+                "id": order_id,
+                "number": f"{order_id}A",
+                "site": "main",
+                "status": status,
+                "statusComment": comment,
+                "createdAt": "2024-%02d-%02d 12:00:00" % (rnd.randint(1, 12), rnd.randint(1, 28)),
+                "customer": {"id": cid},
+                "phone": phone,
+                "customFields": {"bot_code": f"B{order_id}"},
+                "delivery": {},
+            }
+            if status in ("send-to-delivery", "delivering", "complete"):
+                o["delivery"].update(code="cdek", number=f"CDEK{order_id:08d}")
+            data["orders"][order_id] = o
+    return data
+
+def _digits(s: str) -> str:
+    return "".join(ch for ch in (s or "") if ch.isdigit())
+
+class FakeCRM:
+    def __init__(self, dataset: dict, latency_ms: float = 50.0, jitter_ms: float = 20.0,
+                 error_rate: float = 0.0, seed: int = 1):
+        self.customers = dataset["customers"]
+        self.orders = dataset["orders"]
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.calls = Counter()
+        self.errors = Counter()
+        self._rnd = random.Random(seed)
+        self._by_code = {o["customFields"]["bot_code"]: o for o in self.orders.values()}
+        self._by_phone = {_digits(c["phones"][0]["number"])[-10:]: c for c in self.customers.values()}
+        self._by_customer: dict = {}
+        for o in self.orders.values():
+            self._by_customer.setdefault(o["customer"]["id"], []).append(o)
+
+    # ---------- данные для сценариев ----------
+
+    def sample_code(self) -> str:
+        return self._rnd.choice(list(self._by_code))
+
+    def sample_phone(self) -> str:
+        return self._rnd.choice(list(self.customers.values()))["phones"][0]["number"]
+
+    # ---------- сервер ----------
+
+    def app(self) -> web.Application:
+        app = web.Application(middlewares=[self._middleware])
+        app.router.add_get("/api/v5/orders", self.orders_list)
+        app.router.add_get("/api/v5/customers", self.customers_list)
+        app.router.add_get("/api/v5/orders/history", self.history)
+        app.router.add_get("/api/v5/customers/history", self.history)
+        app.router.add_get("/api/v5/reference/sites", self.sites)
+        app.router.add_get("/api/v5/reference/statuses", self.statuses)
+        app.router.add_get("/api/v5/reference/delivery-types", self.delivery_types)
+        app.router.add_get("/api/v5/orders/{id}", self.order_get)
+        app.router.add_post("/api/v5/orders/{id}/edit", self.order_edit)
+        return app
+
+    @web.middleware
+    async def _middleware(self, request: web.Request, handler):
+        route = request.match_info.route.resource
+        label = f"{request.method} {route.canonical if route else request.path}"
+        self.calls[label] += 1
+        delay = max(0.0, self.latency_ms + self._rnd.uniform(-self.jitter_ms, self.jitter_ms)) / 1000.0
+        await asyncio.sleep(delay)
+        if self.error_rate and self._rnd.random() < self.error_rate:
+            self.errors[label] += 1
+            return web.json_response({"success": False, "errorMsg": "injected failure"}, status=503)
+        return await handler(request)
+
+    @staticmethod
+    def _page(items: list, request: web.Request, key: str) -> web.Response:
+        limit = int(request.query.get("limit", 20))
+        page = int(request.query.get("page", 1))
+        chunk = items[(page - 1) * limit:page * limit]
+        total_pages = max(1, -(-len(items) // limit))
+        return web.json_response({
+            "success": True,
+            key: chunk,
+            "pagination": {"limit": limit, "totalCount": len(items), "currentPage": page, "totalPageCount": total_pages},
+        })
+
+    async def orders_list(self, request: web.Request):
+        q = request.query
+        if "filter[customFields][bot_code]" in q:
+            o = self._by_code.get(q["filter[customFields][bot_code]"].strip())
+            items = [o] if o else []
+        elif "filter[customerId]" in q:
+            items = list(self._by_customer.get(int(q["filter[customerId]"]), []))
+            statuses = set(q.getall("filter[extendedStatus][]", []))
+            if statuses:
+                items = [o for o in items if o["status"] in statuses or STATUS_GROUPS.get(o["status"]) in statuses]
+        elif "filter[ids][]" in q:
+            items = [self.orders[int(i)] for i in q.getall("filter[ids][]") if int(i) in self.orders]
+        else:
+            items = list(self.orders.values())
+        return self._page(items, request, "orders")
+
+    async def customers_list(self, request: web.Request):
+        q = request.query
+        if "filter[phone]" in q:
+            c = self._by_phone.get(_digits(q["filter[phone]"])[-10:])
+            items = [c] if c else []
+        elif "filter[name]" in q:
+            items = []
+        elif "filter[ids][]" in q:
+            items = [self.customers[int(i)] for i in q.getall("filter[ids][]") if int(i) in self.customers]
+        else:
+            items = list(self.customers.values())
+        return self._page(items, request, "customers")
+
+    async def order_get(self, request: web.Request):
+        o = self.orders.get(int(request.match_info["id"]))
+        if o is None:
+            return web.json_response({"success": False, "errorMsg": "Not found"}, status=404)
+        return web.json_response({"success": True, "order": o})
+
+    async def order_edit(self, request: web.Request):
+        o = self.orders.get(int(request.match_info["id"]))
+        if o is None:
+            return web.json_response({"success": False, "errorMsg": "Not found"}, status=404)
+        try:
+            payload = await request.json()
+        except Exception:
+            payload = {}
+        fields = ((payload.get("order") or {}).get("customFields")) or {}
+        o["customFields"].update(fields)
+        return web.json_response({"success": True, "id": o["id"]})
+
+    async def history(self, request: web.Request):
+        return web.json_response({"success": True, "history": [], "pagination": {"totalCount": 0}})
+
+    async def sites(self, request: web.Request):
+        return web.json_response({"success": True, "sites": {"main": {"code": "main", "name": "Main"}}})
+
+    async def statuses(self, request: web.Request):
+        return web.json_response({"success": True, "statuses": {
+            code: {"code": code, "name": name, "group": STATUS_GROUPS[code], "active": True} for code, name in STATUSES}})
+
+    async def delivery_types(self, request: web.Request):
+        return web.json_response({"success": True, "deliveryTypes": {"cdek": {"code": "cdek", "name": "СДЭК"}}})
+
+    def stats(self) -> dict:
+        return {"calls": sum(self.calls.values()), "by_endpoint": dict(self.calls),
+                "errors_injected": sum(self.errors.values())}
@@ -0,0 +1,68 @@
+import time
+import asyncio
+import itertools
+from collections import Counter
+
+from aiohttp import web
+
+# Заглушка Telegram Bot API: принимает вызовы бота (sendMessage, answerCallbackQuery, ...)
+# и сообщает о них прогонщику, чтобы тот считал сквозную задержку по чатам.
+class FakeTelegram:
+    def __init__(self, latency_ms: float = 0.0):
+        self.latency_ms = latency_ms
+        self.calls = Counter()
+        self._message_ids = itertools.count(1)
+        self._listeners: list = []
+        self.webhook_url = ""
+
+    def on_call(self, listener):
+        """listener(method, chat_id, callback_query_id, at) — вызывается на каждый ответ бота пользователю."""
+        self._listeners.append(listener)
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        return app
+
+    def _emit(self, method: str, chat_id, callback_query_id):
+        at = time.monotonic()
+        for listener in self._listeners:
+            listener(method, chat_id, callback_query_id, at)
+
+    async def handle(self, request: web.Request):
+        method = request.match_info["method"]
+        self.calls[method] += 1
+        if request.content_type.startswith("multipart/") or request.content_type == "application/x-www-form-urlencoded":
+            params = dict(await request.post())
+        else:
+            params = await request.json() if request.can_read_body else {}
+        if self.latency_ms:
+            await asyncio.sleep(self.latency_ms / 1000.0)
+        result = self._result(method, params)
+        chat_id = params.get("chat_id")
+        self._emit(method, int(chat_id) if chat_id is not None else None, params.get("callback_query_id"))
+        return web.json_response({"ok": True, "result": result})
+
+    def _result(self, method: str, params: dict):
+        if method == "getMe":
+            return {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+        if method == "setWebhook":
+            self.webhook_url = params.get("url", "")
+            return True
+        if method == "deleteWebhook":
+            self.webhook_url = ""
+            return True
+        if method == "getWebhookInfo":
+            return {"url": self.webhook_url, "has_custom_certificate": False, "pending_update_count": 0}
+        if method in ("sendMessage", "editMessageText"):
+            chat_id = int(params.get("chat_id") or 0)
+            return {
+                "message_id": int(params.get("message_id") or next(self._message_ids)),
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "text": params.get("text", ""),
+            }
+        return True
+
+    def stats(self) -> dict:
+        return {"calls": sum(self.calls.values()), "by_method": dict(self.calls)}
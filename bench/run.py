@@ -0,0 +1,345 @@
+"""Нагрузочный прогон бота против фейковых RetailCRM и Telegram.
+
+    python bench/run.py --rate 50 --duration 30 --crm-latency 80 --crm-errors 0.01
+    python bench/run.py --rate 50 --duration 30 --baseline bench/results/prev.json
+
+Бот запускается отдельным процессом (`python bot.py`) с окружением, указывающим
+на заглушки; результаты пишутся в JSON (по умолчанию bench/results/<время>.json).
+"""
+import os
+import sys
+import json
+import time
+import random
+import signal
+import socket
+import asyncio
+import argparse
+import itertools
+from collections import deque
+from datetime import datetime
+
+import aiohttp
+from aiohttp import web
+
+from fake_cdek import FakeCDEK
+from fake_crm import FakeCRM, make_dataset
+from fake_telegram import FakeTelegram
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(ROOT, "bench", "results")
+BOT_TOKEN = "123456:bench"
+WEBHOOK_SECRET = "bench-secret"
+
+# сценарий — список шагов (тип апдейта, текст/callback_data, сколько вызовов Bot API ждём в ответ)
+SCENARIOS = {
+    "auth_code": (0.35, lambda crm: [("message", "/start", 1), ("message", crm.sample_code(), 2),
+                                     ("callback", "status", 2), ("callback", "track", 2),
+                                     ("callback", "orders", 2), ("callback", "orders:active:1", 2),
+                                     ("callback", "orders:past:1", 2)]),
+    "auth_deeplink": (0.10, lambda crm: [("message", "/start " + crm.sample_code(), 2),
+                                         ("callback", "track", 2), ("callback", "status", 2)]),
+    "auth_phone": (0.25, lambda crm: [("message", "/start", 1), ("message", crm.sample_phone(), 2),
+                                      ("callback", "orders", 2), ("callback", "orders:active:1", 2),
+                                      ("callback", "orders:active:2", 2), ("callback", "orders:active:1", 2)]),
+    "auth_miss": (0.15, lambda crm: [("message", "/start", 1), ("message", "NOPE%d" % random.randint(1, 10**6), 2)]),
+    "support": (0.15, lambda crm: [("message", "/start", 1), ("message", crm.sample_code(), 2),
+                                   ("callback", "support", 2), ("message", "Когда приедет заказ?", 1)]),
+}
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def _percentiles(values: list) -> dict:
+    if not values:
+        return {"count": 0}
+    values = sorted(values)
+
+    def pick(q):
+        return round(values[min(len(values) - 1, max(0, int(round(q * len(values))) - 1))] * 1000, 2)
+
+    return {"count": len(values), "p50": pick(0.50), "p95": pick(0.95), "p99": pick(0.99),
+            "max": round(values[-1] * 1000, 2), "mean": round(sum(values) / len(values) * 1000, 2)}
+
+class _Pending:
+    __slots__ = ("sent_at", "expect", "replies", "first_at", "future")
+
+    def __init__(self, sent_at: float, expect: int, future: asyncio.Future):
+        self.sent_at = sent_at
+        self.expect = expect
+        self.replies = 0
+        self.first_at = None
+        self.future = future
+
+class _Session:
+    _ids = itertools.count(1)
+
+    def __init__(self, scenario: str, steps: list):
+        self.chat_id = 10**9 + next(self._ids)
+        self.scenario = scenario
+        self.steps = deque(steps)
+
+class Replayer:
+    def __init__(self, crm: FakeCRM, telegram: FakeTelegram, webhook_url: str, step_timeout: float):
+        self.crm = crm
+        self.webhook_url = webhook_url
+        self.step_timeout = step_timeout
+        self._update_ids = itertools.count(1)
+        self._pending: dict = {}      # chat id -> _Pending
+        self._callbacks: dict = {}    # callback_query id -> chat id
+        self.first: list = []
+        self.complete: list = []
+        self.by_step: dict = {}
+        self.counters = {"sent": 0, "completed": 0, "timeouts": 0, "webhook_errors": 0,
+                         "unexpected_replies": 0, "generator_saturated": 0, "sessions": 0}
+        telegram.on_call(self._on_reply)
+
+    def _on_reply(self, method: str, chat_id, callback_query_id, at: float):
+        if chat_id is None and callback_query_id is not None:
+            chat_id = self._callbacks.pop(callback_query_id, None)
+        p = self._pending.get(chat_id)
+        if p is None:
+            if method not in ("setWebhook", "deleteWebhook", "getWebhookInfo", "getMe"):
+                self.counters["unexpected_replies"] += 1
+            return
+        p.replies += 1
+        if p.first_at is None:
+            p.first_at = at
+        if p.replies >= p.expect and not p.future.done():
+            p.future.set_result(at)
+
+    def _update(self, session: _Session, kind: str, value: str) -> dict:
+        update_id = next(self._update_ids)
+        user = {"id": session.chat_id, "is_bot": False, "first_name": "Bench"}
+        chat = {"id": session.chat_id, "type": "private"}
+        if kind == "callback":
+            cq_id = str(update_id)
+            self._callbacks[cq_id] = session.chat_id
+            return {"update_id": update_id, "callback_query": {
+                "id": cq_id, "from": user, "chat_instance": str(session.chat_id), "data": value,
+                "message": {"message_id": 1, "date": int(time.time()), "chat": chat, "text": "menu"}}}
+        message = {"message_id": update_id, "date": int(time.time()), "chat": chat, "from": user, "text": value}
+        if value.startswith("/"):
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(value.split()[0])}]
+        return {"update_id": update_id, "message": message}
+
+    async def _step(self, http: aiohttp.ClientSession, session: _Session) -> bool:
+        kind, value, expect = session.steps.popleft()
+        label = f"{kind}:{value if kind == 'callback' else value.split()[0] if value.startswith('/') else session.scenario}"
+        loop = asyncio.get_running_loop()
+        p = _Pending(loop.time(), expect, loop.create_future())
+        self._pending[session.chat_id] = p
+        self.counters["sent"] += 1
+        try:
+            async with http.post(self.webhook_url, json=self._update(session, kind, value),
+                                 headers={"X-Telegram-Bot-Api-Secret-Token": WEBHOOK_SECRET}) as r:
+                if r.status != 200:
+                    self.counters["webhook_errors"] += 1
+                    return False
+            done_at = await asyncio.wait_for(asyncio.shield(p.future), timeout=self.step_timeout)
+        except asyncio.TimeoutError:
+            self.counters["timeouts"] += 1
+            return False
+        except aiohttp.ClientError:
+            self.counters["webhook_errors"] += 1
+            return False
+        finally:
+            self._pending.pop(session.chat_id, None)
+        self.counters["completed"] += 1
+        self.first.append(p.first_at - p.sent_at)
+        self.complete.append(done_at - p.sent_at)
+        self.by_step.setdefault(label, []).append(done_at - p.sent_at)
+        return True
+
+    def _new_session(self) -> _Session:
+        names = list(SCENARIOS)
+        name = random.choices(names, weights=[SCENARIOS[n][0] for n in names])[0]
+        self.counters["sessions"] += 1
+        return _Session(name, SCENARIOS[name][1](self.crm))
+
+    async def run(self, rate: float, duration: float, max_sessions: int) -> float:
+        """Открытая модель нагрузки: каждые 1/rate секунд отправляем следующий шаг свободной сессии."""
+        loop = asyncio.get_running_loop()
+        idle: deque = deque()
+        tasks: set = set()
+        active = 0
+
+        async def advance(http, session):
+            nonlocal active
+            ok = await self._step(http, session)
+            if ok and session.steps:
+                idle.append(session)
+            else:
+                active -= 1
+
+        async with aiohttp.ClientSession() as http:
+            started = loop.time()
+            next_at = started
+            while loop.time() - started < duration:
+                session = None
+                if idle:
+                    session = idle.popleft()
+                elif active < max_sessions:
+                    session = self._new_session()
+                    active += 1
+                if session is None:
+                    self.counters["generator_saturated"] += 1
+                else:
+                    task = asyncio.create_task(advance(http, session))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+                next_at += 1.0 / rate
+                await asyncio.sleep(max(0.0, next_at - loop.time()))
+            if tasks:
+                await asyncio.wait(tasks, timeout=self.step_timeout + 5)
+            return loop.time() - started
+
+async def _serve(app: web.Application, port: int) -> web.AppRunner:
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+    return runner
+
+async def _wait_ready(url: str, proc: asyncio.subprocess.Process, timeout: float = 30.0):
+    deadline = time.monotonic() + timeout
+    async with aiohttp.ClientSession() as http:
+        while time.monotonic() < deadline:
+            if proc.returncode is not None:
+                raise RuntimeError(f"bot exited with code {proc.returncode}, see bot log")
+            try:
+                async with http.get(url) as r:
+                    if r.status == 200:
+                        return
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(0.2)
+    raise RuntimeError("bot did not become ready in time")
+
+async def _fetch_json(url: str):
+    try:
+        async with aiohttp.ClientSession() as http:
+            async with http.get(url) as r:
+                return await r.json()
+    except Exception as e:
+        return {"error": str(e)}
+
+def _compare(result: dict, baseline_path: str):
+    with open(baseline_path, encoding="utf-8") as f:
+        base = json.load(f)
+    rows = [
+        ("updates_per_sec", lambda r: r["throughput"]["updates_per_sec"]),
+        ("complete p50, ms", lambda r: r["latency_ms"]["complete"].get("p50")),
+        ("complete p95, ms", lambda r: r["latency_ms"]["complete"].get("p95")),
+        ("complete p99, ms", lambda r: r["latency_ms"]["complete"].get("p99")),
+        ("first reply p95, ms", lambda r: r["latency_ms"]["first_reply"].get("p95")),
+        ("crm calls/update", lambda r: r["crm"]["calls_per_update"]),
+        ("timeouts", lambda r: r["updates"]["timeouts"]),
+    ]
+    print(f"\n{'metric':<22}{'baseline':>12}{'current':>12}{'change':>10}")
+    for name, get in rows:
+        old, new = get(base), get(result)
+        change = f"{(new - old) / old * 100:+.1f}%" if old and new is not None else "—"
+        print(f"{name:<22}{old if old is not None else '—':>12}{new if new is not None else '—':>12}{change:>10}")
+
+async def main(args):
+    random.seed(args.seed)
+    crm = FakeCRM(make_dataset(args.customers, args.orders_per_customer, seed=args.seed), latency_ms=args.crm_latency,
+                  jitter_ms=args.crm_jitter, error_rate=args.crm_errors, seed=args.seed)
+    telegram = FakeTelegram(latency_ms=args.tg_latency)
+    cdek = FakeCDEK()
+    crm_port, tg_port, cdek_port, bot_port = _free_port(), _free_port(), _free_port(), _free_port()
+    runners = [await _serve(crm.app(), crm_port), await _serve(telegram.app(), tg_port),
+               await _serve(cdek.app(), cdek_port)]
+
+    env = dict(os.environ)
+    env.update({
+        "BOT_TOKEN": BOT_TOKEN,
+        "TELEGRAM_API_URL": f"http://127.0.0.1:{tg_port}",
+        "CRM_URL": f"http://127.0.0.1:{crm_port}",
+        "CRM_API_KEY": "bench",
+        "PORT": str(bot_port),
+        "WEBHOOK_URL": f"http://127.0.0.1:{bot_port}",
+        "WEBHOOK_SECRET": WEBHOOK_SECRET,
+        "CDEK_API_URL": f"http://127.0.0.1:{cdek_port}",
+        "CDEK_CLIENT_ID": "bench",
+        "CDEK_CLIENT_SECRET": "bench",
+    })
+    for item in args.env:
+        key, _, value = item.partition("=")
+        env[key] = value
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+    out_path = args.out or os.path.join(RESULTS_DIR, f"{stamp}.json")
+    log_path = os.path.splitext(out_path)[0] + ".bot.log"
+    with open(log_path, "wb") as log:
+        proc = await asyncio.create_subprocess_exec(sys.executable, "bot.py", cwd=ROOT, env=env,
+                                                    stdout=log, stderr=asyncio.subprocess.STDOUT)
+    base = f"http://127.0.0.1:{bot_port}"
+    try:
+        await _wait_ready(f"{base}/healthz", proc)
+        crm.calls.clear()
+        replayer = Replayer(crm, telegram, f"{base}/webhook", args.step_timeout)
+        elapsed = await replayer.run(args.rate, args.duration, args.max_sessions)
+        bot_health = await _fetch_json(f"{base}/healthz")
+    finally:
+        if proc.returncode is None:
+            proc.send_signal(signal.SIGTERM)
+            try:
+                await asyncio.wait_for(proc.wait(), timeout=30)
+            except asyncio.TimeoutError:
+                proc.kill()
+        for runner in runners:
+            await runner.cleanup()
+
+    completed = replayer.counters["completed"]
+    crm_stats = crm.stats()
+    result = {
+        "started_at": stamp,
+        "config": {k: v for k, v in vars(args).items() if k not in ("out", "baseline")},
+        "updates": replayer.counters,
+        "throughput": {"elapsed_seconds": round(elapsed, 2),
+                       "updates_per_sec": round(completed / elapsed, 2) if elapsed else 0.0},
+        "latency_ms": {"first_reply": _percentiles(replayer.first), "complete": _percentiles(replayer.complete)},
+        "by_step": {label: _percentiles(values) for label, values in sorted(replayer.by_step.items())},
+        "crm": dict(crm_stats, calls_per_update=round(crm_stats["calls"] / replayer.counters["sent"], 3)
+                    if replayer.counters["sent"] else 0.0),
+        "telegram": telegram.stats(),
+        "cdek": cdek.stats(),
+        "bot_health": bot_health,
+    }
+    with open(out_path, "w", encoding="utf-8") as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+
+    print(f"updates: {replayer.counters['sent']} sent, {completed} completed, "
+          f"{replayer.counters['timeouts']} timeouts, {replayer.counters['webhook_errors']} webhook errors")
+    print(f"throughput: {result['throughput']['updates_per_sec']} updates/s")
+    for name, stats in result["latency_ms"].items():
+        print(f"{name}: p50={stats.get('p50')}ms p95={stats.get('p95')}ms p99={stats.get('p99')}ms")
+    print(f"crm calls/update: {result['crm']['calls_per_update']}")
+    print(f"saved: {out_path}")
+    if args.baseline:
+        _compare(result, args.baseline)
+
+def parse_args(argv=None):
+    p = argparse.ArgumentParser(description="Нагрузочный прогон бота против фейковых RetailCRM и Telegram")
+    p.add_argument("--rate", type=float, default=20.0, help="апдейтов в секунду")
+    p.add_argument("--duration", type=float, default=30.0, help="длительность прогона, сек")
+    p.add_argument("--max-sessions", type=int, default=500, help="одновременно активных пользователей")
+    p.add_argument("--customers", type=int, default=5000, help="клиентов в фейковой CRM")
+    p.add_argument("--orders-per-customer", type=int, default=8, help="до скольких заказов у клиента")
+    p.add_argument("--crm-latency", type=float, default=50.0, help="средняя задержка CRM, мс")
+    p.add_argument("--crm-jitter", type=float, default=20.0, help="разброс задержки CRM, мс")
+    p.add_argument("--crm-errors", type=float, default=0.0, help="доля ответов CRM с ошибкой 503")
+    p.add_argument("--tg-latency", type=float, default=0.0, help="задержка фейкового Telegram, мс")
+    p.add_argument("--step-timeout", type=float, default=30.0, help="сколько ждать ответа бота на апдейт, сек")
+    p.add_argument("--seed", type=int, default=1)
+    p.add_argument("--env", action="append", default=[], metavar="KEY=VALUE",
+                   help="дополнительные переменные окружения бота (например CRM_RATE_LIMIT=1000)")
+    p.add_argument("--out", help="куда сохранить JSON с результатами")
+    p.add_argument("--baseline", help="JSON предыдущего прогона для сравнения")
+    return p.parse_args(argv)
+
+if __name__ == "__main__":
+    asyncio.run(main(parse_args()))
@@ -1,29 +1,55 @@
 
 import os
 import re
+import hashlib
+import asyncio
 import logging
 from aiogram import Bot, Dispatcher, types, F
-from aiogram.filters import Command, CommandStart, StateFilter
-from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+from aiogram.filters import Command, CommandObject, CommandStart, StateFilter
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, BufferedInputFile
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiogram.exceptions import TelegramBadRequest
 from aiohttp import web
 
-from crm import (
+import time
+import crm_index
+import crm_limiter
+import crm_reference
+import tracking
+import crm_writer
+import metrics
+import log_setup
+import diagnostics
+import notifier
+import bulk_probe
+import throttle
+import workers
+import sender as tg_sender
+from keyboards import get_orders_keyboard, get_orders_page_keyboard
+from ingest import UpdateIngestor
+from crm_async import (
     pick_order_by_code_or_phone,
     get_order_by_id,
+    prefetch_order,
     get_order_status_text_by_id,
     get_tracking_number_text_by_id,
-    get_orders_list_text_by_customer_id,
+    get_orders_page_text,
     save_review_by_order_id,
     save_telegram_id_for_order,
-    debug_probe
+    debug_probe,
+    close_session as close_crm_session,
+    cache_stats,
+    check_reachable as check_crm_reachable,
+    NO_ORDERS_TEXT,
 )
 
-# Logs
-logging.basicConfig(level=logging.INFO)
+# Logs: очередь + поток вывода, JSON (log_setup.py)
+log_setup.setup()
 logging.getLogger("aiogram").setLevel(logging.INFO)
 
 # ENV
@@ -31,6 +57,11 @@ BOT_TOKEN = os.getenv("BOT_TOKEN")
 WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
 WEBHOOK_URL = os.getenv("WEBHOOK_URL")
 PORT = int(os.getenv("PORT", 8080))
+# свой адрес Bot API: локальный telegram-bot-api сервер или фейковый Telegram из bench/
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or None
+# queue — сразу отвечаем Telegram 200 и обрабатываем апдейт в пуле воркеров; inline — обработка внутри запроса
+WEBHOOK_MODE = os.getenv("WEBHOOK_MODE", "queue").lower()
 
 ADMIN_ID_RAW = os.getenv("ADMIN_ID")
 def _parse_admin_id(val: str | None):
@@ -45,16 +76,52 @@ def _parse_admin_id(val: str | None):
     return None
 ADMIN_ID = _parse_admin_id(ADMIN_ID_RAW)
 
-DROP_UPDATES_ON_START = os.getenv("DROP_UPDATES_ON_START", "true").lower() == "true"
-
-bot = Bot(token=BOT_TOKEN)
-dp = Dispatcher(storage=MemoryStorage())
+CRM_UNAVAILABLE_TEXT = "Сейчас не получается подключиться к CRM. Попробуйте ещё раз через минуту 🤍"
+
+HEALTH_CACHE_TTL = float(os.getenv("HEALTH_CACHE_TTL", "15"))  # как долго помним результат глубокой проверки /healthz?deep=1
+
+# при редеплое апдейты, пришедшие во время рестарта, Telegram доставит новому процессу — не выбрасываем их
+DROP_UPDATES_ON_START = os.getenv("DROP_UPDATES_ON_START", "false").lower() == "true"
+ALLOWED_UPDATES = ["message", "callback_query"]
+SHUTDOWN_TIMEOUT = float(os.getenv("SHUTDOWN_TIMEOUT", "25"))  # сколько при остановке дорабатываем уже принятые апдейты, сек
+WEBHOOK_STATE_KEY = "bot:webhook"  # отпечаток последней установки вебхука (секрет getWebhookInfo не возвращает)
+# redis — сессии переживают редеплой и общие для нескольких реплик; memory — только для локальной отладки
+FSM_STORAGE = os.getenv("FSM_STORAGE", "redis" if os.getenv("REDIS_URL") else "memory").lower()
+# в многопроцессном режиме (BOT_WORKERS > 1) фронт-процесс передаёт воркеру номер и unix-сокет;
+# вебхук и фоновые задачи ведёт только воркер 0
+WORKER_INDEX = int(os.getenv("BOT_WORKER_INDEX", "0"))
+WORKER_SOCKET = os.getenv("BOT_WORKER_SOCKET")
+
+def _make_storage():
+    if FSM_STORAGE == "redis":
+        from fsm_storage import RedisFSMStorage
+        return RedisFSMStorage()
+    return MemoryStorage()
+
+def _make_bot() -> Bot:
+    if TELEGRAM_API_URL:
+        session = AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL.rstrip("/")))
+        return Bot(token=BOT_TOKEN, session=session)
+    return Bot(token=BOT_TOKEN)
+
+bot = _make_bot()
+dp = Dispatcher(storage=_make_storage())
+sender = tg_sender.SendScheduler(bot)
+bot.session.middleware(tg_sender.SchedulerMiddleware(sender))
+ingestor = UpdateIngestor(dp, bot, secret=WEBHOOK_SECRET)
+dp.update.outer_middleware(log_setup.LogContextMiddleware())
+dp.message.middleware(metrics.HandlerTimingMiddleware("message"))
+dp.callback_query.middleware(metrics.HandlerTimingMiddleware("callback_query"))
 
 class AuthStates(StatesGroup):
     waiting_for_code = State()
     waiting_for_review = State()
     waiting_support_message = State()
 
+_throttle = throttle.ThrottleMiddleware(auth_state=AuthStates.waiting_for_code.state)
+dp.message.outer_middleware(_throttle)
+dp.callback_query.outer_middleware(_throttle)
+
 def get_main_keyboard():
     return InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="📦 Статус отправления", callback_data="status")],
@@ -71,14 +138,27 @@ async def is_authed(state: FSMContext) -> bool:
     return bool(data.get("order_id"))
 
 @dp.message(CommandStart())
-async def start_handler(message: types.Message, state: FSMContext):
-    logging.info("START from %s", message.from_user.id)
+async def start_handler(message: types.Message, state: FSMContext, command: CommandObject):
+    # t.me/<bot>?start=<bot_code> — код приходит вместе с /start, входим сразу, без второго сообщения
+    payload = (command.args or "").strip()
+    logging.info("START from %s%s", message.from_user.id, " with code" if payload else "")
     await state.clear()
+    await state.set_state(AuthStates.waiting_for_code)
+    if payload:
+        logging.info("AUTH deep link from %s: %s", message.from_user.id, log_setup.mask(payload))
+        # ThrottleMiddleware проверяет блокировку только в состоянии ввода кода, а /start приходит без него
+        left = await throttle.auth_lockout_left(message.from_user.id)
+        if left > 0:
+            metrics.THROTTLED.inc("auth_lockout")
+            await message.answer(throttle.auth_locked_text(left))
+            return
+        await _authorize(message, state, payload,
+                         searching_text="👋 Привет! Я Missis S'Uzi — ищу ваш заказ… секунду, пожалуйста 🤍")
+        return
     await message.answer(
         "👋 Привет! Я Missis S'Uzi — помогу узнать статус вашего заказа.\n"
         "Введите, пожалуйста, ваш bot_code или номер телефона 🤍"
     )
-    await state.set_state(AuthStates.waiting_for_code)
 
 @dp.message(Command("ping"))
 async def ping_handler(message: types.Message):
@@ -94,9 +174,9 @@ async def _run_probe(message: types.Message, raw_value: str):
     if not value:
         await message.answer("Использование: /probe 7488  или  /probe +7XXXXXXXXXX")
         return
-    logging.info("PROBE by %s: %s", message.from_user.id, value)
+    logging.info("PROBE by %s: %s", message.from_user.id, log_setup.mask(value))
     try:
-        report = debug_probe(value)
+        report = await debug_probe(value)
     except Exception as e:
         logging.exception("probe failed")
         await message.answer(f"Проверка упала: {e}")
@@ -106,11 +186,14 @@ async def _run_probe(message: types.Message, raw_value: str):
     lines.append("🔎 PROBE-результат:")
     lines.append(f"• Ввод: {report.get('input')}")
     lines.append(f"• Нормализованный телефон: {report.get('normalized_phone') or '—'}")
+    if report.get("phone_key"):
+        # RetailCRM сравнивает телефон по цифрам: этот ключ находит и +7…, и 8…, и 7…
+        lines.append(f"• Ключ поиска по телефону: {report['phone_key']}")
     by_code = report.get('by_code') or {}
     lines.append(f"• Найдено заказов по bot_code: {by_code.get('count', 0)}")
     first = by_code.get('first')
     if first:
-        lines.append(f"   └ первый: id={first.get('id')} №{first.get('number')} site={first.get('site')} bot_code={first.get('bot_code')}")
+        lines.append(f"   └ первый: id={first.get('id')} №{first.get('number')} site={first.get('site_name') or first.get('site')} bot_code={first.get('bot_code')}")
     by_phone = report.get('by_phone') or {}
     lines.append(f"• Найдено клиентов по телефону: {by_phone.get('customers_count', 0)}")
     fc = by_phone.get('first_customer') or {}
@@ -119,8 +202,11 @@ async def _run_probe(message: types.Message, raw_value: str):
     lines.append(f"• Найдено заказов по customerId: {by_phone.get('orders_count', 0)}")
     fo = by_phone.get('first_order') or {}
     if fo:
-        lines.append(f"   └ первый заказ: id={fo.get('id')} №{fo.get('number')} site={fo.get('site')}")
+        lines.append(f"   └ первый заказ: id={fo.get('id')} №{fo.get('number')} site={fo.get('site_name') or fo.get('site')}")
     lines.append(f"• Выбранный заказ: {report.get('picked') or '—'}")
+    timings = report.get("timings_ms") or {}
+    if timings:
+        lines.append("• Время запросов, мс: " + ", ".join(f"{k}={v}" for k, v in timings.items()))
     lines.append("")
     lines.append("Если по коду/телефону ноль результатов: проверьте в CRM, что:")
     lines.append("— код поля именно customFields.bot_code (или задайте CRM_BOT_CODE_FIELD);")
@@ -129,6 +215,60 @@ async def _run_probe(message: types.Message, raw_value: str):
     lines.append("— сайт заказа доступен текущему apiKey.")
     await message.answer("\n".join(lines))
 
+_bulk_probe_running = False
+
+# /probe с приложенным файлом — пакетная проверка; регистрируется раньше обычного /probe
+@dp.message(Command("probe"), F.document)
+async def bulk_probe_handler(message: types.Message):
+    global _bulk_probe_running
+    if not _is_admin(message.from_user.id):
+        await message.answer("Команда доступна только администратору.")
+        return
+    if (message.document.file_size or 0) > bulk_probe.BULK_PROBE_MAX_BYTES:
+        await message.answer("Файл слишком большой (максимум 5 МБ).")
+        return
+    if _bulk_probe_running:
+        await message.answer("Пакетная проверка уже идёт, дождитесь отчёта.")
+        return
+    # занимаем флаг до первого await, иначе два файла подряд запустят две проверки
+    _bulk_probe_running = True
+    handed_off = False
+    try:
+        data = await bot.download(message.document)
+        values = bulk_probe.parse_values(data.read())
+        if not values:
+            await message.answer("В файле не нашлось кодов или телефонов: нужен CSV или текст, по значению в строке.")
+            return
+        logging.info("BULK PROBE by %s: %s values", message.from_user.id, len(values))
+        progress = await message.answer(f"🔎 Проверяю {len(values)} значений…")
+        _spawn(_bulk_probe_run(message, values, progress), "bulk-probe")
+        handed_off = True  # дальше флаг снимет сама проверка
+    finally:
+        if not handed_off:
+            _bulk_probe_running = False
+
+async def _bulk_probe_run(message: types.Message, values: list, progress: types.Message):
+    global _bulk_probe_running
+
+    async def on_progress(done, total, found, errors):
+        await progress.edit_text(f"🔎 Проверено {done}/{total}: найдено {found}, ошибок {errors}")
+
+    started = time.monotonic()
+    try:
+        rows = await bulk_probe.run(values, on_progress)
+        text = bulk_probe.summary(rows, time.monotonic() - started)
+        report = BufferedInputFile(bulk_probe.to_csv(rows), filename=f"probe-{int(time.time())}.csv")
+        await bot.send_document(message.chat.id, report, caption=text)
+        try:
+            await progress.delete()
+        except TelegramBadRequest:
+            pass
+    except Exception as e:
+        logging.exception("bulk probe failed")
+        await sender.send_message(message.chat.id, f"Пакетная проверка упала: {e}")
+    finally:
+        _bulk_probe_running = False
+
 @dp.message(Command("probe"))
 async def probe_handler(message: types.Message):
     if not _is_admin(message.from_user.id):
@@ -138,6 +278,27 @@ async def probe_handler(message: types.Message):
     arg = parts[1] if len(parts) > 1 else ""
     await _run_probe(message, arg)
 
+@dp.message(Command("broadcast"))
+async def broadcast_handler(message: types.Message):
+    if not _is_admin(message.from_user.id):
+        await message.answer("Команда доступна только администратору.")
+        return
+    parts = (message.text or "").split(maxsplit=1)
+    text = parts[1].strip() if len(parts) > 1 else ""
+    if not text:
+        await message.answer("Использование: /broadcast текст сообщения")
+        return
+    if not tg_sender.TG_SUBSCRIBERS:
+        await message.answer("Рассылка недоступна: список подписчиков хранится в Redis, а он не настроен.")
+        return
+    await message.answer("Запускаю рассылку…")
+
+    async def _run():
+        stats = await sender.broadcast(text)
+        await sender.send_message(message.chat.id, f"Рассылка завершена: доставлено {stats['sent']}, ошибок {stats['failed']}.")
+
+    _spawn(_run(), "broadcast")
+
 # Text fallback: "probe <value>"
 @dp.message(F.text.regexp(r"^\s*probe\s+(.+)$"))
 async def probe_text_handler(message: types.Message, regexp: types.Message):
@@ -151,37 +312,57 @@ async def probe_text_handler(message: types.Message, regexp: types.Message):
 @dp.message(StateFilter(AuthStates.waiting_for_code), F.text)
 async def process_auth(message: types.Message, state: FSMContext):
     code_or_phone = (message.text or "").strip()
-    logging.info("AUTH attempt from %s: %s", message.from_user.id, code_or_phone)
+    logging.info("AUTH attempt from %s: %s", message.from_user.id, log_setup.mask(code_or_phone))
     if not code_or_phone:
         await message.answer("Введите, пожалуйста, bot_code или номер телефона 🤍")
         return
+    await _authorize(message, state, code_or_phone)
 
-    await message.answer("Ищу ваш заказ… секунду, пожалуйста 🤍")
+async def _authorize(message: types.Message, state: FSMContext, code_or_phone: str,
+                     searching_text: str = "Ищу ваш заказ… секунду, пожалуйста 🤍") -> bool:
+    """Найти заказ по bot_code или телефону и войти; при неудаче состояние ввода кода остаётся."""
+    await message.answer(searching_text)
 
     try:
-        order = pick_order_by_code_or_phone(code_or_phone)
+        order = await pick_order_by_code_or_phone(code_or_phone)
     except Exception as e:
         logging.exception("Auth CRM error")
-        await message.answer("Сейчас не получается подключиться к CRM. Попробуйте ещё раз через минуту 🤍")
-        return
+        metrics.AUTH_ATTEMPTS.inc("error")
+        await message.answer(CRM_UNAVAILABLE_TEXT)
+        return False
 
     if not order:
         logging.info("AUTH not found for %s", message.from_user.id)
+        metrics.AUTH_ATTEMPTS.inc("not_found")
+        lockout = await throttle.auth_failed(message.from_user.id)
+        if lockout:
+            await message.answer("❌ Не нашла заказ по введённым данным.\n" + throttle.auth_locked_text(lockout))
+            return False
         await message.answer(
             "❌ Не нашла заказ по введённым данным.\n"
             "Проверьте bot_code или введите номер телефона в формате +7XXXXXXXXXX 🤍"
         )
-        return
+        return False
 
+    metrics.AUTH_ATTEMPTS.inc("success")
+    # заказ и статус посылки грузятся, пока пользователь читает ответ и выбирает кнопку
+    _spawn(prefetch_order(order.id), "prefetch-order")
+    await throttle.auth_succeeded(message.from_user.id)
     try:
-        save_telegram_id_for_order(order["id"], message.from_user.id, site=order.get("site"))
+        await save_telegram_id_for_order(order.id, message.from_user.id, site=order.site)
     except Exception as e:
         logging.warning("Save telegram_id failed: %s", e)
 
-    await state.update_data(order_id=order["id"], customer_id=(order.get("customer") or {}).get("id"))
+    if notifier.NOTIFY_ENABLED:
+        _spawn(notifier.subscribe(order.id), "notify-subscribe")
+    if tg_sender.TG_SUBSCRIBERS:
+        _spawn(tg_sender.add_subscriber(message.chat.id), "add-subscriber")
+
+    await state.update_data(order_id=order.id, customer_id=order.customer_id)
     await state.set_state(None)
 
     await message.answer("✅ Авторизация успешна! Что хотите узнать?", reply_markup=get_main_keyboard())
+    return True
 
 async def ensure_authorized(callback: types.CallbackQuery, state: FSMContext) -> bool:
     if not await is_authed(state):
@@ -199,7 +380,11 @@ async def order_status_handler(callback: types.CallbackQuery, state: FSMContext)
         return
     data = await state.get_data()
     order_id = data["order_id"]
-    text = get_order_status_text_by_id(order_id)
+    try:
+        text = await get_order_status_text_by_id(order_id)
+    except Exception:
+        logging.exception("Status CRM error")
+        text = CRM_UNAVAILABLE_TEXT
     await callback.message.answer(text, reply_markup=get_main_keyboard())
     await callback.answer()
 
@@ -209,7 +394,11 @@ async def tracking_handler(callback: types.CallbackQuery, state: FSMContext):
         return
     data = await state.get_data()
     order_id = data["order_id"]
-    text = get_tracking_number_text_by_id(order_id)
+    try:
+        text = await get_tracking_number_text_by_id(order_id)
+    except Exception:
+        logging.exception("Tracking CRM error")
+        text = CRM_UNAVAILABLE_TEXT
     await callback.message.answer(text, reply_markup=get_main_keyboard())
     await callback.answer()
 
@@ -218,16 +407,55 @@ async def orders_handler(callback: types.CallbackQuery, state: FSMContext):
     if not await ensure_authorized(callback, state):
         return
     data = await state.get_data()
-    customer_id = data.get("customer_id")
-    if customer_id:
-        text = get_orders_list_text_by_customer_id(customer_id)
-    else:
-        o = get_order_by_id(data["order_id"])
-        status = o.get("statusComment") or o.get("status") or "Без статуса"
-        text = f"📋 Ваши заказы:\n— #{o.get('number')} ({status})"
+    if data.get("customer_id"):
+        await callback.message.answer("Какие заказы показать?", reply_markup=get_orders_keyboard())
+        await callback.answer()
+        return
+    try:
+        o = await get_order_by_id(data["order_id"])
+        text = f"📋 Ваши заказы:\n— #{o.number} ({o.status_label or 'Без статуса'})" if o else NO_ORDERS_TEXT
+    except Exception:
+        logging.exception("Orders CRM error")
+        text = CRM_UNAVAILABLE_TEXT
     await callback.message.answer(text, reply_markup=get_main_keyboard())
     await callback.answer()
 
+async def _edit_or_answer(callback: types.CallbackQuery, text: str, reply_markup):
+    try:
+        await callback.message.edit_text(text, reply_markup=reply_markup)
+    except TelegramBadRequest as e:
+        # повторное нажатие на ту же страницу — сообщение уже такое
+        if "message is not modified" not in str(e):
+            await callback.message.answer(text, reply_markup=reply_markup)
+
+@dp.callback_query(F.data.startswith("orders:"))
+async def orders_page_handler(callback: types.CallbackQuery, state: FSMContext):
+    if not await ensure_authorized(callback, state):
+        return
+    parts = (callback.data or "").split(":")
+    group = parts[1] if len(parts) > 1 else "active"
+    page = int(parts[2]) if len(parts) > 2 and parts[2].isdigit() else 1
+    data = await state.get_data()
+    customer_id = data.get("customer_id")
+    if group not in ("active", "past") or not customer_id:
+        await callback.answer()
+        return
+    try:
+        text, page, pages = await get_orders_page_text(customer_id, group, page)
+        markup = get_orders_page_keyboard(group, page, pages)
+    except Exception:
+        logging.exception("Orders page CRM error")
+        text, markup = CRM_UNAVAILABLE_TEXT, get_main_keyboard()
+    await _edit_or_answer(callback, text, markup)
+    await callback.answer()
+
+@dp.callback_query(F.data == "menu")
+async def menu_handler(callback: types.CallbackQuery, state: FSMContext):
+    if not await ensure_authorized(callback, state):
+        return
+    await _edit_or_answer(callback, "Что хотите узнать?", get_main_keyboard())
+    await callback.answer()
+
 @dp.callback_query(F.data == "support")
 async def support_handler(callback: types.CallbackQuery, state: FSMContext):
     if not await ensure_authorized(callback, state):
@@ -244,7 +472,7 @@ async def support_message_receiver(message: types.Message, state: FSMContext):
     uname = f"@{message.from_user.username}" if message.from_user.username else f"id {message.from_user.id}"
     if ADMIN_ID is not None:
         try:
-            await bot.send_message(ADMIN_ID, f"🆘 Запрос поддержки от {uname}:\n{message.text}")
+            await sender.send_message(ADMIN_ID, f"🆘 Запрос поддержки от {uname}:\n{message.text}")
         except Exception as e:
             logging.warning("Failed to deliver support message to ADMIN_ID=%r: %s", ADMIN_ID, e)
     else:
@@ -254,40 +482,244 @@ async def support_message_receiver(message: types.Message, state: FSMContext):
     await state.set_state(None)
 
 # Health endpoint
-async def health(request: web.Request):
-    return web.json_response({"ok": True})
+_deep_health = {"at": 0.0, "result": None}
 
-async def on_startup(app):
+async def _redis_check() -> dict:
     try:
-        url = WEBHOOK_URL
-        if not url.endswith(WEBHOOK_PATH):
-            url = url.rstrip("/") + WEBHOOK_PATH
-        await bot.set_webhook(
-            url,
-            allowed_updates=["message", "callback_query"],
-            drop_pending_updates=DROP_UPDATES_ON_START,
-        )
-        logging.info("Webhook set to: %s", url)
+        from redis_client import ping
+        return await ping()
     except Exception as e:
-        logging.exception("Failed to set webhook: %s", e)
-        raise
+        return {"ok": False, "error": str(e)}
+
+async def _deep_checks() -> dict:
+    # результат кэшируем: частые пробы балансировщика не должны долбить CRM и Redis
+    now = time.monotonic()
+    if _deep_health["result"] is None or now - _deep_health["at"] >= HEALTH_CACHE_TTL:
+        redis_result, crm_result = await asyncio.gather(_redis_check(), check_crm_reachable())
+        _deep_health["result"] = {"redis": redis_result, "crm": crm_result}
+        _deep_health["at"] = now
+    return dict(_deep_health["result"], checked_seconds_ago=round(now - _deep_health["at"], 1))
+
+async def health(request: web.Request):
+    payload = {"ok": True, "webhook": _webhook_status, "cache": cache_stats(), "sender": sender.stats(),
+               "reference": crm_reference.stats(), "logs": log_setup.stats(),
+               "loop": diagnostics.summary()}
+    if tracking.TRACKING_ENABLED:
+        payload["tracking"] = tracking.stats()
+    if request.query.get("deep"):
+        payload["checks"] = await _deep_checks()
+        payload["ok"] = payload["checks"]["redis"]["ok"] and payload["checks"]["crm"]["ok"]
+    if WEBHOOK_MODE == "queue":
+        payload["ingest"] = ingestor.stats()
+    if crm_index.CRM_INDEX_ENABLED:
+        try:
+            payload["index"] = await crm_index.index_lag()
+        except Exception as e:
+            payload["index"] = {"error": str(e)}
+    if crm_writer.CRM_WRITE_QUEUE:
+        try:
+            payload["write_queue"] = await crm_writer.queue_stats()
+        except Exception as e:
+            payload["write_queue"] = {"error": str(e)}
+    return web.json_response(payload, status=200 if payload["ok"] else 503)
+
+async def metrics_handler(request: web.Request):
+    return web.Response(body=metrics.render().encode(),
+                        headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+def _collect_runtime() -> list:
+    families = []
+    cache_samples = {"hits": [], "stale_hits": [], "misses": [], "loads": [], "load_errors": []}
+    for name, stats in cache_stats().items():
+        for key, samples in cache_samples.items():
+            samples.append(({"cache": name}, stats.get(key)))
+    for key, samples in cache_samples.items():
+        families.append((f"crm_cache_{key}_total", "counter", f"Кэш заказов: {key}", samples))
+    families.append(("tg_send_total", "counter", "Исходящие сообщения по результату",
+                     [({"result": k}, v) for k, v in sender.counters.items()]))
+    families.append(("tg_send_queue", "gauge", "Сообщения в очереди отправки",
+                     [({"queue": "ready"}, sender.stats()["queued"]), ({"queue": "delayed"}, sender.stats()["delayed"])]))
+    if WEBHOOK_MODE == "queue":
+        stats = ingestor.stats()
+        families.append(("ingest_updates_total", "counter", "Входящие апдейты по результату",
+                         [({"result": k}, stats[k]) for k in ingestor.counters]))
+        families.append(("ingest_queue_depth", "gauge", "Апдейты в очереди обработки", [({}, stats["depth"])]))
+        families.append(("ingest_lag_max_seconds", "gauge", "Максимальная задержка апдейта в очереди",
+                         [({}, stats["lag_max_seconds"])]))
+    state = crm_limiter.breaker.state
+    families.append(("crm_breaker_open", "gauge", "Circuit breaker CRM: 1 — разомкнут",
+                     [({}, 0 if state == "closed" else 1)]))
+    return families
+
+metrics.register_collector(_collect_runtime)
+
+# Background workers (index sync etc.)
+_background_tasks: list[asyncio.Task] = []
+_spawned: set[asyncio.Task] = set()
+
+def _start_background(coro, name: str):
+    _background_tasks.append(asyncio.create_task(coro, name=name))
+
+def _spawn(coro, name: str):
+    # короткая фоновая задача «запустил и забыл»; держим ссылку, чтобы её не собрал GC
+    task = asyncio.create_task(coro, name=name)
+    _spawned.add(task)
+
+    def _done(t: asyncio.Task):
+        _spawned.discard(t)
+        if not t.cancelled() and t.exception() is not None:
+            logging.warning("Background task %s failed: %s", name, t.exception())
+    task.add_done_callback(_done)
+
+async def _stop_background():
+    for task in _background_tasks:
+        task.cancel()
+    await asyncio.gather(*_background_tasks, return_exceptions=True)
+    _background_tasks.clear()
+
+# Webhook
+_webhook_status = {"ready": False, "action": None}
+
+def _webhook_url() -> str:
+    url = WEBHOOK_URL
+    if not url.endswith(WEBHOOK_PATH):
+        url = url.rstrip("/") + WEBHOOK_PATH
+    return url
+
+def _webhook_fingerprint(url: str) -> str:
+    raw = "|".join([url, ",".join(sorted(ALLOWED_UPDATES)), WEBHOOK_SECRET or ""])
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+async def _webhook_up_to_date(url: str) -> bool:
+    if DROP_UPDATES_ON_START:
+        return False
+    info = await bot.get_webhook_info()
+    if info.url != url or set(info.allowed_updates or []) != set(ALLOWED_UPDATES):
+        return False
+    if not WEBHOOK_SECRET:
+        return True
+    if not os.getenv("REDIS_URL"):
+        # секрет не сверить — переустанавливаем, чтобы не остаться со старым
+        return False
+    from redis_client import ar
+    return await ar.get(WEBHOOK_STATE_KEY) == _webhook_fingerprint(url)
+
+async def ensure_webhook():
+    """Поставить вебхук, только если он отличается от уже установленного; при ошибке — повторять."""
+    if not WEBHOOK_URL:
+        logging.warning("WEBHOOK_URL is not set; webhook setup skipped")
+        return
+    url = _webhook_url()
+    delay = 1.0
+    while True:
+        try:
+            if await _webhook_up_to_date(url):
+                logging.info("Webhook already set to %s, skipping setWebhook", url)
+                _webhook_status.update(ready=True, action="unchanged")
+                return
+            await bot.set_webhook(
+                url,
+                allowed_updates=ALLOWED_UPDATES,
+                drop_pending_updates=DROP_UPDATES_ON_START,
+                secret_token=WEBHOOK_SECRET,
+            )
+            if os.getenv("REDIS_URL"):
+                try:
+                    from redis_client import ar
+                    await ar.set(WEBHOOK_STATE_KEY, _webhook_fingerprint(url))
+                except Exception as e:
+                    logging.warning("Failed to store webhook fingerprint: %s", e)
+            logging.info("Webhook set to: %s", url)
+            _webhook_status.update(ready=True, action="set")
+            return
+        except Exception as e:
+            logging.warning("Failed to set webhook (retry in %.0fs): %s", delay, e)
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 60.0)
+
+async def on_startup(app):
+    await sender.start()
+    if WEBHOOK_MODE == "queue":
+        await ingestor.start()
+    if WORKER_SOCKET:
+        _start_background(workers.watch_front(), "front-watch")
+    if diagnostics.LOOP_MONITOR_ENABLED:
+        diagnostics.start_watchdog()
+        _start_background(diagnostics.run_lag_monitor(), "loop-lag")
+    # справочники нужны каждому процессу; свежую копию из Redis процессы берут друг у друга
+    _start_background(crm_reference.run_refresh_worker(), "crm-reference")
+    if WORKER_INDEX != 0:
+        return
+    # вебхук настраиваем в фоне — процесс сразу отвечает на /healthz
+    _start_background(ensure_webhook(), "webhook-setup")
+    if crm_index.CRM_INDEX_ENABLED:
+        _start_background(crm_index.run_sync_worker(), "crm-index-sync")
+    if crm_writer.CRM_WRITE_QUEUE:
+        _start_background(crm_writer.run_write_worker(), "crm-write-queue")
+    if notifier.NOTIFY_ENABLED:
+        _start_background(notifier.run_notifier(sender), "order-notifier")
+    if tracking.TRACKING_ENABLED:
+        _start_background(tracking.run_poller(), "tracking-poller")
 
 async def on_shutdown(app):
-    await bot.delete_webhook()
+    # вебхук не удаляем: при редеплое новый процесс уже принимает апдейты по тому же адресу,
+    # а всё, что не успели принять, Telegram доставит повторно
+    if WEBHOOK_MODE == "queue":
+        await ingestor.stop(timeout=SHUTDOWN_TIMEOUT)
+    await _stop_background()
+    diagnostics.stop_watchdog()
+
+async def on_cleanup(app):
+    # aiohttp вызывает on_cleanup после того, как дождался текущих запросов (shutdown_timeout):
+    # в режиме inline обработчики ещё отвечают пользователям во время on_shutdown
+    await sender.stop()
     try:
         await bot.session.close()
     except Exception as e:
         logging.warning("Failed to close bot session: %s", e)
+    try:
+        await close_crm_session()
+    except Exception as e:
+        logging.warning("Failed to close CRM session: %s", e)
+    try:
+        await tracking.close_session()
+    except Exception as e:
+        logging.warning("Failed to close carrier session: %s", e)
+    try:
+        await dp.storage.close()
+    except Exception as e:
+        logging.warning("Failed to close FSM storage: %s", e)
+    try:
+        from redis_client import close_async
+        await close_async()
+    except Exception as e:
+        logging.warning("Failed to close Redis pool: %s", e)
 
-def main():
+def create_app() -> web.Application:
     app = web.Application()
-    SimpleRequestHandler(dispatcher=dp, bot=bot).register(app, path=WEBHOOK_PATH)
-    SimpleRequestHandler(dispatcher=dp, bot=bot).register(app, path="/")
+    for path in (WEBHOOK_PATH, "/"):
+        if WEBHOOK_MODE == "queue":
+            app.router.add_post(path, ingestor.handle)
+        else:
+            # не .register(): он закрывает сессию бота в on_shutdown, до того как дождались текущих запросов
+            app.router.add_post(path, SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=WEBHOOK_SECRET).handle)
     app.router.add_get("/healthz", health)
+    app.router.add_get("/metrics", metrics_handler)
+    diagnostics.setup_routes(app)
     setup_application(app, dp, bot=bot)
     app.on_startup.append(on_startup)
     app.on_shutdown.append(on_shutdown)
-    web.run_app(app, host="0.0.0.0", port=PORT)
+    app.on_cleanup.append(on_cleanup)
+    return app
+
+def main():
+    # на SIGTERM aiohttp перестаёт принимать соединения и ждёт текущие запросы до shutdown_timeout
+    if WORKER_SOCKET:
+        web.run_app(create_app(), path=WORKER_SOCKET, shutdown_timeout=SHUTDOWN_TIMEOUT, print=None)
+    elif workers.BOT_WORKERS > 1:
+        workers.run_front(os.path.abspath(__file__), PORT, WEBHOOK_PATH, WEBHOOK_SECRET, SHUTDOWN_TIMEOUT)
+    else:
+        web.run_app(create_app(), host="0.0.0.0", port=PORT, shutdown_timeout=SHUTDOWN_TIMEOUT)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,113 @@
+import io
+import os
+import csv
+import time
+import asyncio
+import logging
+
+import crm_limiter
+from crm_async import debug_probe
+
+# Пакетный /probe: администратор присылает файл с кодами и телефонами (CSV или по одному
+# в строке), бот проверяет их параллельно с низким приоритетом в лимитере CRM — запросы
+# пользователей идут первыми — и возвращает CSV с результатами и временем запросов.
+BULK_PROBE_CONCURRENCY = int(os.getenv("BULK_PROBE_CONCURRENCY", "8"))
+BULK_PROBE_MAX_ROWS = int(os.getenv("BULK_PROBE_MAX_ROWS", "5000"))
+BULK_PROBE_MAX_BYTES = 5 * 1024 * 1024
+BULK_PROBE_PROGRESS_INTERVAL = 3.0  # как часто обновлять сообщение с прогрессом, сек
+
+CSV_FIELDS = [
+    "input", "result", "picked", "normalized_phone", "orders_by_code", "customers", "customer_orders",
+    "customer_id", "order_id", "error", "by_code_ms", "by_phone_ms", "customer_orders_ms", "total_ms",
+]
+
+def parse_values(data: bytes) -> list[str]:
+    """Значения из файла: первая непустая ячейка каждой строки, без заголовков и повторов."""
+    try:
+        text = data.decode("utf-8-sig")
+    except UnicodeDecodeError:
+        text = data.decode("cp1251", errors="replace")
+    try:
+        dialect = csv.Sniffer().sniff(text[:4096], delimiters=",;\t")
+    except csv.Error:
+        dialect = csv.excel
+    values, seen = [], set()
+    for row in csv.reader(io.StringIO(text), dialect):
+        value = next((cell.strip() for cell in row if cell.strip()), "")
+        # строки без цифр — заголовки и комментарии, а не коды/телефоны
+        if not any(ch.isdigit() for ch in value) or value in seen:
+            continue
+        seen.add(value)
+        values.append(value)
+        if len(values) >= BULK_PROBE_MAX_ROWS:
+            break
+    return values
+
+def _row(value: str, report: dict | None, error: str = "") -> dict:
+    if report is None:
+        return {"input": value, "result": "error", "error": error}
+    by_code = report.get("by_code") or {}
+    by_phone = report.get("by_phone") or {}
+    first = by_code.get("first") or by_phone.get("first_order") or {}
+    timings = report.get("timings_ms") or {}
+    return {
+        "input": value,
+        "result": "found" if report.get("picked") else "not_found",
+        "picked": report.get("picked") or "",
+        "normalized_phone": report.get("normalized_phone") or "",
+        "orders_by_code": by_code.get("count", 0),
+        "customers": by_phone.get("customers_count", 0),
+        "customer_orders": by_phone.get("orders_count", 0),
+        "customer_id": (by_phone.get("first_customer") or {}).get("id") or "",
+        "order_id": first.get("id") or "",
+        "error": "",
+        "by_code_ms": timings.get("by_code", ""),
+        "by_phone_ms": timings.get("by_phone", ""),
+        "customer_orders_ms": timings.get("customer_orders", ""),
+        "total_ms": timings.get("total", ""),
+    }
+
+async def run(values: list[str], on_progress=None, concurrency: int = BULK_PROBE_CONCURRENCY) -> list[dict]:
+    """Проверить все значения; on_progress(done, total, found, errors) вызывается не чаще раза в интервал."""
+    rows: list = [None] * len(values)
+    counts = {"done": 0, "found": 0, "errors": 0}
+    queue = iter(enumerate(values))
+    last_progress = time.monotonic()
+
+    async def worker():
+        nonlocal last_progress
+        for i, value in queue:
+            try:
+                rows[i] = _row(value, await debug_probe(value, priority=crm_limiter.PRIORITY_BULK))
+            except Exception as e:
+                rows[i] = _row(value, None, f"{type(e).__name__}: {e}"[:200])
+            counts["done"] += 1
+            counts["found"] += rows[i]["result"] == "found"
+            counts["errors"] += rows[i]["result"] == "error"
+            if on_progress and time.monotonic() - last_progress >= BULK_PROBE_PROGRESS_INTERVAL:
+                last_progress = time.monotonic()
+                try:
+                    await on_progress(counts["done"], len(values), counts["found"], counts["errors"])
+                except Exception as e:
+                    logging.warning("Bulk probe: progress update failed: %s", e)
+
+    await asyncio.gather(*(worker() for _ in range(max(1, min(concurrency, len(values))))))
+    return rows
+
+def to_csv(rows: list[dict]) -> bytes:
+    buf = io.StringIO()
+    writer = csv.DictWriter(buf, fieldnames=CSV_FIELDS, restval="")
+    writer.writeheader()
+    writer.writerows(rows)
+    # BOM — чтобы Excel открыл кириллицу без танцев с кодировкой
+    return buf.getvalue().encode("utf-8-sig")
+
+def summary(rows: list[dict], seconds: float) -> str:
+    found = sum(r["result"] == "found" for r in rows)
+    errors = sum(r["result"] == "error" for r in rows)
+    totals = sorted(r["total_ms"] for r in rows if isinstance(r.get("total_ms"), (int, float)))
+    p50 = totals[len(totals) // 2] if totals else 0
+    p95 = totals[min(len(totals) - 1, int(len(totals) * 0.95))] if totals else 0
+    return (f"🔎 Пакетная проверка: {len(rows)} значений за {seconds:.0f} с\n"
+            f"• найдено: {found}\n• не найдено: {len(rows) - found - errors}\n• ошибок: {errors}\n"
+            f"• время на значение: p50 {p50:.0f} мс, p95 {p95:.0f} мс")
@@ -9,6 +9,7 @@ ADMIN_TELEGRAM_ID = int(os.getenv("ADMIN_TELEGRAM_ID", "0"))  # REQUIRED for sup
 WEBHOOK_URL = os.getenv("WEBHOOK_URL")  # e.g. https://your-app-name.railway.app
 PORT = int(os.getenv("PORT", "8080"))
 
+REDIS_URL = os.getenv("REDIS_URL")  # Railway выдаёт готовый URL; имеет приоритет над REDIS_HOST/PORT
 REDIS_HOST = os.getenv("REDIS_HOST", "localhost")
 REDIS_PORT = int(os.getenv("REDIS_PORT", "6379"))
 REDIS_DB = int(os.getenv("REDIS_DB", "0"))
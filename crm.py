@@ -1,8 +1,12 @@
 
 import os
 import logging
+from dataclasses import dataclass, fields
+
 import requests
 
+import crm_reference
+
 API_KEY = os.getenv("CRM_API_KEY", "pDUAhKJaZZlSXnWtSberXS6PCwfiGP4D")
 CRM_URL = os.getenv("CRM_URL", "https://valentinkalinovski.retailcrm.ru")
 BOT_CODE_FIELD = os.getenv("CRM_BOT_CODE_FIELD", "bot_code")  # можно переопределить код поля
@@ -52,10 +56,29 @@ def _normalize_phone(s: str) -> str:
         return "+7" + digits[1:]
     return digits
 
+def _phone_key(s: str) -> str:
+    """Последние 10 цифр номера — одинаковы для +7…, 8…, 7… и записи без кода страны."""
+    digits = "".join(ch for ch in (s or "") if ch.isdigit())
+    return digits[-10:] if len(digits) >= 10 else ""
+
 def _orders_by_bot_code(code: str) -> list:
     field_code = BOT_CODE_FIELD or "bot_code"
     data = crm_get("orders", {f"filter[customFields][{field_code}]": code, "limit": 20})
-    orders = data.get("orders", []) or []
+    return [OrderSnapshot.from_crm(o) for o in _filter_by_bot_code(data.get("orders", []) or [], code)]
+
+def _customers_by_phone(phone: str) -> list:
+    key = _phone_key(phone)
+    if not key:
+        return []
+    data = crm_get("customers", {"filter[phone]": key, "limit": 20})
+    return data.get("customers", []) or []
+
+def _orders_by_customer_id(customer_id: int) -> list:
+    data = crm_get("orders", {"filter[customerId]": customer_id, "limit": 20})
+    return [OrderSnapshot.from_crm(o) for o in data.get("orders", []) or []]
+
+def _filter_by_bot_code(orders: list, code: str) -> list:
+    field_code = BOT_CODE_FIELD or "bot_code"
     out = []
     for o in orders:
         cf = (o.get("customFields") or {})
@@ -63,24 +86,24 @@ def _orders_by_bot_code(code: str) -> list:
             out.append(o)
     return out
 
-def _customers_by_phone(phone: str) -> list:
-    data = crm_get("customers", {"filter[phone]": phone, "limit": 20})
-    customers = data.get("customers", []) or []
-    if customers:
-        return customers
-    data = crm_get("customers", {"filter[name]": phone, "limit": 20})
-    return data.get("customers", []) or []
+def _latest_by_code(by_code: list):
+    if not by_code:
+        return None
+    by_code.sort(key=lambda o: o.created_at or "", reverse=True)
+    return by_code[0]
 
-def _orders_by_customer_id(customer_id: int) -> list:
-    data = crm_get("orders", {"filter[customerId]": customer_id, "limit": 20})
-    return data.get("orders", []) or []
+def _latest_for_customer(orders: list, cid):
+    orders.sort(key=lambda o: o.created_at or "", reverse=True)
+    for o in orders:
+        if o.customer_id == cid:
+            return o
+    return None
 
 def pick_order_by_code_or_phone(code_or_phone: str):
     if code_or_phone:
         by_code = _orders_by_bot_code(code_or_phone)
         if by_code:
-            by_code.sort(key=lambda o: o.get("createdAt") or "", reverse=True)
-            return by_code[0]
+            return _latest_by_code(by_code)
     phone = _normalize_phone(code_or_phone)
     if phone:
         customers = _customers_by_phone(phone)
@@ -90,16 +113,12 @@ def pick_order_by_code_or_phone(code_or_phone: str):
             if cid:
                 orders = _orders_by_customer_id(cid)
                 if orders:
-                    orders.sort(key=lambda o: o.get("createdAt") or "", reverse=True)
-                    for o in orders:
-                        cust = o.get("customer") or {}
-                        if cust.get("id") == cid:
-                            return o
+                    return _latest_for_customer(orders, cid)
     return None
 
 def get_order_by_id(order_id: int):
     data = crm_get(f"orders/{order_id}", {"by": "id"})
-    return data.get("order") or {}
+    return OrderSnapshot.from_crm(data["order"]) if data.get("order") else None
 
 def save_telegram_id_for_order(order_id: int, telegram_id: int, site: str | None = None):
     payload = {"order": {"customFields": {"telegram_id": str(telegram_id)}}}
@@ -134,38 +153,124 @@ def _extract_track(o: dict) -> str | None:
             return c.strip()
     return None
 
-def get_tracking_number_text_by_id(order_id: int):
-    o = get_order_by_id(order_id)
+@dataclass(slots=True, frozen=True)
+class OrderSnapshot:
+    """Компактный снимок заказа: только поля, которые показывает бот; трек вычислен при разборе.
+
+    Сырой заказ RetailCRM (товары, оплаты, доставка) в памяти и кэшах не держим.
+    """
+    id: int
+    number: str | None = None
+    site: str | None = None
+    status: str | None = None
+    status_comment: str | None = None
+    customer_id: int | None = None
+    bot_code: str | None = None
+    track: str | None = None
+    created_at: str | None = None
+    delivery_type: str | None = None
+
+    @classmethod
+    def from_crm(cls, o: dict) -> "OrderSnapshot":
+        bot_code = (o.get("customFields") or {}).get(BOT_CODE_FIELD)
+        return cls(
+            id=int(o["id"]),
+            number=o.get("number"),
+            site=o.get("site"),
+            status=o.get("status"),
+            status_comment=o.get("statusComment"),
+            customer_id=(o.get("customer") or {}).get("id"),
+            bot_code=str(bot_code).strip() if bot_code else None,
+            track=_extract_track(o),
+            created_at=o.get("createdAt"),
+            delivery_type=((o.get("delivery") or {}).get("code")) or None,
+        )
+
+    def to_dict(self) -> dict:
+        return {f.name: getattr(self, f.name) for f in fields(self)}
+
+    @classmethod
+    def from_dict(cls, d: dict) -> "OrderSnapshot":
+        if "customFields" in d or "customer" in d:
+            # старый формат (урезанный заказ CRM), например из индекса до обновления
+            return cls.from_crm(d)
+        return cls(**d)
+
+    @property
+    def status_label(self) -> str | None:
+        # комментарий менеджера, затем название статуса из справочника CRM, затем код
+        return self.status_comment or crm_reference.status_name(self.status) or self.status
+
+    @property
+    def delivery_label(self) -> str | None:
+        return crm_reference.delivery_type_name(self.delivery_type)
+
+NO_TRACK_TEXT = "📦 Трек-номер пока не присвоен, но я дам знать, как только он появится 🤍"
+NO_ORDERS_TEXT = "📦 Пока нет активных заказов. Я всё проверила 🤍"
+
+def _tracking_text(o: OrderSnapshot | None) -> str:
     if not o:
-        return "📦 Трек-номер пока не присвоен, но я дам знать, как только он появится 🤍"
-    track_num = _extract_track(o)
-    num = o.get("number", "—")
+        return NO_TRACK_TEXT
+    track_num = o.track
+    num = o.number or "—"
     if track_num:
-        return f"🎯 Заказ #{num}\nВаш трек-номер: {track_num}\nОтследить: https://www.cdek.ru/ru/tracking?order_id={track_num}"
-    return "📦 Трек-номер пока не присвоен, но я дам знать, как только он появится 🤍"
+        delivery = f"Доставка: {o.delivery_label}\n" if o.delivery_label else ""
+        return f"🎯 Заказ #{num}\n{delivery}Ваш трек-номер: {track_num}\nОтследить: https://www.cdek.ru/ru/tracking?order_id={track_num}"
+    return NO_TRACK_TEXT
 
-def get_order_status_text_by_id(order_id: int):
-    o = get_order_by_id(order_id)
+def _status_text(o: OrderSnapshot | None) -> str:
     if not o:
-        return "📦 Пока нет активных заказов. Я всё проверила 🤍"
-    status = o.get("statusComment") or o.get("status") or "Статус не указан"
-    num = o.get("number", "—")
+        return NO_ORDERS_TEXT
+    status = o.status_label or "Статус не указан"
+    num = o.number or "—"
     return f"📦 Заказ #{num}\nСтатус: {status}"
 
-def get_orders_list_text_by_customer_id(customer_id: int):
-    if not customer_id:
-        return "📦 Пока нет активных заказов. Я всё проверила 🤍"
-    orders = _orders_by_customer_id(customer_id)
+def _orders_list_text(orders: list) -> str:
     if not orders:
-        return "📦 Пока нет активных заказов. Я всё проверила 🤍"
+        return NO_ORDERS_TEXT
     out = ["📋 Ваши заказы:"]
     for o in orders:
-        out.append(f"— #{o.get('number')} ({o.get('statusComment') or o.get('status') or 'Без статуса'})")
+        out.append(f"— #{o.number} ({o.status_label or 'Без статуса'})")
+    return "\n".join(out)
+
+ORDER_GROUP_TITLES = {"active": "📋 Активные заказы", "past": "🗂 Прошлые заказы"}
+ORDER_GROUP_EMPTY = {"active": NO_ORDERS_TEXT, "past": "🗂 Прошлых заказов пока нет 🤍"}
+
+def _order_row(o: OrderSnapshot) -> dict:
+    """Только то, что нужно для строки списка: номер, подпись статуса, дата."""
+    return {
+        "number": o.number,
+        "status": o.status_label or "Без статуса",
+        "date": (o.created_at or "")[:10],
+    }
+
+def _orders_page_text(group: str, rows: list, page: int, pages: int) -> str:
+    if not rows:
+        return ORDER_GROUP_EMPTY.get(group, NO_ORDERS_TEXT)
+    title = ORDER_GROUP_TITLES.get(group, "📋 Ваши заказы")
+    out = [f"{title} (стр. {page} из {pages}):" if pages > 1 else f"{title}:"]
+    for row in rows:
+        line = f"— #{row['number']} ({row['status']})"
+        if row.get("date"):
+            y, m, d = (row["date"].split("-") + ["", ""])[:3]
+            line += f" от {d}.{m}.{y}"
+        out.append(line)
     return "\n".join(out)
 
+def get_tracking_number_text_by_id(order_id: int):
+    return _tracking_text(get_order_by_id(order_id))
+
+def get_order_status_text_by_id(order_id: int):
+    return _status_text(get_order_by_id(order_id))
+
+def get_orders_list_text_by_customer_id(customer_id: int):
+    if not customer_id:
+        return NO_ORDERS_TEXT
+    return _orders_list_text(_orders_by_customer_id(customer_id))
+
 def save_review_by_order_id(order_id: int, review_text: str):
     o = get_order_by_id(order_id)
-    site = o.get("site")
+    site = o.site if o else None
     payload = {"order": {"customFields": {"comments": review_text}}}
     params = {"by": "id"}
     if site:
@@ -175,20 +280,13 @@ def save_review_by_order_id(order_id: int, review_text: str):
     except requests.HTTPError:
         return crm_post(f"orders/{order_id}/edit", payload, params={"by": "id"})
 
-def debug_probe(value: str) -> dict:
-    by_code = _orders_by_bot_code(value)
+def _probe_report(value: str, by_code: list, norm_phone: str, customers: list, orders_by_c: list) -> dict:
     by_code_first = None
     if by_code:
         o = by_code[0]
-        by_code_first = {
-            "id": o.get("id"),
-            "number": o.get("number"),
-            "site": o.get("site"),
-            "bot_code": ((o.get("customFields") or {}).get(BOT_CODE_FIELD)),
-        }
+        by_code_first = {"id": o.id, "number": o.number, "site": o.site, "site_name": crm_reference.site_name(o.site),
+                         "bot_code": o.bot_code}
 
-    norm_phone = _normalize_phone(value)
-    customers = _customers_by_phone(norm_phone) if norm_phone else []
     first_customer = customers[0] if customers else None
     first_c_brief = None
     if first_customer:
@@ -198,25 +296,22 @@ def debug_probe(value: str) -> dict:
             "lastName": first_customer.get("lastName"),
         }
 
-    orders_by_c = _orders_by_customer_id(first_customer.get("id")) if first_customer and first_customer.get("id") else []
     first_order = orders_by_c[0] if orders_by_c else None
     first_o_brief = None
     if first_order:
-        first_o_brief = {
-            "id": first_order.get("id"),
-            "number": first_order.get("number"),
-            "site": first_order.get("site"),
-        }
+        first_o_brief = {"id": first_order.id, "number": first_order.number, "site": first_order.site,
+                         "site_name": crm_reference.site_name(first_order.site)}
 
     picked = None
     if by_code:
-        picked = f"#{by_code[0].get('number')} (id={by_code[0].get('id')})"
+        picked = f"#{by_code[0].number} (id={by_code[0].id})"
     elif first_order:
-        picked = f"#{first_order.get('number')} (id={first_order.get('id')})"
+        picked = f"#{first_order.number} (id={first_order.id})"
 
     return {
         "input": value,
         "normalized_phone": norm_phone,
+        "phone_key": _phone_key(value),
         "by_code": {"count": len(by_code), "first": by_code_first},
         "by_phone": {
             "customers_count": len(customers),
@@ -226,3 +321,11 @@ def debug_probe(value: str) -> dict:
         },
         "picked": picked,
     }
+
+def debug_probe(value: str) -> dict:
+    by_code = _orders_by_bot_code(value)
+    norm_phone = _normalize_phone(value)
+    customers = _customers_by_phone(norm_phone) if norm_phone else []
+    first_customer = customers[0] if customers else None
+    orders_by_c = _orders_by_customer_id(first_customer.get("id")) if first_customer and first_customer.get("id") else []
+    return _probe_report(value, by_code, norm_phone, customers, orders_by_c)
@@ -0,0 +1,589 @@
+
+import os
+import re
+import time
+import asyncio
+import logging
+from collections import OrderedDict, deque
+
+import aiohttp
+
+import crm_index
+import crm_limiter
+import metrics
+import crm_writer
+import tracking
+from order_cache import SnapshotCache
+from crm import (
+    API_KEY,
+    CRM_URL,
+    _normalize_phone,
+    _phone_key,
+    _filter_by_bot_code,
+    _latest_by_code,
+    _latest_for_customer,
+    _tracking_text,
+    _status_text,
+    _orders_list_text,
+    _order_row,
+    _orders_page_text,
+    _probe_report,
+    OrderSnapshot,
+    BOT_CODE_FIELD,
+    NO_ORDERS_TEXT,
+)
+
+CRM_TIMEOUT = float(os.getenv("CRM_TIMEOUT", "20"))  # общий дедлайн одного запроса, сек
+CRM_CONNECT_TIMEOUT = float(os.getenv("CRM_CONNECT_TIMEOUT", "5"))
+CRM_POOL_LIMIT = int(os.getenv("CRM_POOL_LIMIT", "100"))
+CRM_POOL_LIMIT_PER_HOST = int(os.getenv("CRM_POOL_LIMIT_PER_HOST", "20"))
+CRM_KEEPALIVE = float(os.getenv("CRM_KEEPALIVE", "30"))
+# concurrent — код и телефон ищем параллельно; sequential — старый порядок «сначала код, потом телефон»
+CRM_AUTH_MODE = os.getenv("CRM_AUTH_MODE", "concurrent").lower()
+# дублировать чтение при входе, если CRM отвечает дольше своего p95
+CRM_HEDGE_ENABLED = os.getenv("CRM_HEDGE_ENABLED", "false").lower() == "true"
+CRM_HEDGE_MIN_SAMPLES = int(os.getenv("CRM_HEDGE_MIN_SAMPLES", "20"))
+CRM_LATENCY_WINDOW = 200
+# история заказов: группы статусов RetailCRM для filter[extendedStatus][] и размер страницы в боте
+ORDER_STATUS_GROUPS = {
+    "active": [g.strip() for g in os.getenv("ORDERS_ACTIVE_GROUPS", "new,approval,assembling,delivery").split(",") if g.strip()],
+    "past": [g.strip() for g in os.getenv("ORDERS_PAST_GROUPS", "complete,cancel").split(",") if g.strip()],
+}
+ORDERS_PAGE_SIZE = int(os.getenv("ORDERS_PAGE_SIZE", "5"))
+ORDERS_PAGE_TTL = float(os.getenv("ORDERS_PAGE_TTL", "120"))
+CRM_LIST_LIMIT = 20  # RetailCRM принимает limit 20, 50 или 100
+# ввод, по которому ничего не нашлось, какое-то время не ищем в CRM повторно
+AUTH_NEGATIVE_TTL = int(os.getenv("AUTH_NEGATIVE_TTL", "60"))
+AUTH_NEGATIVE_REDIS = os.getenv("AUTH_NEGATIVE_REDIS", "true" if os.getenv("REDIS_URL") else "false").lower() == "true"
+
+_session: aiohttp.ClientSession | None = None
+
+def _encode_orders(orders):
+    return [o.to_dict() for o in orders]
+
+def _decode_orders(raw):
+    return [OrderSnapshot.from_dict(d) for d in raw]
+
+order_cache = SnapshotCache("order", encode=lambda o: o.to_dict() if o else None,
+                            decode=lambda d: OrderSnapshot.from_dict(d) if d else None)
+customer_orders_cache = SnapshotCache("customer_orders", encode=_encode_orders, decode=_decode_orders)
+orders_page_cache = SnapshotCache("orders_page", ttl=ORDERS_PAGE_TTL)  # ключ customer:group:страница CRM, только строки списка
+
+def _get_session() -> aiohttp.ClientSession:
+    global _session
+    if _session is None or _session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=CRM_POOL_LIMIT,
+            limit_per_host=CRM_POOL_LIMIT_PER_HOST,
+            keepalive_timeout=CRM_KEEPALIVE,
+            ttl_dns_cache=300,
+        )
+        _session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=CRM_TIMEOUT, connect=CRM_CONNECT_TIMEOUT),
+        )
+    return _session
+
+async def close_session():
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
+
+def _timeout(deadline: float | None):
+    if deadline is None:
+        return None
+    return aiohttp.ClientTimeout(total=deadline, connect=min(deadline, CRM_CONNECT_TIMEOUT))
+
+async def _read_json(prefix: str, resp: aiohttp.ClientResponse):
+    if resp.status >= 400:
+        try:
+            body = await resp.json(content_type=None)
+        except Exception:
+            body = await resp.text()
+        logging.error("%s: status=%s url=%s response=%s", prefix, resp.status, resp.url, body)
+        resp.raise_for_status()
+    return await resp.json(content_type=None)
+
+def _query(params) -> list:
+    # списки раскладываем в повторяющиеся ключи: {"filter[ids][]": [1, 2]} -> filter[ids][]=1&filter[ids][]=2
+    out = []
+    for k, v in (params or {}).items():
+        if isinstance(v, (list, tuple)):
+            out.extend((k, str(x)) for x in v)
+        elif v is not None:
+            out.append((k, str(v)))
+    out.append(("apiKey", API_KEY))
+    return out
+
+def _endpoint_label(endpoint: str) -> str:
+    # orders/123/edit -> orders/{id}/edit, чтобы не плодить отдельную статистику на каждый заказ
+    return re.sub(r"/\d+(?=/|$)", "/{id}", endpoint)
+
+_latency: dict[str, deque] = {}
+
+def _record_latency(endpoint: str, seconds: float):
+    window = _latency.get(endpoint)
+    if window is None:
+        window = _latency[endpoint] = deque(maxlen=CRM_LATENCY_WINDOW)
+    window.append(seconds)
+
+def _p95(endpoint: str) -> float | None:
+    window = _latency.get(endpoint)
+    if not window or len(window) < CRM_HEDGE_MIN_SAMPLES:
+        return None
+    ordered = sorted(window)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+
+def _is_crm_failure(e: Exception) -> bool:
+    # 4xx (кроме 429) — ошибка запроса, а не недоступность CRM
+    if isinstance(e, aiohttp.ClientResponseError):
+        return e.status >= 500 or e.status == 429
+    return isinstance(e, (aiohttp.ClientError, asyncio.TimeoutError))
+
+async def _guarded(priority: int, call, on_acquired=None):
+    breaker = crm_limiter.breaker
+    try:
+        breaker.before_call()
+    except crm_limiter.CRMUnavailable:
+        metrics.CRM_REQUESTS.inc("-", "-", "breaker_open")
+        raise
+    try:
+        await crm_limiter.acquire(priority)
+        if on_acquired is not None:
+            on_acquired()
+        result = await call()
+    except asyncio.CancelledError:
+        breaker.release_trial()
+        raise
+    except crm_limiter.CRMUnavailable:
+        breaker.release_trial()
+        raise
+    except Exception as e:
+        if _is_crm_failure(e):
+            breaker.record_failure()
+        else:
+            breaker.record_success()
+        raise
+    breaker.record_success()
+    return result
+
+async def _request(method: str, endpoint, params, timeout, payload=None):
+    url = f"{CRM_URL}/api/v5/{endpoint}"
+    label = _endpoint_label(endpoint)
+    kwargs = {"params": _query(params)}
+    if timeout is not None:
+        # timeout=None в aiohttp — «без ограничения», а не «как у сессии»; без дедлайна действуют CRM_TIMEOUT/CRM_CONNECT_TIMEOUT
+        kwargs["timeout"] = _timeout(timeout)
+    if method == "POST":
+        kwargs["json"] = payload or {}
+    started = time.monotonic()
+    status = "error"
+    try:
+        async with _get_session().request(method, url, **kwargs) as r:
+            status = str(r.status)
+            data = await _read_json(f"CRM {method} failed", r)
+    except asyncio.TimeoutError:
+        status = "timeout"
+        raise
+    finally:
+        elapsed = time.monotonic() - started
+        metrics.CRM_LATENCY.observe(elapsed, method, label)
+        metrics.CRM_REQUESTS.inc(method, label, status)
+    if method == "GET":
+        _record_latency(label, elapsed)
+    return data
+
+async def _get_once(endpoint, params, timeout, priority=crm_limiter.PRIORITY_INTERACTIVE):
+    return await _guarded(priority, lambda: _request("GET", endpoint, params, timeout))
+
+async def _get_hedged(endpoint, params, timeout, priority):
+    delay = _p95(_endpoint_label(endpoint))
+    started = asyncio.Event()
+    first = asyncio.ensure_future(_guarded(priority, lambda: _request("GET", endpoint, params, timeout),
+                                           on_acquired=started.set))
+    if delay is None:
+        return await first
+    tasks = [first]
+    try:
+        # таймер p95 — с момента, когда первый запрос получил токен: ожидание в лимитере — не медленная CRM,
+        # и дубль под нагрузкой только отнял бы ещё токен
+        waiter = asyncio.ensure_future(started.wait())
+        try:
+            await asyncio.wait({first, waiter}, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            waiter.cancel()
+        done, _ = await asyncio.wait(tasks, timeout=delay)
+        if not done:
+            logging.info("CRM GET %s slower than p95 (%.2fs), hedging", endpoint, delay)
+            tasks.append(asyncio.ensure_future(_get_once(endpoint, params, timeout, priority)))
+        pending = set(tasks)
+        error = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            ok = [t for t in done if t.exception() is None]
+            if ok:
+                return ok[0].result()
+            error = error or next(iter(done)).exception()
+        raise error
+    finally:
+        for t in tasks:
+            t.cancel()
+
+async def crm_get(endpoint, params=None, timeout: float | None = None, hedge: bool = False,
+                  priority: int = crm_limiter.PRIORITY_INTERACTIVE):
+    if hedge and CRM_HEDGE_ENABLED:
+        return await _get_hedged(endpoint, params, timeout, priority)
+    return await _get_once(endpoint, params, timeout, priority)
+
+async def crm_post(endpoint, payload=None, params=None, timeout: float | None = None,
+                   priority: int = crm_limiter.PRIORITY_INTERACTIVE):
+    return await _guarded(priority, lambda: _request("POST", endpoint, params, timeout, payload))
+
+async def _orders_by_bot_code(code: str, priority: int = crm_limiter.PRIORITY_INTERACTIVE) -> list:
+    field_code = BOT_CODE_FIELD or "bot_code"
+    data = await crm_get("orders", {f"filter[customFields][{field_code}]": code, "limit": 20},
+                         hedge=priority < crm_limiter.PRIORITY_BULK, priority=priority)
+    return [OrderSnapshot.from_crm(o) for o in _filter_by_bot_code(data.get("orders", []) or [], code)]
+
+async def _customers_by_filter(name: str, value: str, priority: int = crm_limiter.PRIORITY_INTERACTIVE) -> list:
+    data = await crm_get("customers", {f"filter[{name}]": value, "limit": 20},
+                         hedge=priority < crm_limiter.PRIORITY_BULK, priority=priority)
+    return data.get("customers", []) or []
+
+async def _customers_by_phone(phone: str, priority: int = crm_limiter.PRIORITY_INTERACTIVE) -> list:
+    key = _phone_key(phone)
+    if not key:
+        return []
+    # RetailCRM сравнивает телефон по цифрам, поэтому 10 цифр без кода страны
+    # одним запросом находят и +7…, и 8…, и 7…
+    return await _customers_by_filter("phone", key, priority)
+
+async def _fetch_orders_by_customer_id(customer_id: int, priority: int = crm_limiter.PRIORITY_INTERACTIVE) -> list:
+    data = await crm_get("orders", {"filter[customerId]": customer_id, "limit": 20},
+                         hedge=priority < crm_limiter.PRIORITY_BULK, priority=priority)
+    return [OrderSnapshot.from_crm(o) for o in data.get("orders", []) or []]
+
+async def _orders_by_customer_id(customer_id: int, fresh: bool = False) -> list:
+    if fresh:
+        orders = await _fetch_orders_by_customer_id(customer_id)
+        await customer_orders_cache.put(customer_id, orders)
+        return orders
+    return await customer_orders_cache.get(customer_id, lambda: _fetch_orders_by_customer_id(customer_id))
+
+async def _pick_from_index(code_or_phone: str):
+    if code_or_phone:
+        order = await crm_index.lookup_code(code_or_phone)
+        if order:
+            return order
+    cid = await crm_index.lookup_customer_by_phone(_normalize_phone(code_or_phone))
+    if cid:
+        orders = await crm_index.lookup_customer_orders(cid)
+        if orders:
+            return _latest_for_customer(orders, cid)
+    return None
+
+def _looks_like_phone(value: str) -> bool:
+    value = (value or "").strip()
+    digits = sum(ch.isdigit() for ch in value)
+    return digits >= 10 and all(ch.isdigit() or ch in "+-() " for ch in value)
+
+async def _pick_by_code(code: str):
+    by_code = await _orders_by_bot_code(code)
+    return _latest_by_code(by_code) if by_code else None
+
+async def _pick_by_phone(phone: str):
+    customers = await _customers_by_phone(phone)
+    if customers:
+        cid = customers[0].get("id")
+        if cid:
+            # при входе нужен самый свежий список — новый заказ мог появиться только что
+            orders = await _orders_by_customer_id(cid, fresh=True)
+            if orders:
+                return _latest_for_customer(list(orders), cid)
+    return None
+
+async def _first_found(*coros):
+    """Запустить поиски параллельно и вернуть непустой результат первого по порядку, отменив остальные.
+
+    Порядок аргументов — приоритет: результат следующего поиска берём, только когда все
+    предыдущие закончились ничем (bot_code важнее телефона, кто бы ни ответил первым).
+    Если ничего не нашлось, а какой-то из поисков упал — пробрасываем ошибку,
+    чтобы пользователь увидел «нет связи с CRM», а не «заказ не найден».
+    """
+    tasks = [asyncio.ensure_future(c) for c in coros]
+    try:
+        while True:
+            for t in tasks:
+                if not t.done():
+                    break
+                if t.exception() is None and t.result():
+                    return t.result()
+            else:
+                error = next((t.exception() for t in tasks if t.exception() is not None), None)
+                if error is not None:
+                    raise error
+                return None
+            await asyncio.wait([t for t in tasks if not t.done()], return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for t in tasks:
+            t.cancel()
+
+_auth_misses: OrderedDict = OrderedDict()  # локальный негативный кэш, если Redis не используется
+_auth_miss_counters = {"hits": 0, "stored": 0, "invalidated": 0}
+
+def _miss_keys(code_or_phone: str) -> list:
+    value = (code_or_phone or "").strip()
+    if not value:
+        return []
+    phone_key = _phone_key(value)
+    if phone_key and _looks_like_phone(value):
+        # +7…, 8… и 10 цифр — один и тот же ввод
+        return [f"phone:{phone_key}"]
+    keys = [f"code:{value}"]
+    if phone_key:
+        keys.append(f"phone:{phone_key}")
+    return keys
+
+async def _is_known_miss(keys: list) -> bool:
+    if AUTH_NEGATIVE_REDIS:
+        from redis_client import ar
+        try:
+            return await ar.exists(*(f"auth:miss:{k}" for k in keys)) == len(keys)
+        except Exception as e:
+            logging.warning("Auth negative cache: redis unavailable: %s", e)
+            return False
+    now = time.monotonic()
+    return all(_auth_misses.get(k, 0) > now for k in keys)
+
+async def _remember_miss(keys: list):
+    if AUTH_NEGATIVE_REDIS:
+        from redis_client import ar
+        try:
+            async with ar.pipeline(transaction=False) as pipe:
+                for k in keys:
+                    pipe.set(f"auth:miss:{k}", "1", ex=AUTH_NEGATIVE_TTL)
+                await pipe.execute()
+        except Exception as e:
+            logging.warning("Auth negative cache: redis unavailable: %s", e)
+            return
+    else:
+        expires = time.monotonic() + AUTH_NEGATIVE_TTL
+        for k in keys:
+            _auth_misses[k] = expires
+            _auth_misses.move_to_end(k)
+        while len(_auth_misses) > 10000:
+            _auth_misses.popitem(last=False)
+    _auth_miss_counters["stored"] += 1
+
+async def forget_auth_misses(codes=(), phones=()):
+    """Появился заказ или клиент с этими кодами/телефонами (ключ телефона — последние 10 цифр)."""
+    keys = [f"code:{c}" for c in codes] + [f"phone:{p}" for p in phones]
+    if not keys:
+        return
+    if AUTH_NEGATIVE_REDIS:
+        from redis_client import ar
+        try:
+            for i in range(0, len(keys), 500):
+                _auth_miss_counters["invalidated"] += await ar.delete(*(f"auth:miss:{k}" for k in keys[i:i + 500]))
+        except Exception as e:
+            logging.warning("Auth negative cache: redis unavailable: %s", e)
+        return
+    for k in keys:
+        if _auth_misses.pop(k, None) is not None:
+            _auth_miss_counters["invalidated"] += 1
+
+async def pick_order_by_code_or_phone(code_or_phone: str):
+    keys = _miss_keys(code_or_phone)
+    if keys and await _is_known_miss(keys):
+        _auth_miss_counters["hits"] += 1
+        return None
+    order = await _pick_order(code_or_phone)
+    if order is None and keys:
+        await _remember_miss(keys)
+    return order
+
+async def _pick_order(code_or_phone: str):
+    if crm_index.CRM_INDEX_ENABLED:
+        try:
+            order = await _pick_from_index(code_or_phone)
+        except Exception as e:
+            logging.warning("Index lookup failed, falling back to CRM: %s", e)
+            order = None
+        if order:
+            return order
+    phone = _normalize_phone(code_or_phone)
+    if CRM_AUTH_MODE == "concurrent" and code_or_phone and phone and _looks_like_phone(code_or_phone):
+        return await _first_found(_pick_by_code(code_or_phone), _pick_by_phone(phone))
+    if code_or_phone:
+        order = await _pick_by_code(code_or_phone)
+        if order:
+            return order
+    if phone:
+        return await _pick_by_phone(phone)
+    return None
+
+async def _fetch_order_by_id(order_id: int) -> OrderSnapshot | None:
+    data = await crm_get(f"orders/{order_id}", {"by": "id"})
+    return OrderSnapshot.from_crm(data["order"]) if data.get("order") else None
+
+async def get_order_by_id(order_id: int) -> OrderSnapshot | None:
+    return await order_cache.get(int(order_id), lambda: _fetch_order_by_id(order_id))
+
+async def get_by_ids(kind: str, ids: list, priority: int = crm_limiter.PRIORITY_BULK, page: int = 100) -> list:
+    """Загрузить заказы или клиентов (kind = orders/customers) по списку id, пачками по page."""
+    out = []
+    for i in range(0, len(ids), page):
+        chunk = ids[i:i + page]
+        data = await crm_get(kind, {"filter[ids][]": chunk, "limit": page}, priority=priority)
+        out.extend(data.get(kind, []) or [])
+    return out
+
+def _changes_snapshot(payload: dict) -> bool:
+    """Меняет ли правка поля, которые хранит OrderSnapshot (из customFields — только bot_code)."""
+    order = payload.get("order") or {}
+    return bool(set(order) - {"customFields"}) or BOT_CODE_FIELD in (order.get("customFields") or {})
+
+async def _edit_order(order_id: int, payload: dict, site: str | None,
+                      priority: int = crm_limiter.PRIORITY_INTERACTIVE):
+    params = {"by": "id"}
+    if site:
+        params["site"] = site
+    try:
+        try:
+            return await crm_post(f"orders/{order_id}/edit", payload, params=params, priority=priority)
+        except aiohttp.ClientResponseError:
+            if site:
+                return await crm_post(f"orders/{order_id}/edit", payload, params={"by": "id"}, priority=priority)
+            raise
+    finally:
+        # telegram_id, rating, comments в снимке нет — прогретый при входе заказ остаётся в кэше
+        if _changes_snapshot(payload):
+            await order_cache.invalidate(int(order_id))
+
+async def _save_custom_fields(order_id: int, fields: dict, site: str | None = None, resolve_site: bool = False):
+    if crm_writer.CRM_WRITE_QUEUE:
+        try:
+            await crm_writer.enqueue_custom_fields(order_id, fields, site=site)
+            return None
+        except Exception as e:
+            logging.warning("CRM write queue unavailable, writing directly: %s", e)
+    if site is None and resolve_site:
+        o = await get_order_by_id(order_id)
+        site = o.site if o else None
+    return await _edit_order(order_id, {"order": {"customFields": fields}}, site)
+
+async def save_telegram_id_for_order(order_id: int, telegram_id: int, site: str | None = None):
+    return await _save_custom_fields(order_id, {"telegram_id": str(telegram_id)}, site=site)
+
+async def save_review_by_order_id(order_id: int, review_text: str):
+    return await _save_custom_fields(order_id, {"comments": review_text}, resolve_site=True)
+
+async def get_tracking_number_text_by_id(order_id: int):
+    order = await get_order_by_id(order_id)
+    text = _tracking_text(order)
+    if order and order.track and tracking.TRACKING_ENABLED:
+        checkpoint = tracking.checkpoint_text(await tracking.latest(order.track, order.delivery_type))
+        if checkpoint:
+            text += f"\n\nПоследний статус посылки:\n{checkpoint}"
+    return text
+
+async def prefetch_order(order_id: int):
+    """Прогреть кэш заказа и статуса посылки сразу после входа — первое нажатие кнопки отвечает из памяти."""
+    order = await get_order_by_id(order_id)
+    if order and order.track and tracking.TRACKING_ENABLED:
+        await tracking.latest(order.track, order.delivery_type)
+
+async def get_order_status_text_by_id(order_id: int):
+    return _status_text(await get_order_by_id(order_id))
+
+async def get_orders_list_text_by_customer_id(customer_id: int):
+    if not customer_id:
+        return NO_ORDERS_TEXT
+    return _orders_list_text(await _orders_by_customer_id(customer_id))
+
+async def _fetch_orders_chunk(customer_id: int, group: str, crm_page: int) -> dict:
+    data = await crm_get("orders", {
+        "filter[customerId]": customer_id,
+        "filter[extendedStatus][]": ORDER_STATUS_GROUPS[group],
+        "limit": CRM_LIST_LIMIT,
+        "page": crm_page,
+    })
+    orders = data.get("orders", []) or []
+    total = (data.get("pagination") or {}).get("totalCount")
+    return {"rows": [_order_row(OrderSnapshot.from_crm(o)) for o in orders], "total": total if total is not None else len(orders)}
+
+async def get_orders_page(customer_id: int, group: str, page: int = 1) -> dict:
+    """Страница истории заказов клиента по группе статусов (active/past).
+
+    Страницы CRM кэшируются по клиенту, поэтому листание вперёд-назад не ходит в CRM повторно.
+    """
+    if group not in ORDER_STATUS_GROUPS:
+        raise ValueError(f"unknown order group: {group}")
+    page = max(1, page)
+    start = (page - 1) * ORDERS_PAGE_SIZE
+    end = start + ORDERS_PAGE_SIZE
+    first, last = start // CRM_LIST_LIMIT + 1, (end - 1) // CRM_LIST_LIMIT + 1
+    chunks = await asyncio.gather(*(
+        orders_page_cache.get(f"{customer_id}:{group}:{n}", lambda n=n: _fetch_orders_chunk(customer_id, group, n))
+        for n in range(first, last + 1)
+    ))
+    total = chunks[0]["total"]
+    pages = max(1, -(-total // ORDERS_PAGE_SIZE))
+    if page > pages:
+        # заказов стало меньше, пока пользователь листал — показываем последнюю страницу
+        return await get_orders_page(customer_id, group, pages)
+    offset = (first - 1) * CRM_LIST_LIMIT
+    rows = [row for chunk in chunks for row in chunk["rows"]][start - offset:end - offset]
+    return {"group": group, "page": page, "pages": pages, "total": total, "rows": rows}
+
+async def get_orders_page_text(customer_id: int, group: str, page: int = 1) -> tuple[str, int, int]:
+    """Текст страницы истории заказов и (номер страницы, всего страниц) для клавиатуры."""
+    data = await get_orders_page(customer_id, group, page)
+    return _orders_page_text(group, data["rows"], data["page"], data["pages"]), data["page"], data["pages"]
+
+async def debug_probe(value: str, priority: int = crm_limiter.PRIORITY_INTERACTIVE) -> dict:
+    """Диагностика ввода для /probe; в отчёте — время каждого запроса к CRM (timings_ms)."""
+    timings = {}
+    started = time.monotonic()
+
+    async def timed(name, coro):
+        t = time.monotonic()
+        try:
+            return await coro
+        finally:
+            timings[name] = round((time.monotonic() - t) * 1000, 1)
+
+    norm_phone = _normalize_phone(value)
+    # код и телефон проверяем параллельно — это независимые запросы
+    by_code, customers = await asyncio.gather(
+        timed("by_code", _orders_by_bot_code(value, priority)),
+        timed("by_phone", _customers_by_phone(norm_phone, priority)) if norm_phone else asyncio.sleep(0, result=[]),
+    )
+    first_customer = customers[0] if customers else None
+    orders_by_c = []
+    if first_customer and first_customer.get("id"):
+        orders_by_c = await timed("customer_orders", _fetch_orders_by_customer_id(first_customer.get("id"), priority))
+        await customer_orders_cache.put(first_customer.get("id"), orders_by_c)
+    report = _probe_report(value, by_code, norm_phone, customers, orders_by_c)
+    timings["total"] = round((time.monotonic() - started) * 1000, 1)
+    report["timings_ms"] = timings
+    return report
+
+def cache_stats() -> dict:
+    return {"order": order_cache.stats(), "customer_orders": customer_orders_cache.stats(),
+            "orders_page": orders_page_cache.stats(), "auth_misses": dict(_auth_miss_counters)}
+
+async def check_reachable() -> dict:
+    started = time.monotonic()
+    try:
+        # интерактивный приоритет: ожидание лимитера ограничено CRM_RATE_MAX_WAIT, у фоновых оно бесконечно
+        await crm_get("reference/sites", timeout=5, priority=crm_limiter.PRIORITY_INTERACTIVE)
+        return {"ok": True, "latency_ms": round((time.monotonic() - started) * 1000, 1)}
+    except crm_limiter.CRMUnavailable as e:
+        if crm_limiter.breaker.state == "closed":
+            # CRM отвечает, просто исчерпан лимит запросов — перезапуск реплики тут не поможет
+            return {"ok": True, "degraded": True, "error": str(e)[:200]}
+        return {"ok": False, "error": f"{type(e).__name__}: {e}"[:200]}
+    except Exception as e:
+        return {"ok": False, "error": f"{type(e).__name__}: {e}"[:200]}
@@ -0,0 +1,214 @@
+import os
+import sys
+import json
+import time
+import asyncio
+import logging
+from datetime import datetime
+
+import crm_async
+import crm_limiter
+from crm import BOT_CODE_FIELD, OrderSnapshot, _phone_key
+
+CRM_INDEX_ENABLED = os.getenv("CRM_INDEX_ENABLED", "false").lower() == "true"
+CRM_INDEX_INTERVAL = float(os.getenv("CRM_INDEX_INTERVAL", "30"))  # пауза между проходами по истории, сек
+CRM_INDEX_PAGE = 100  # максимальный limit, который принимает RetailCRM
+CRM_INDEX_CUSTOMER_ORDERS = 20  # сколько последних заказов клиента держим в индексе
+
+K_CODE = "idx:code"              # bot_code -> снимок заказа (OrderSnapshot, json)
+K_PHONE = "idx:phone"            # последние 10 цифр телефона -> customer id
+K_CUST_ORDERS = "idx:cust_orders"  # customer id -> последние заказы (json-список)
+K_META = "idx:meta"              # курсоры sinceId, время последней синхронизации и т.д.
+K_LOCK = "idx:lock"
+
+def _redis():
+    from redis_client import ar
+    return ar
+
+def _brief_order(o: dict) -> dict:
+    return OrderSnapshot.from_crm(o).to_dict()
+
+def _customer_phones(c: dict) -> list:
+    return [p.get("number") for p in (c.get("phones") or []) if (p or {}).get("number")]
+
+# ---------- запись в индекс ----------
+
+async def index_orders(orders: list):
+    if not orders:
+        return
+    r = _redis()
+    by_customer: dict = {}
+    codes, phones = set(), set()
+    async with r.pipeline(transaction=False) as pipe:
+        for o in orders:
+            brief = _brief_order(o)
+            code = str((o.get("customFields") or {}).get(BOT_CODE_FIELD) or "").strip()
+            if code:
+                codes.add(code)
+                pipe.hset(K_CODE, code, json.dumps(brief, ensure_ascii=False, separators=(",", ":")))
+            cust = o.get("customer") or {}
+            cid = cust.get("id")
+            if cid:
+                by_customer.setdefault(str(cid), []).append(brief)
+                for phone in _customer_phones(cust) + [o.get("phone")]:
+                    key = _phone_key(phone)
+                    if key:
+                        phones.add(key)
+                        pipe.hset(K_PHONE, key, str(cid))
+        await pipe.execute()
+    # по этим кодам и телефонам теперь есть заказ — забываем прежние «не найдено»
+    await crm_async.forget_auth_misses(codes, phones)
+
+    if not by_customer:
+        return
+    cids = list(by_customer)
+    current = await r.hmget(K_CUST_ORDERS, cids)
+    merged = {}
+    for cid, raw in zip(cids, current):
+        known = {o["id"]: o for o in (OrderSnapshot.from_dict(d).to_dict() for d in (json.loads(raw) if raw else []))}
+        for o in by_customer[cid]:
+            known[o["id"]] = o
+        recent = sorted(known.values(), key=lambda o: o.get("created_at") or "", reverse=True)
+        merged[cid] = json.dumps(recent[:CRM_INDEX_CUSTOMER_ORDERS], ensure_ascii=False, separators=(",", ":"))
+    await r.hset(K_CUST_ORDERS, mapping=merged)
+
+async def index_customers(customers: list):
+    mapping = {}
+    for c in customers or []:
+        cid = c.get("id")
+        if not cid:
+            continue
+        for phone in _customer_phones(c):
+            key = _phone_key(phone)
+            if key:
+                mapping[key] = str(cid)
+    if mapping:
+        await _redis().hset(K_PHONE, mapping=mapping)
+        await crm_async.forget_auth_misses(phones=mapping)
+
+# ---------- чтение ----------
+
+async def lookup_code(code: str):
+    raw = await _redis().hget(K_CODE, str(code).strip())
+    return OrderSnapshot.from_dict(json.loads(raw)) if raw else None
+
+async def lookup_customer_by_phone(phone: str):
+    key = _phone_key(phone)
+    if not key:
+        return None
+    cid = await _redis().hget(K_PHONE, key)
+    return int(cid) if cid else None
+
+async def lookup_customer_orders(customer_id) -> list:
+    raw = await _redis().hget(K_CUST_ORDERS, str(customer_id))
+    return [OrderSnapshot.from_dict(d) for d in json.loads(raw)] if raw else []
+
+async def index_lag() -> dict:
+    meta = await _redis().hgetall(K_META)
+    now = time.time()
+    synced_at = float(meta["synced_at"]) if meta.get("synced_at") else None
+    out = {
+        "enabled": CRM_INDEX_ENABLED,
+        "backfilled": meta.get("backfilled") == "1",
+        "orders_since_id": meta.get("orders_since_id"),
+        "customers_since_id": meta.get("customers_since_id"),
+        "last_change_at": meta.get("last_change_at"),
+        "seconds_since_sync": round(now - synced_at, 1) if synced_at else None,
+    }
+    # возраст последнего применённого изменения CRM: если в CRM идёт работа, а число растёт — индекс отстаёт
+    if meta.get("last_change_at"):
+        try:
+            seen = datetime.strptime(meta["last_change_at"], "%Y-%m-%d %H:%M:%S").timestamp()
+            out["seconds_since_last_change"] = round(max(0.0, now - seen), 1)
+        except ValueError:
+            pass
+    return out
+
+# ---------- синхронизация ----------
+
+async def backfill():
+    """Полная загрузка индекса постранично: все заказы и клиенты."""
+    r = _redis()
+    started = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    for kind, index in (("orders", index_orders), ("customers", index_customers)):
+        page, total_pages = 1, 1
+        while page <= total_pages:
+            data = await crm_async.crm_get(kind, {"limit": CRM_INDEX_PAGE, "page": page},
+                                            priority=crm_limiter.PRIORITY_BULK)
+            await index(data.get(kind, []) or [])
+            total_pages = ((data.get("pagination") or {}).get("totalPageCount")) or 1
+            logging.info("Index backfill %s: page %s/%s", kind, page, total_pages)
+            page += 1
+    # история за время backfill подхватится инкрементальной синхронизацией с этой даты
+    await r.hset(K_META, mapping={"backfilled": "1", "history_start": started, "synced_at": str(time.time())})
+
+async def sync_history(kind: str) -> int:
+    """Пройти по {kind}/history от сохранённого sinceId; вернуть число обработанных записей."""
+    r = _redis()
+    entity = kind[:-1]  # orders -> order, customers -> customer
+    cursor_field = f"{kind}_since_id"
+    processed = 0
+    while True:
+        meta = await r.hmget(K_META, cursor_field, "history_start")
+        since_id, history_start = meta
+        params = {"limit": CRM_INDEX_PAGE}
+        if since_id:
+            params["filter[sinceId]"] = since_id
+        elif history_start:
+            params["filter[startDate]"] = history_start
+        data = await crm_async.crm_get(f"{kind}/history", params, priority=crm_limiter.PRIORITY_BULK)
+        history = data.get("history", []) or []
+        if not history:
+            break
+        ids = sorted({(h.get(entity) or {}).get("id") for h in history} - {None})
+        entities = await crm_async.get_by_ids(kind, ids, page=CRM_INDEX_PAGE)
+        if kind == "orders":
+            await index_orders(entities)
+        else:
+            await index_customers(entities)
+        last = history[-1]
+        mapping = {cursor_field: str(last.get("id"))}
+        if last.get("createdAt"):
+            mapping["last_change_at"] = last["createdAt"]
+        await r.hset(K_META, mapping=mapping)
+        processed += len(history)
+        if len(history) < CRM_INDEX_PAGE:
+            break
+    return processed
+
+async def run_sync_worker(interval: float = CRM_INDEX_INTERVAL):
+    from redis_client import singleton_lock
+    r = _redis()
+    while True:
+        try:
+            # один синхронизатор на все реплики; лок продлевается, пока идёт долгий backfill
+            async with singleton_lock(K_LOCK) as acquired:
+                if acquired:
+                    if await r.hget(K_META, "backfilled") != "1":
+                        await backfill()
+                    changed = await sync_history("orders") + await sync_history("customers")
+                    await r.hset(K_META, "synced_at", str(time.time()))
+                    if changed:
+                        logging.info("Index sync: %s history entries applied", changed)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logging.exception("Index sync failed")
+        await asyncio.sleep(interval)
+
+if __name__ == "__main__":
+    # python crm_index.py backfill — разовая полная загрузка индекса
+    # python crm_index.py lag      — показать отставание индекса
+    import log_setup
+    log_setup.setup()
+    cmd = sys.argv[1] if len(sys.argv) > 1 else "lag"
+
+    async def _cli():
+        try:
+            if cmd == "backfill":
+                await backfill()
+            print(json.dumps(await index_lag(), ensure_ascii=False, indent=2))
+        finally:
+            await crm_async.close_session()
+
+    asyncio.run(_cli())
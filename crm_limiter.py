@@ -0,0 +1,144 @@
+import os
+import time
+import asyncio
+import logging
+
+# Ограничение частоты запросов к RetailCRM (token bucket) и circuit breaker.
+# Bucket общий для всех процессов/реплик через Redis; если Redis недоступен —
+# работаем по локальному bucket, поделив лимит на CRM_RATE_REPLICAS и число процессов-воркеров.
+CRM_RATE_LIMIT = float(os.getenv("CRM_RATE_LIMIT", "10"))  # запросов в секунду на apiKey
+CRM_RATE_BURST = float(os.getenv("CRM_RATE_BURST", "10"))
+CRM_RATE_BULK_RESERVE = float(os.getenv("CRM_RATE_BULK_RESERVE", "0.3"))  # доля bucket, недоступная фоновым задачам
+CRM_RATE_REDIS = os.getenv("CRM_RATE_REDIS", "true" if os.getenv("REDIS_URL") else "false").lower() == "true"
+CRM_RATE_REPLICAS = max(1, int(os.getenv("CRM_RATE_REPLICAS", "1")))
+CRM_RATE_MAX_WAIT = float(os.getenv("CRM_RATE_MAX_WAIT", "10"))
+CRM_BREAKER_THRESHOLD = int(os.getenv("CRM_BREAKER_THRESHOLD", "5"))  # подряд ошибок до размыкания
+CRM_BREAKER_COOLDOWN = float(os.getenv("CRM_BREAKER_COOLDOWN", "30"))  # сколько секунд не ходим в CRM после размыкания
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BULK = 1
+
+BUCKET_KEY = "crm:ratelimit"
+
+class CRMUnavailable(Exception):
+    pass
+
+# KEYS[1] — bucket; ARGV: rate, burst, now (сек), cost, min_left
+# Возвращает 0, если токен выдан, иначе сколько миллисекунд подождать.
+_TAKE_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local cost = tonumber(ARGV[4])
+local min_left = tonumber(ARGV[5])
+local state = redis.call('HMGET', KEYS[1], 't', 'ts')
+local tokens = tonumber(state[1]) or burst
+local ts = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+local wait = 0
+if tokens - cost >= min_left then
+  tokens = tokens - cost
+else
+  wait = math.ceil((cost + min_left - tokens) / rate * 1000)
+end
+redis.call('HSET', KEYS[1], 't', tokens, 'ts', now)
+redis.call('PEXPIRE', KEYS[1], math.ceil(burst / rate * 1000) + 1000)
+return wait
+"""
+
+class _LocalBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.ts = time.monotonic()
+
+    def take(self, cost: float, min_left: float) -> float:
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.ts) * self.rate)
+        self.ts = now
+        if self.tokens - cost >= min_left:
+            self.tokens -= cost
+            return 0.0
+        return (cost + min_left - self.tokens) / self.rate
+
+# без Redis каждый процесс-воркер (BOT_WORKERS, workers.py) держит свой bucket — делим лимит и на них
+_LOCAL_SHARE = CRM_RATE_REPLICAS * max(1, int(os.getenv("BOT_WORKERS", "1")))
+_local = _LocalBucket(CRM_RATE_LIMIT / _LOCAL_SHARE, max(1.0, CRM_RATE_BURST / _LOCAL_SHARE))
+_script = None
+
+async def _take_shared(cost: float, min_left: float) -> float:
+    global _script
+    from redis_client import ar
+    if _script is None:
+        _script = ar.register_script(_TAKE_SCRIPT)
+    wait_ms = await _script(keys=[BUCKET_KEY], args=[CRM_RATE_LIMIT, CRM_RATE_BURST, time.time(), cost, min_left])
+    return int(wait_ms) / 1000.0
+
+async def acquire(priority: int = PRIORITY_INTERACTIVE, cost: float = 1.0):
+    """Дождаться права на запрос к CRM. Фоновые задачи не трогают резерв интерактивных."""
+    min_left = CRM_RATE_BURST * CRM_RATE_BULK_RESERVE if priority >= PRIORITY_BULK else 0.0
+    # резерв локального bucket — от его собственного размера, и так, чтобы фоновым вообще что-то оставалось
+    local_min_left = max(0.0, min(_local.burst * CRM_RATE_BULK_RESERVE, _local.burst - cost)) if min_left else 0.0
+    deadline = time.monotonic() + (CRM_RATE_MAX_WAIT if priority < PRIORITY_BULK else float("inf"))
+    while True:
+        if CRM_RATE_REDIS:
+            try:
+                wait = await _take_shared(cost, min_left)
+            except Exception as e:
+                logging.warning("Shared CRM rate limiter unavailable, using local bucket: %s", e)
+                wait = _local.take(cost, local_min_left)
+        else:
+            wait = _local.take(cost, local_min_left)
+        if wait <= 0:
+            return
+        if time.monotonic() + wait > deadline:
+            raise CRMUnavailable("CRM rate limit: wait exceeds deadline")
+        await asyncio.sleep(wait)
+
+class CircuitBreaker:
+    def __init__(self, threshold: int = CRM_BREAKER_THRESHOLD, cooldown: float = CRM_BREAKER_COOLDOWN):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at: float | None = None
+        self._trial = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.cooldown:
+            return "half_open"
+        return "open"
+
+    def before_call(self):
+        state = self.state
+        if state == "open":
+            raise CRMUnavailable("CRM circuit breaker is open")
+        if state == "half_open":
+            # после паузы пропускаем один пробный запрос, остальные пока отбиваем
+            if self._trial:
+                raise CRMUnavailable("CRM circuit breaker is half-open")
+            self._trial = True
+
+    def release_trial(self):
+        # пробный запрос отменили, не дождавшись ответа — следующий может попробовать снова
+        self._trial = False
+
+    def record_success(self):
+        if self.opened_at is not None:
+            logging.info("CRM circuit breaker closed")
+        self.failures = 0
+        self.opened_at = None
+        self._trial = False
+
+    def record_failure(self):
+        self.failures += 1
+        self._trial = False
+        if self.opened_at is not None or self.failures >= self.threshold:
+            if self.state != "open":
+                logging.warning("CRM circuit breaker opened after %s consecutive failures", self.failures)
+            self.opened_at = time.monotonic()
+
+breaker = CircuitBreaker()
@@ -0,0 +1,116 @@
+import os
+import json
+import time
+import asyncio
+import logging
+from types import MappingProxyType
+
+# Справочники RetailCRM: названия статусов, типов доставки и магазинов. Загружаются один раз
+# и обновляются в фоне; в памяти лежат неизменяемые словари, которые целиком подменяются
+# при обновлении, поэтому обработчики читают их без блокировок. Копия хранится в Redis —
+# новый процесс стартует с готовыми названиями и не идёт за ними в CRM.
+CRM_REFERENCE_REFRESH = float(os.getenv("CRM_REFERENCE_REFRESH", "3600"))  # как часто перечитывать, сек
+CRM_REFERENCE_REDIS = os.getenv("CRM_REFERENCE_REDIS", "true" if os.getenv("REDIS_URL") else "false").lower() == "true"
+REDIS_KEY = "crm:reference"
+REDIS_TTL = 7 * 24 * 3600
+
+# справочник -> (эндпоинт RetailCRM, ключ в ответе)
+DICTIONARIES = {
+    "statuses": ("reference/statuses", "statuses"),
+    "delivery_types": ("reference/delivery-types", "deliveryTypes"),
+    "sites": ("reference/sites", "sites"),
+}
+
+_EMPTY = MappingProxyType({})
+_data = MappingProxyType({name: _EMPTY for name in DICTIONARIES})
+_meta = {"loaded_at": 0.0, "source": None, "refreshes": 0, "errors": 0}
+
+def _names(items) -> dict:
+    """{code: name} из ответа справочника (RetailCRM отдаёт объект по кодам, иногда — список)."""
+    if isinstance(items, dict):
+        items = items.values()
+    return {i["code"]: i.get("name") or i["code"] for i in items or [] if isinstance(i, dict) and i.get("code")}
+
+def _install(data: dict, loaded_at: float, source: str):
+    global _data
+    _data = MappingProxyType({name: MappingProxyType(dict(data.get(name) or {})) for name in DICTIONARIES})
+    _meta.update(loaded_at=loaded_at, source=source)
+
+def status_name(code: str | None) -> str | None:
+    return _data["statuses"].get(code) if code else None
+
+def delivery_type_name(code: str | None) -> str | None:
+    return _data["delivery_types"].get(code) if code else None
+
+def site_name(code: str | None) -> str | None:
+    return _data["sites"].get(code) if code else None
+
+def stats() -> dict:
+    return {
+        **{name: len(values) for name, values in _data.items()},
+        "age_seconds": round(time.time() - _meta["loaded_at"], 1) if _meta["loaded_at"] else None,
+        "source": _meta["source"],
+        "refreshes": _meta["refreshes"],
+        "errors": _meta["errors"],
+    }
+
+def _redis():
+    from redis_client import ar
+    return ar
+
+async def _load_from_redis() -> dict | None:
+    try:
+        raw = await _redis().get(REDIS_KEY)
+        return json.loads(raw) if raw else None
+    except Exception as e:
+        logging.warning("Reference: failed to read Redis copy: %s", e)
+        return None
+
+async def _fetch_from_crm() -> dict:
+    import crm_async
+    import crm_limiter
+
+    async def fetch(endpoint, key):
+        data = await crm_async.crm_get(endpoint, priority=crm_limiter.PRIORITY_BULK)
+        return _names(data.get(key))
+
+    results = await asyncio.gather(*(fetch(endpoint, key) for endpoint, key in DICTIONARIES.values()))
+    return dict(zip(DICTIONARIES, results))
+
+async def refresh(max_age: float = CRM_REFERENCE_REFRESH):
+    """Взять свежую копию из Redis (её мог обновить другой процесс), иначе перечитать из CRM."""
+    if CRM_REFERENCE_REDIS:
+        cached = await _load_from_redis()
+        if cached and time.time() - cached.get("loaded_at", 0) < max_age:
+            if cached["loaded_at"] != _meta["loaded_at"]:
+                _install(cached, cached["loaded_at"], "redis")
+            return
+        if cached and not _meta["loaded_at"]:
+            # устаревшая копия лучше кодов статусов, пока CRM не ответила
+            _install(cached, cached["loaded_at"], "redis")
+    data = await _fetch_from_crm()
+    loaded_at = time.time()
+    _install(data, loaded_at, "crm")
+    _meta["refreshes"] += 1
+    if CRM_REFERENCE_REDIS:
+        try:
+            await _redis().set(REDIS_KEY, json.dumps({**data, "loaded_at": loaded_at}, ensure_ascii=False), ex=REDIS_TTL)
+        except Exception as e:
+            logging.warning("Reference: failed to store Redis copy: %s", e)
+    logging.info("Reference data loaded: %s", {name: len(v) for name, v in data.items()})
+
+async def run_refresh_worker(interval: float = CRM_REFERENCE_REFRESH):
+    delay = 5.0
+    while True:
+        try:
+            await refresh(interval)
+            delay = 5.0
+            await asyncio.sleep(interval)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # пока справочников нет, повторяем чаще
+            _meta["errors"] += 1
+            logging.warning("Reference refresh failed (retry in %.0fs): %s", delay, e)
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, interval)
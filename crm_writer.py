@@ -0,0 +1,221 @@
+import os
+import json
+import time
+import socket
+import asyncio
+import logging
+import contextlib
+
+import aiohttp
+
+import crm_async
+import crm_limiter
+
+# Запись в CRM через очередь: пользователь сразу получает ответ, а orders/{id}/edit
+# выполняет фоновый воркер. Нужен Redis; без него пишем напрямую, как раньше.
+CRM_WRITE_QUEUE = os.getenv("CRM_WRITE_QUEUE", "true" if os.getenv("REDIS_URL") else "false").lower() == "true"
+CRM_WRITE_BATCH = int(os.getenv("CRM_WRITE_BATCH", "100"))
+CRM_WRITE_CONCURRENCY = int(os.getenv("CRM_WRITE_CONCURRENCY", "4"))
+CRM_WRITE_ATTEMPTS = int(os.getenv("CRM_WRITE_ATTEMPTS", "6"))
+CRM_WRITE_BACKOFF = float(os.getenv("CRM_WRITE_BACKOFF", "2"))  # первая пауза между попытками, сек; дальше x2
+CRM_WRITE_CLAIM_IDLE_MS = int(os.getenv("CRM_WRITE_CLAIM_IDLE_MS", "300000"))  # чужие зависшие записи забираем через 5 мин
+CRM_WRITE_CLAIM_INTERVAL = float(os.getenv("CRM_WRITE_CLAIM_INTERVAL", "30"))  # как часто искать зависшие записи, сек
+
+STREAM = "crm:writes"
+DEAD_STREAM = "crm:writes:dead"
+GROUP = "crm-writers"
+SITE_KEY = "crm:order_site:{}"  # магазин заказа для orders/{id}/edit
+SITE_TTL = 30 * 24 * 3600
+STREAM_MAXLEN = 100000
+
+_consumer = f"{socket.gethostname()}-{os.getpid()}"
+
+def _redis():
+    from redis_client import ar
+    return ar
+
+async def remember_site(order_id, site: str | None):
+    if site:
+        await _redis().set(SITE_KEY.format(order_id), site, ex=SITE_TTL)
+
+async def _resolve_site(order_id) -> str | None:
+    site = await _redis().get(SITE_KEY.format(order_id))
+    if site:
+        return site
+    o = await crm_async.get_order_by_id(order_id)
+    site = o.site if o else None
+    await remember_site(order_id, site)
+    return site
+
+async def enqueue_custom_fields(order_id, fields: dict, site: str | None = None):
+    """Поставить обновление customFields заказа в очередь (без ожидания CRM)."""
+    r = _redis()
+    async with r.pipeline(transaction=False) as pipe:
+        if site:
+            pipe.set(SITE_KEY.format(order_id), site, ex=SITE_TTL)
+        pipe.xadd(STREAM, {"order_id": str(order_id), "fields": json.dumps(fields, ensure_ascii=False)},
+                  maxlen=STREAM_MAXLEN, approximate=True)
+        await pipe.execute()
+
+def _is_permanent(e: Exception) -> bool:
+    return isinstance(e, aiohttp.ClientResponseError) and 400 <= e.status < 500 and e.status != 429
+
+async def _dead_letter(order_id, fields: dict, error: Exception):
+    logging.error("CRM write for order %s dead-lettered: %s", order_id, error)
+    await _redis().xadd(DEAD_STREAM, {
+        "order_id": str(order_id),
+        "fields": json.dumps(fields, ensure_ascii=False),
+        "error": str(error)[:500],
+    }, maxlen=STREAM_MAXLEN, approximate=True)
+
+_order_locks: dict = {}  # order_id -> [asyncio.Lock, сколько задач его держит или ждёт]
+
+@contextlib.asynccontextmanager
+async def _order_lock(order_id):
+    """Одна запись заказа за раз, по порядку очереди (asyncio.Lock отдаёт ожидающим в порядке прихода)."""
+    entry = _order_locks.setdefault(order_id, [asyncio.Lock(), 0])
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            yield
+    finally:
+        entry[1] -= 1
+        if not entry[1]:
+            _order_locks.pop(order_id, None)
+
+async def _write_order(order_id, fields: dict, message_ids: list, sem: asyncio.Semaphore):
+    # лок держим и на время пауз между попытками: иначе повтор старой пачки лёг бы поверх
+    # уже записанных более новых полей из следующей пачки
+    async with _order_lock(order_id):
+        delay = CRM_WRITE_BACKOFF
+        for attempt in range(1, CRM_WRITE_ATTEMPTS + 1):
+            try:
+                async with sem:
+                    site = await _resolve_site(order_id)
+                    await crm_async._edit_order(order_id, {"order": {"customFields": fields}}, site,
+                                                priority=crm_limiter.PRIORITY_BULK)
+                break
+            except asyncio.CancelledError:
+                raise  # запись останется в pending и её подберёт следующий запуск
+            except Exception as e:
+                if _is_permanent(e) or attempt == CRM_WRITE_ATTEMPTS:
+                    await _dead_letter(order_id, fields, e)
+                    break
+                logging.warning("CRM write for order %s failed (attempt %s): %s", order_id, attempt, e)
+                await asyncio.sleep(delay)
+                delay *= 2
+        await _redis().xack(STREAM, GROUP, *message_ids)
+
+def _coalesce(messages: list) -> dict:
+    # несколько обновлений одного заказа превращаем в один edit; более поздние поля перекрывают ранние
+    by_order: dict = {}
+    for msg_id, fields in messages:
+        order_id = fields.get("order_id")
+        try:
+            update = json.loads(fields.get("fields") or "{}")
+        except ValueError:
+            update = {}
+        entry = by_order.setdefault(order_id, ({}, []))
+        entry[0].update(update)
+        entry[1].append(msg_id)
+    return by_order
+
+async def _ensure_group():
+    try:
+        await _redis().xgroup_create(STREAM, GROUP, id="0", mkstream=True)
+    except Exception as e:
+        if "BUSYGROUP" not in str(e):
+            raise
+
+async def _process(messages: list, sem: asyncio.Semaphore):
+    batch = _coalesce(messages)
+    if len(batch) < len(messages):
+        logging.info("CRM write queue: %s updates coalesced into %s edits", len(messages), len(batch))
+    await asyncio.gather(*(
+        _write_order(order_id, fields, ids, sem) for order_id, (fields, ids) in batch.items() if order_id
+    ))
+
+async def _own_pending(r):
+    """Свои неподтверждённые записи (упали до xack) — постранично, от начала PEL."""
+    last = "0"
+    while True:
+        resp = await r.xreadgroup(GROUP, _consumer, {STREAM: last}, count=CRM_WRITE_BATCH)
+        messages = [m for _, msgs in resp or [] for m in msgs]
+        if not messages:
+            return
+        yield [m for m in messages if m[1]]
+        last = messages[-1][0]
+
+async def _claim_stale(r):
+    """Записи, которые другой потребитель (прошлый процесс до редеплоя, упавшая реплика) держит дольше
+    CRM_WRITE_CLAIM_IDLE_MS, — по курсору XAUTOCLAIM до конца PEL."""
+    cursor = "0-0"
+    while True:
+        cursor, claimed, *_ = await r.xautoclaim(STREAM, GROUP, _consumer, min_idle_time=CRM_WRITE_CLAIM_IDLE_MS,
+                                                 start_id=cursor, count=CRM_WRITE_BATCH)
+        claimed = [m for m in claimed if m[1]]  # удалённые из стрима записи приходят без полей
+        if claimed:
+            yield claimed
+        if cursor in ("0-0", b"0-0"):
+            return
+
+async def run_write_worker():
+    r = _redis()
+    await _ensure_group()
+    sem = asyncio.Semaphore(CRM_WRITE_CONCURRENCY)
+    in_flight: set[asyncio.Task] = set()
+
+    def _submit(messages: list):
+        task = asyncio.create_task(_process(messages, sem))
+        in_flight.add(task)
+        task.add_done_callback(in_flight.discard)
+
+    async def _recover(pages):
+        try:
+            async for messages in pages:
+                if messages:
+                    _submit(messages)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logging.exception("CRM write queue: failed to recover pending writes")
+
+    # сначала то, что осталось неподтверждённым после падения или редеплоя
+    await _recover(_own_pending(r))
+    await _recover(_claim_stale(r))
+    next_claim = time.monotonic() + CRM_WRITE_CLAIM_INTERVAL
+    try:
+        while True:
+            try:
+                # не набираем новых записей, пока старые ждут повтора
+                if len(in_flight) >= CRM_WRITE_CONCURRENCY * 4:
+                    await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+                if time.monotonic() >= next_claim:
+                    # записи прошлого процесса становятся «зависшими» только через CRM_WRITE_CLAIM_IDLE_MS после редеплоя
+                    next_claim = time.monotonic() + CRM_WRITE_CLAIM_INTERVAL
+                    await _recover(_claim_stale(r))
+                resp = await r.xreadgroup(GROUP, _consumer, {STREAM: ">"}, count=CRM_WRITE_BATCH, block=5000)
+                for _, messages in resp or []:
+                    _submit(messages)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logging.exception("CRM write queue worker failed")
+                await asyncio.sleep(CRM_WRITE_BACKOFF)
+    finally:
+        for task in in_flight:
+            task.cancel()
+
+async def queue_stats() -> dict:
+    r = _redis()
+    try:
+        pending = await r.xpending(STREAM, GROUP)
+        pending_count = pending.get("pending", 0)
+    except Exception:
+        pending_count = None
+    return {
+        "enabled": CRM_WRITE_QUEUE,
+        "length": await r.xlen(STREAM),
+        "pending": pending_count,
+        "dead": await r.xlen(DEAD_STREAM),
+    }
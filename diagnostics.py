@@ -0,0 +1,192 @@
+import os
+import sys
+import hmac
+import time
+import asyncio
+import logging
+import threading
+from collections import Counter, deque
+
+from aiohttp import web
+
+import metrics
+
+# Диагностика event loop: фоновый замер задержки loop, сторожевой поток, который ловит
+# зависания (синхронный requests, разбор большого JSON) и запоминает стек виновника,
+# и семплирующий профайлер по запросу — /debug/profile отдаёт collapsed stacks для flamegraph.
+LOOP_MONITOR_ENABLED = os.getenv("LOOP_MONITOR_ENABLED", "true").lower() == "true"
+LOOP_LAG_INTERVAL = float(os.getenv("LOOP_LAG_INTERVAL", "0.5"))          # как часто мерить задержку, сек
+LOOP_STALL_THRESHOLD = float(os.getenv("LOOP_STALL_THRESHOLD", "0.25"))  # сколько loop может не отвечать, сек
+DEBUG_TOKEN = os.getenv("DEBUG_TOKEN") or None  # без токена /debug/* не отвечают
+PROFILE_MAX_SECONDS = 60.0
+PROFILE_DEFAULT_HZ = 200
+HEARTBEAT_INTERVAL = 0.05
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+def _label(frame) -> str:
+    code = frame.f_code
+    return f"{os.path.basename(code.co_filename)}:{code.co_name}"
+
+def _stack(frame) -> list:
+    """Кадры от внешнего к внутреннему."""
+    out = []
+    while frame is not None:
+        out.append(frame)
+        frame = frame.f_back
+    return out[::-1]
+
+def _culprit(frames: list) -> str:
+    """Первый и последний кадр нашего кода: обычно обработчик и место, где он блокирует loop."""
+    ours = [f for f in frames if f.f_code.co_filename.startswith(ROOT)]
+    if not ours:
+        return _label(frames[-1]) if frames else "unknown"
+    outer, inner = _label(ours[0]), _label(ours[-1])
+    return outer if outer == inner else f"{outer} → {inner}"
+
+class _Watchdog(threading.Thread):
+    def __init__(self, loop: asyncio.AbstractEventLoop, threshold: float):
+        super().__init__(name="loop-watchdog", daemon=True)
+        self.loop = loop
+        self.loop_thread_id = threading.get_ident()
+        self.threshold = threshold
+        self.heartbeat = time.monotonic()
+        self._stopping = threading.Event()
+        self._handle = None
+        self.stalls = 0
+        self.max_stall = 0.0
+        self.offenders: Counter = Counter()        # виновник -> суммарное время зависаний, сек
+        self.offender_counts: Counter = Counter()  # виновник -> число зависаний
+        self.recent: deque = deque(maxlen=10)
+
+    def beat(self):
+        self.heartbeat = time.monotonic()
+        self._handle = self.loop.call_later(HEARTBEAT_INTERVAL, self.beat)
+
+    def run(self):
+        stalled_since = None
+        culprit, stack = None, []
+        while not self._stopping.wait(HEARTBEAT_INTERVAL):
+            last = self.heartbeat
+            age = time.monotonic() - last
+            if stalled_since is None and age > self.threshold:
+                # loop стоит: снимаем стек его потока прямо сейчас, пока виновник ещё выполняется
+                frames = _stack(sys._current_frames().get(self.loop_thread_id))
+                stalled_since, culprit, stack = last, _culprit(frames), [_label(f) for f in frames]
+            elif stalled_since is not None and last != stalled_since:
+                self._record(last - stalled_since - HEARTBEAT_INTERVAL, culprit, stack)
+                stalled_since = None
+
+    def _record(self, duration: float, culprit: str, stack: list):
+        self.stalls += 1
+        self.max_stall = max(self.max_stall, duration)
+        self.offenders[culprit] += duration
+        self.offender_counts[culprit] += 1
+        self.recent.append({"at": time.time(), "seconds": round(duration, 3), "culprit": culprit,
+                            "stack": ";".join(stack)})
+        metrics.LOOP_STALLS.inc()
+        logging.warning("Event loop stalled for %.0f ms in %s\n  %s", duration * 1000, culprit, "\n  ".join(stack[-15:]))
+
+    def stop(self):
+        self._stopping.set()
+        if self._handle is not None:
+            self._handle.cancel()
+
+_watchdog: _Watchdog | None = None
+_lag = {"last": 0.0, "max": 0.0}
+_profile_lock = asyncio.Lock()
+
+async def run_lag_monitor(interval: float = LOOP_LAG_INTERVAL):
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(interval)
+        lag = max(0.0, loop.time() - started - interval)
+        _lag["last"] = lag
+        _lag["max"] = max(_lag["max"], lag)
+        metrics.LOOP_LAG.observe(lag)
+
+def start_watchdog(threshold: float = LOOP_STALL_THRESHOLD):
+    """Запустить сторожевой поток; вызывать из потока event loop."""
+    global _watchdog
+    if _watchdog is not None:
+        return
+    _watchdog = _Watchdog(asyncio.get_running_loop(), threshold)
+    _watchdog.beat()
+    _watchdog.start()
+
+def stop_watchdog():
+    global _watchdog
+    if _watchdog is not None:
+        _watchdog.stop()
+        _watchdog = None
+
+def summary() -> dict:
+    """Коротко для /healthz: задержка loop и число зависаний."""
+    return {"lag_last_ms": round(_lag["last"] * 1000, 1), "lag_max_ms": round(_lag["max"] * 1000, 1),
+            "stalls": _watchdog.stalls if _watchdog else 0}
+
+def stats(top: int = 10) -> dict:
+    out = summary()
+    if _watchdog is not None:
+        w = _watchdog
+        out.update(
+            stall_max_ms=round(w.max_stall * 1000, 1),
+            worst_offenders=[{"culprit": c, "total_ms": round(t * 1000, 1), "count": w.offender_counts[c]}
+                             for c, t in w.offenders.most_common(top)],
+            recent_stalls=list(w.recent),
+        )
+    return out
+
+# ---------- профайлер ----------
+
+def sample_profile(seconds: float, hz: int = PROFILE_DEFAULT_HZ, thread_ids=None) -> Counter:
+    """Снимать стеки потоков seconds секунд с частотой hz; результат — {"поток;кадр;…;кадр": число}."""
+    me = threading.get_ident()
+    names = {t.ident: t.name for t in threading.enumerate()}
+    counts: Counter = Counter()
+    deadline = time.monotonic() + seconds
+    interval = 1.0 / max(1, hz)
+    while time.monotonic() < deadline:
+        for tid, frame in sys._current_frames().items():
+            if tid == me or (thread_ids is not None and tid not in thread_ids):
+                continue
+            stack = [_label(f) for f in _stack(frame)]
+            counts[";".join([names.get(tid, str(tid))] + stack)] += 1
+        time.sleep(interval)
+    return counts
+
+def collapsed(counts: Counter) -> str:
+    return "".join(f"{stack} {n}\n" for stack, n in counts.most_common())
+
+def _authorized(request: web.Request) -> bool:
+    if not DEBUG_TOKEN:
+        return False
+    header = request.headers.get("Authorization", "")
+    token = header[7:] if header.startswith("Bearer ") else request.query.get("token", "")
+    return hmac.compare_digest(token, DEBUG_TOKEN)
+
+async def loop_handler(request: web.Request) -> web.Response:
+    if not _authorized(request):
+        return web.Response(status=404)
+    return web.json_response(stats())
+
+async def profile_handler(request: web.Request) -> web.Response:
+    """GET /debug/profile?seconds=10[&hz=200][&threads=all] — collapsed stacks (flamegraph.pl, speedscope)."""
+    if not _authorized(request):
+        return web.Response(status=404)
+    try:
+        seconds = min(PROFILE_MAX_SECONDS, max(0.1, float(request.query.get("seconds", "10"))))
+        hz = min(1000, max(1, int(request.query.get("hz", PROFILE_DEFAULT_HZ))))
+    except ValueError:
+        return web.Response(status=400, text="seconds and hz must be numbers")
+    if _profile_lock.locked():
+        return web.Response(status=409, text="profile already running")
+    # по умолчанию — только поток event loop; threads=all — ещё поток логов, executor и т.д.
+    threads = None if request.query.get("threads") == "all" else {threading.get_ident()}
+    async with _profile_lock:
+        counts = await asyncio.get_running_loop().run_in_executor(None, sample_profile, seconds, hz, threads)
+    return web.Response(text=collapsed(counts), content_type="text/plain")
+
+def setup_routes(app: web.Application):
+    app.router.add_get("/debug/loop", loop_handler)
+    app.router.add_get("/debug/profile", profile_handler)
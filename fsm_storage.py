@@ -0,0 +1,114 @@
+import os
+import json
+import contextlib
+from contextvars import ContextVar
+from typing import Any, Dict, Optional
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StorageKey, StateType, DEFAULT_DESTINY
+
+FSM_TTL = int(os.getenv("FSM_TTL", str(30 * 24 * 3600)))  # через сколько секунд простоя сессия забывается
+
+# прочитанное состояние живёт только до конца апдейта: следующий апдейт чата может прийти
+# в другую реплику, и её запись этот процесс не увидел бы
+_update_cache: ContextVar[Optional[dict]] = ContextVar("fsm_update_cache", default=None)
+
+@contextlib.contextmanager
+def update_scope():
+    """Кэш чтений FSM на время обработки одного апдейта: middleware aiogram и обработчик
+    читают состояние по нескольку раз, в Redis идёт только первое чтение."""
+    cache: dict = {}
+    token = _update_cache.set(cache)
+    try:
+        yield
+    finally:
+        _update_cache.reset(token)
+        cache.clear()  # фоновые задачи, запущенные из обработчика, унаследовали ссылку — не отдаём им старое
+
+def _dumps(data: dict) -> str:
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":"))
+
+class RedisFSMStorage(BaseStorage):
+    """FSM-хранилище aiogram в Redis: состояние и данные пользователя лежат
+    в одном hash (поля s и d), чтение и запись — один round trip с продлением TTL.
+
+    Внутри update_scope() прочитанное состояние запоминается до конца апдейта.
+    """
+
+    def __init__(self, redis=None, prefix: str = "fsm", ttl: int = FSM_TTL):
+        if redis is None:
+            from redis_client import ar as redis
+        self.redis = redis
+        self.prefix = prefix
+        self.ttl = ttl
+
+    def _key(self, key: StorageKey) -> str:
+        parts = [self.prefix, str(key.bot_id), str(key.chat_id), str(key.user_id)]
+        if key.thread_id:
+            parts.append(str(key.thread_id))
+        if key.business_connection_id:
+            parts.append(str(key.business_connection_id))
+        if key.destiny != DEFAULT_DESTINY:
+            parts.append(key.destiny)
+        return ":".join(parts)
+
+    @staticmethod
+    def _remember(rkey: str, state: Optional[str], data: Dict[str, Any]):
+        cache = _update_cache.get()
+        if cache is not None:
+            cache[rkey] = (state, data)
+
+    @staticmethod
+    def _cached(rkey: str):
+        cache = _update_cache.get()
+        return cache.get(rkey) if cache is not None else None
+
+    async def _load(self, rkey: str):
+        entry = self._cached(rkey)
+        if entry is not None:
+            return entry
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.hmget(rkey, "s", "d")
+            pipe.expire(rkey, self.ttl)
+            (raw_state, raw_data), _ = await pipe.execute()
+        data = json.loads(raw_data) if raw_data else {}
+        self._remember(rkey, raw_state, data)
+        return raw_state, data
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        rkey = self._key(key)
+        value = state.state if isinstance(state, State) else state
+        async with self.redis.pipeline(transaction=True) as pipe:
+            if value is None:
+                pipe.hdel(rkey, "s")
+            else:
+                pipe.hset(rkey, "s", value)
+                pipe.expire(rkey, self.ttl)
+            await pipe.execute()
+        entry = self._cached(rkey)
+        if entry is not None:
+            self._remember(rkey, value, entry[1])
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        state, _ = await self._load(self._key(key))
+        return state
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        rkey = self._key(key)
+        async with self.redis.pipeline(transaction=True) as pipe:
+            if not data:
+                pipe.hdel(rkey, "d")
+            else:
+                pipe.hset(rkey, "d", _dumps(data))
+                pipe.expire(rkey, self.ttl)
+            await pipe.execute()
+        entry = self._cached(rkey)
+        if entry is not None:
+            self._remember(rkey, entry[0], dict(data))
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        _, data = await self._load(self._key(key))
+        return dict(data)
+
+    async def close(self) -> None:
+        pass
@@ -0,0 +1,182 @@
+import os
+import hmac
+import time
+import asyncio
+import logging
+from collections import OrderedDict, deque
+
+from aiogram import Bot, Dispatcher
+from aiogram.types import Update
+from aiohttp import web
+
+import fsm_storage
+
+# Быстрый приём вебхуков: проверяем секрет, отбрасываем повторы по update_id,
+# кладём апдейт в очередь и сразу отвечаем Telegram 200. Обработку ведёт пул
+# воркеров; апдейты одного чата обрабатываются строго по порядку.
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", "32"))
+INGEST_MAX_QUEUE = int(os.getenv("INGEST_MAX_QUEUE", "10000"))
+INGEST_DEDUP_TTL = int(os.getenv("INGEST_DEDUP_TTL", "3600"))
+INGEST_DEDUP_REDIS = os.getenv("INGEST_DEDUP_REDIS", "true" if os.getenv("REDIS_URL") else "false").lower() == "true"
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+def update_chat_id(data: dict):
+    """chat.id апдейта (для порядка обработки и шардирования); если чата нет — id пользователя."""
+    for key in ("message", "edited_message", "channel_post", "edited_channel_post", "business_message"):
+        chat = (data.get(key) or {}).get("chat")
+        if chat:
+            return chat.get("id")
+    cq = data.get("callback_query")
+    if cq:
+        chat = (cq.get("message") or {}).get("chat")
+        if chat:
+            return chat.get("id")
+        return (cq.get("from") or {}).get("id")
+    for key in ("inline_query", "chosen_inline_result", "shipping_query", "pre_checkout_query",
+                "my_chat_member", "chat_member", "chat_join_request"):
+        obj = data.get(key)
+        if obj:
+            return ((obj.get("chat") or {}).get("id")) or ((obj.get("from") or {}).get("id"))
+    return None
+
+class _LocalDedup:
+    def __init__(self, ttl: int, maxsize: int = 100000):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._seen: OrderedDict = OrderedDict()
+
+    def add(self, update_id) -> bool:
+        now = time.monotonic()
+        while self._seen and (next(iter(self._seen.values())) < now or len(self._seen) > self.maxsize):
+            self._seen.popitem(last=False)
+        if update_id in self._seen:
+            return False
+        self._seen[update_id] = now + self.ttl
+        return True
+
+class UpdateIngestor:
+    def __init__(self, dp: Dispatcher, bot: Bot, secret: str | None = None,
+                 workers: int = INGEST_WORKERS, max_queue: int = INGEST_MAX_QUEUE):
+        self.dp = dp
+        self.bot = bot
+        self.secret = secret
+        self.workers = workers
+        self.max_queue = max_queue
+        self._chats: dict = {}         # chat id -> deque[(enqueued_at, update dict)]
+        self._ready: asyncio.Queue | None = None
+        self._depth = 0
+        self._busy = 0
+        self._tasks: list[asyncio.Task] = []
+        self._local_dedup = _LocalDedup(INGEST_DEDUP_TTL)
+        self.accepting = True
+        self.counters = {"accepted": 0, "duplicates": 0, "rejected": 0, "processed": 0, "failed": 0}
+        self._lag_last = 0.0
+        self._lag_max = 0.0
+
+    async def _is_new(self, update_id) -> bool:
+        if update_id is None:
+            return True
+        if INGEST_DEDUP_REDIS:
+            try:
+                from redis_client import ar
+                return bool(await ar.set(f"upd:{update_id}", "1", nx=True, ex=INGEST_DEDUP_TTL))
+            except Exception as e:
+                logging.warning("Update dedup via Redis failed, using local set: %s", e)
+        return self._local_dedup.add(update_id)
+
+    async def handle(self, request: web.Request) -> web.Response:
+        if self.secret and not hmac.compare_digest(request.headers.get(SECRET_HEADER, ""), self.secret):
+            return web.Response(status=401)
+        if not self.accepting or self._ready is None:
+            # Telegram повторит доставку — апдейт заберёт следующий процесс
+            return web.Response(status=503)
+        if self._depth >= self.max_queue:
+            self.counters["rejected"] += 1
+            return web.Response(status=503)
+        try:
+            data = await request.json()
+        except Exception:
+            return web.Response(status=400)
+        if not await self._is_new(data.get("update_id")):
+            self.counters["duplicates"] += 1
+            return web.Response()
+        self.enqueue(data)
+        return web.Response()
+
+    def enqueue(self, data: dict):
+        chat_id = update_chat_id(data)
+        if chat_id is None:
+            chat_id = ("update", data.get("update_id"))
+        pending = self._chats.get(chat_id)
+        if pending is None:
+            pending = self._chats[chat_id] = deque()
+            self._ready.put_nowait(chat_id)
+        pending.append((time.monotonic(), data))
+        self._depth += 1
+        self.counters["accepted"] += 1
+
+    async def _process(self, enqueued_at: float, data: dict):
+        lag = time.monotonic() - enqueued_at
+        self._lag_last = lag
+        self._lag_max = max(self._lag_max, lag)
+        try:
+            update = Update.model_validate(data, context={"bot": self.bot})
+            # received_at — когда апдейт пришёл (для отсечения повторных нажатий в throttle)
+            with fsm_storage.update_scope():
+                await self.dp.feed_update(self.bot, update, received_at=time.time() - lag)
+            self.counters["processed"] += 1
+        except Exception:
+            self.counters["failed"] += 1
+            logging.exception("Failed to process update %s", data.get("update_id"))
+
+    async def _worker(self):
+        while True:
+            chat_id = await self._ready.get()
+            pending = self._chats.get(chat_id)
+            self._busy += 1
+            try:
+                if pending:
+                    enqueued_at, data = pending.popleft()
+                    self._depth -= 1
+                    await self._process(enqueued_at, data)
+            finally:
+                self._busy -= 1
+                # чат снова в очередь, если у него ещё есть апдейты — так один болтливый чат не занимает воркер целиком
+                if pending:
+                    self._ready.put_nowait(chat_id)
+                else:
+                    self._chats.pop(chat_id, None)
+                self._ready.task_done()
+
+    async def start(self):
+        if self._ready is not None:
+            return
+        self._ready = asyncio.Queue()
+        self.accepting = True
+        self._tasks = [asyncio.create_task(self._worker(), name=f"ingest-{i}") for i in range(self.workers)]
+
+    async def stop(self, timeout: float = 25.0):
+        if self._ready is None:
+            return
+        self.accepting = False
+        try:
+            await asyncio.wait_for(self._ready.join(), timeout=timeout)
+        except asyncio.TimeoutError:
+            logging.warning("Ingest stopped with %s updates unprocessed", self._depth)
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._ready = None
+
+    def stats(self) -> dict:
+        out = dict(self.counters)
+        out["depth"] = self._depth
+        out["chats_pending"] = len(self._chats)
+        out["busy_workers"] = self._busy
+        out["lag_last_seconds"] = round(self._lag_last, 3)
+        out["lag_max_seconds"] = round(self._lag_max, 3)
+        oldest = min((p[0][0] for p in self._chats.values() if p), default=None)
+        out["oldest_pending_seconds"] = round(time.monotonic() - oldest, 3) if oldest is not None else 0.0
+        return out
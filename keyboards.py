@@ -11,10 +11,23 @@ def get_main_keyboard():
 
 def get_orders_keyboard():
     return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="Активные заказы", callback_data="orders_active")],
-        [InlineKeyboardButton(text="Прошлые заказы", callback_data="orders_past")]
+        [InlineKeyboardButton(text="Активные заказы", callback_data="orders:active:1")],
+        [InlineKeyboardButton(text="Прошлые заказы", callback_data="orders:past:1")]
     ])
 
+def get_orders_page_keyboard(group: str, page: int, pages: int):
+    nav = []
+    if page > 1:
+        nav.append(InlineKeyboardButton(text="◀️ Назад", callback_data=f"orders:{group}:{page - 1}"))
+    if page < pages:
+        nav.append(InlineKeyboardButton(text="Вперёд ▶️", callback_data=f"orders:{group}:{page + 1}"))
+    other = "past" if group == "active" else "active"
+    rows = [nav] if nav else []
+    rows.append([InlineKeyboardButton(text="Прошлые заказы" if other == "past" else "Активные заказы",
+                                      callback_data=f"orders:{other}:1")])
+    rows.append([InlineKeyboardButton(text="🏠 В меню", callback_data="menu")])
+    return InlineKeyboardMarkup(inline_keyboard=rows)
+
 def get_stars_keyboard():
     return InlineKeyboardMarkup(inline_keyboard=[
         [
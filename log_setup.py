@@ -0,0 +1,183 @@
+import os
+import re
+import sys
+import json
+import copy
+import queue
+import atexit
+import random
+import logging
+import logging.handlers
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject, Update
+
+# Логи не пишутся в stderr из event loop: записи кладутся в очередь (QueueHandler),
+# а форматирует и выводит их отдельный поток (QueueListener). Формат — JSON по строке
+# на запись с полями апдейта (update_id, user_id, handler, latency_ms), шумные INFO-строки
+# (access-лог, события aiogram, итог обработчика) сэмплируются, телефоны и коды маскируются.
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json").lower()  # json | text
+LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", "0.1"))  # доля сохраняемых шумных INFO-строк
+LOG_SAMPLED_LOGGERS = [n.strip() for n in os.getenv("LOG_SAMPLED_LOGGERS", "aiohttp.access,aiogram.event,bot.handler").split(",")
+                       if n.strip()]
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+
+CONTEXT_FIELDS = ("update_id", "user_id", "handler", "latency_ms")
+_context: ContextVar[dict] = ContextVar("log_context", default={})
+
+# +7 (999) 123-45-67, 8 999 123 45 67, 79991234567; 10 цифр без кода не трогаем — так выглядят id в Telegram
+_PHONE_RE = re.compile(r"(?<![\w+])(?:\+7|8|7)[\s\-(]*\d{3}[\s\-)]*\d{3}[\s\-]*\d{2}[\s\-]*\d{2}(?!\w)")
+# телефон в query-строке запроса к CRM: filter[phone]=9991234567 (в том числе url-encoded)
+_PHONE_PARAM_RE = re.compile(r"(phone(?:\]|%5D)?=)(\+?\d+)", re.I)
+# filter[customFields][bot_code]=… — код входа (имя поля настраивается, поэтому любое customFields-поле)
+_CUSTOM_FIELD_PARAM_RE = re.compile(r"(customFields(?:\]|%5D)(?:\[|%5B)[^=&\s]+?(?:\]|%5D)=)([^&\s\"']+)", re.I)
+# ключ API RetailCRM в query-строке не пишем вообще
+_API_KEY_PARAM_RE = re.compile(r"((?:api_?key|apikey)=)[^&\s\"']+", re.I)
+
+def mask(value) -> str:
+    """Скрыть код или телефон в логе, оставив последние два символа для сверки."""
+    s = str(value or "").strip()
+    if len(s) <= 2:
+        return "*" * len(s)
+    return "*" * (len(s) - 2) + s[-2:]
+
+def redact(text: str) -> str:
+    text = _API_KEY_PARAM_RE.sub(r"\1***", text)
+    text = _CUSTOM_FIELD_PARAM_RE.sub(lambda m: m.group(1) + mask(m.group(2)), text)
+    text = _PHONE_PARAM_RE.sub(lambda m: m.group(1) + mask(m.group(2)), text)
+    return _PHONE_RE.sub(lambda m: mask(re.sub(r"\D", "", m.group(0))), text)
+
+def bind(**fields):
+    """Добавить поля в контекст логов текущей задачи; вернуть токен для reset()."""
+    return _context.set({**_context.get(), **fields})
+
+def reset(token):
+    _context.reset(token)
+
+class _ContextFilter(logging.Filter):
+    """Переносит поля контекста в запись — в потоке event loop, пока контекст ещё доступен."""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        for key, value in _context.get().items():
+            if not hasattr(record, key):
+                setattr(record, key, value)
+        return True
+
+class _SamplingFilter(logging.Filter):
+    def __init__(self, rate: float, loggers: list):
+        super().__init__()
+        self.rate = rate
+        self.loggers = tuple(loggers)
+        self.dropped = 0
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno > logging.INFO or self.rate >= 1.0:
+            return True
+        if getattr(record, "sampled", False) or record.name.startswith(self.loggers):
+            if random.random() >= self.rate:
+                self.dropped += 1
+                return False
+        return True
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """Не блокирует loop: при переполненной очереди запись отбрасывается и считается."""
+
+    def __init__(self, q):
+        super().__init__(q)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # в loop только подставляем аргументы; трейсбек (чтение исходников) форматирует поток вывода
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        doc = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": redact(record.getMessage()),
+        }
+        for key in CONTEXT_FIELDS:
+            value = getattr(record, key, None)
+            if value is not None:
+                doc[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            doc["exc"] = redact(record.exc_text)
+        return json.dumps(doc, ensure_ascii=False, default=str)
+
+class TextFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__("%(levelname)s:%(name)s:%(message)s")
+
+    def format(self, record: logging.LogRecord) -> str:
+        line = redact(super().format(record))
+        extra = " ".join(f"{k}={getattr(record, k)}" for k in CONTEXT_FIELDS if getattr(record, k, None) is not None)
+        return f"{line} [{extra}]" if extra else line
+
+_listener: logging.handlers.QueueListener | None = None
+_queue_handler: _QueueHandler | None = None
+_sampling: _SamplingFilter | None = None
+
+def setup(level: str = LOG_LEVEL, fmt: str = LOG_FORMAT):
+    """Перенастроить root-логгер на очередь с выводом из фонового потока (повторный вызов ничего не делает)."""
+    global _listener, _queue_handler, _sampling
+    if _listener is not None:
+        return
+    stream = logging.StreamHandler(sys.stderr)
+    stream.setFormatter(JsonFormatter() if fmt == "json" else TextFormatter())
+    q = queue.Queue(LOG_QUEUE_SIZE)
+    _queue_handler = _QueueHandler(q)
+    _sampling = _SamplingFilter(LOG_SAMPLE_RATE, LOG_SAMPLED_LOGGERS)
+    _queue_handler.addFilter(_sampling)
+    _queue_handler.addFilter(_ContextFilter())
+    root = logging.getLogger()
+    for h in list(root.handlers):
+        root.removeHandler(h)
+    root.addHandler(_queue_handler)
+    root.setLevel(level)
+    _listener = logging.handlers.QueueListener(q, stream, respect_handler_level=True)
+    _listener.start()
+    atexit.register(shutdown)
+
+def shutdown():
+    """Дописать всё, что осталось в очереди, и остановить поток вывода."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+def stats() -> dict:
+    return {
+        "queued": _queue_handler.queue.qsize() if _queue_handler else 0,
+        "dropped_overflow": _queue_handler.dropped if _queue_handler else 0,
+        "dropped_sampled": _sampling.dropped if _sampling else 0,
+    }
+
+class LogContextMiddleware(BaseMiddleware):
+    """Outer-middleware на update: update_id и user_id во всех логах, написанных при его обработке."""
+
+    async def __call__(self, handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+                       event: TelegramObject, data: Dict[str, Any]) -> Any:
+        user = data.get("event_from_user")
+        token = bind(update_id=event.update_id if isinstance(event, Update) else None,
+                     user_id=user.id if user else None)
+        try:
+            return await handler(event, data)
+        finally:
+            reset(token)
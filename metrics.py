@@ -0,0 +1,162 @@
+import time
+import bisect
+import logging
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject
+
+import log_setup
+
+# Минимальный реестр метрик в текстовом формате Prometheus (/metrics).
+# Без внешних зависимостей: счётчики и гистограммы живут в памяти процесса.
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0)
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _labels(names, values, extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+def _num(v) -> str:
+    if v == float("inf"):
+        return "+Inf"
+    return repr(float(v)) if isinstance(v, float) else str(v)
+
+class Counter:
+    def __init__(self, name: str, help: str, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values: dict = {}
+
+    def inc(self, *labels, amount: float = 1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self) -> list:
+        out = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for labels, value in sorted(self._values.items()):
+            out.append(f"{self.name}{_labels(self.labelnames, labels)} {_num(value)}")
+        return out
+
+class Histogram:
+    def __init__(self, name: str, help: str, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._values: dict = {}  # labels -> [counts per bucket..., +Inf], sum
+
+    def observe(self, value: float, *labels):
+        entry = self._values.get(labels)
+        if entry is None:
+            entry = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        entry[0][bisect.bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+
+    def time(self, *labels):
+        return _Timer(self, labels)
+
+    def render(self) -> list:
+        out = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for labels, (counts, total) in sorted(self._values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = 'le="%s"' % _num(bound)
+                out.append(f"{self.name}_bucket{_labels(self.labelnames, labels, le)} {cumulative}")
+            out.append(f"{self.name}_sum{_labels(self.labelnames, labels)} {_num(total)}")
+            out.append(f"{self.name}_count{_labels(self.labelnames, labels)} {cumulative}")
+        return out
+
+class _Timer:
+    def __init__(self, histogram: Histogram, labels: tuple):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.started, *self.labels)
+        return False
+
+_metrics: list = []
+_collectors: list = []  # функции, которые на момент выдачи возвращают [(name, type, help, [(labels dict, value)])]
+
+def counter(name: str, help: str, labelnames=()) -> Counter:
+    m = Counter(name, help, labelnames)
+    _metrics.append(m)
+    return m
+
+def histogram(name: str, help: str, labelnames=(), buckets=DEFAULT_BUCKETS) -> Histogram:
+    m = Histogram(name, help, labelnames, buckets)
+    _metrics.append(m)
+    return m
+
+def register_collector(fn: Callable[[], list]):
+    _collectors.append(fn)
+
+def render() -> str:
+    lines = []
+    for m in _metrics:
+        lines.extend(m.render())
+    for fn in _collectors:
+        try:
+            families = fn()
+        except Exception:
+            continue
+        for name, kind, help, samples in families:
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in samples:
+                if value is None:
+                    continue
+                lines.append(f"{name}{_labels(labels.keys(), labels.values())} {_num(value)}")
+    return "\n".join(lines) + "\n"
+
+# ---------- метрики бота ----------
+
+HANDLER_LATENCY = histogram("bot_handler_duration_seconds", "Время работы обработчика aiogram", ("handler", "event", "outcome"))
+CRM_LATENCY = histogram("crm_request_duration_seconds", "Время запроса к RetailCRM", ("method", "endpoint"))
+CRM_REQUESTS = counter("crm_requests_total", "Запросы к RetailCRM по коду ответа", ("method", "endpoint", "status"))
+REDIS_LATENCY = histogram("redis_command_duration_seconds", "Время команды Redis",
+                          ("command",), buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0))
+REDIS_ERRORS = counter("redis_command_errors_total", "Ошибки команд Redis", ("command",))
+AUTH_ATTEMPTS = counter("bot_auth_attempts_total", "Попытки авторизации по результату", ("result",))
+CARRIER_LATENCY = histogram("carrier_request_duration_seconds", "Время запроса к API службы доставки", ("carrier", "status"))
+LOOP_LAG = histogram("event_loop_lag_seconds", "Задержка event loop относительно запланированного пробуждения", (),
+                     buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0))
+LOOP_STALLS = counter("event_loop_stalls_total", "Зависания event loop дольше LOOP_STALL_THRESHOLD")
+THROTTLED = counter("bot_throttled_total", "Отброшенные апдейты: повтор, лимит, блокировка входа", ("reason",))
+
+_handler_log = logging.getLogger("bot.handler")
+
+class HandlerTimingMiddleware(BaseMiddleware):
+    """Inner-middleware: замеряет время выбранного обработчика, с его именем в метке."""
+
+    def __init__(self, event: str):
+        self.event = event
+
+    async def __call__(self, handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+                       event: TelegramObject, data: Dict[str, Any]) -> Any:
+        handler_obj = data.get("handler")
+        name = getattr(getattr(handler_obj, "callback", None), "__name__", "unknown")
+        token = log_setup.bind(handler=name)
+        started = time.perf_counter()
+        outcome = "ok"
+        try:
+            return await handler(event, data)
+        except Exception:
+            outcome = "error"
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            HANDLER_LATENCY.observe(elapsed, name, self.event, outcome)
+            # итог обработчика — шумная строка, log_setup сэмплирует логгер bot.handler
+            _handler_log.info("%s %s", self.event, outcome, extra={"latency_ms": round(elapsed * 1000, 1)})
+            log_setup.reset(token)
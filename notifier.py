@@ -0,0 +1,141 @@
+import os
+import json
+import time
+import hashlib
+import asyncio
+import logging
+from datetime import datetime
+
+import crm_async
+import crm_limiter
+from sender import PRIORITY_BULK
+from crm import OrderSnapshot, _status_text, _tracking_text
+
+# Уведомления о смене статуса и появлении трек-номера.
+# Идём по orders/history со своим курсором, находим заказы с customFields.telegram_id
+# и сравниваем статус/трек с последним отправленным пользователю.
+NOTIFY_ENABLED = os.getenv("NOTIFY_ENABLED", "false").lower() == "true"
+NOTIFY_INTERVAL = float(os.getenv("NOTIFY_INTERVAL", "60"))
+NOTIFY_PAGE = 100
+NOTIFY_DEDUP_TTL = 14 * 24 * 3600
+NOTIFY_STATE_TTL = int(os.getenv("NOTIFY_STATE_TTL", str(90 * 24 * 3600)))  # заказ без изменений дольше — забываем
+
+K_CURSOR = "notify:meta"        # since_id / start_date
+K_STATE = "notify:state:{}"     # {"s": статус, "t": трек} заказа, что пользователь уже видел
+K_SENT = "notify:sent:{}"       # защита от повторной отправки одного и того же изменения
+K_LOCK = "notify:lock"
+
+def _redis():
+    from redis_client import ar
+    return ar
+
+def _state_of(o: OrderSnapshot) -> dict:
+    return {"s": o.status, "t": o.track}
+
+def _dumps(state: dict) -> str:
+    return json.dumps(state, ensure_ascii=False, separators=(",", ":"))
+
+def _telegram_id(o: dict):
+    raw = str(((o.get("customFields") or {}).get("telegram_id")) or "").strip()
+    return int(raw) if raw.lstrip("-").isdigit() else None
+
+async def subscribe(order_id: int):
+    """Запомнить текущий статус/трек заказа как уже показанный пользователю."""
+    o = await crm_async.get_order_by_id(order_id)
+    if o:
+        await _redis().set(K_STATE.format(order_id), _dumps(_state_of(o)), nx=True, ex=NOTIFY_STATE_TTL)
+
+def _messages_for(o: OrderSnapshot, old: dict, new: dict) -> list:
+    out = []
+    if new["s"] and new["s"] != old.get("s"):
+        out.append(("s", "🔔 Обновление по заказу!\n" + _status_text(o)))
+    if new["t"] and new["t"] != old.get("t"):
+        out.append(("t", "🔔 Появился трек-номер!\n" + _tracking_text(o)))
+    return out
+
+async def _notify_order(sender, o: OrderSnapshot, chat_id: int, known: str | None, entry_id):
+    r = _redis()
+    order_id = str(o.id)
+    new = _state_of(o)
+    if known is None:
+        # заказ видим впервые (авторизовались до включения уведомлений) — только запоминаем
+        await r.set(K_STATE.format(order_id), _dumps(new), ex=NOTIFY_STATE_TTL)
+        return
+    old = json.loads(known)
+    messages = _messages_for(o, old, new)
+    seen = dict(old)
+    if messages and chat_id:
+        # ключ — запись истории и переход «было → стало»: повтор той же страницы после рестарта
+        # не шлёт второй раз, а настоящий повторный переход (A→B→A→B) — новая запись истории
+        digest = hashlib.sha1(f"{order_id}:{entry_id}:{_dumps(old)}>{_dumps(new)}".encode()).hexdigest()
+        if await r.exists(K_SENT.format(digest)):
+            seen = new
+        else:
+            for field, text in messages:
+                try:
+                    await sender.send_message(chat_id, text, priority=PRIORITY_BULK)
+                except Exception as e:
+                    logging.warning("Notify order %s to %s failed: %s", order_id, chat_id, e)
+                    break
+                seen[field] = new[field]
+            else:
+                await r.set(K_SENT.format(digest), "1", ex=NOTIFY_DEDUP_TTL)
+    else:
+        seen = new
+    # запоминаем только то, что пользователь действительно получил; TTL продлевается с каждым изменением
+    if seen != old:
+        await r.set(K_STATE.format(order_id), _dumps(seen), ex=NOTIFY_STATE_TTL)
+
+async def poll_once(sender) -> int:
+    r = _redis()
+    meta = await r.hgetall(K_CURSOR)
+    if not meta.get("since_id") and not meta.get("start_date"):
+        # первый запуск: историю до этого момента не рассылаем
+        await r.hset(K_CURSOR, "start_date", datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+        return 0
+    processed = 0
+    while True:
+        params = {"limit": NOTIFY_PAGE}
+        if meta.get("since_id"):
+            params["filter[sinceId]"] = meta["since_id"]
+        else:
+            params["filter[startDate]"] = meta["start_date"]
+        data = await crm_async.crm_get("orders/history", params, priority=crm_limiter.PRIORITY_BULK)
+        history = data.get("history", []) or []
+        if not history:
+            break
+        last_entry = {}  # order id -> id последней записи истории на странице
+        for h in history:
+            if (h.get("order") or {}).get("id") is not None:
+                last_entry[h["order"]["id"]] = h.get("id")
+        ids = sorted(last_entry)
+        orders = [(OrderSnapshot.from_crm(o), _telegram_id(o))
+                  for o in await crm_async.get_by_ids("orders", ids, page=NOTIFY_PAGE) if _telegram_id(o)]
+        if orders:
+            known = await r.mget([K_STATE.format(o.id) for o, _ in orders])
+            for (o, chat_id), state in zip(orders, known):
+                await crm_async.order_cache.put(o.id, o)
+                await _notify_order(sender, o, chat_id, state, last_entry.get(o.id))
+        meta["since_id"] = str(history[-1].get("id"))
+        await r.hset(K_CURSOR, "since_id", meta["since_id"])
+        processed += len(history)
+        if len(history) < NOTIFY_PAGE:
+            break
+    return processed
+
+async def run_notifier(sender, interval: float = NOTIFY_INTERVAL):
+    from redis_client import singleton_lock
+    while True:
+        try:
+            # лок продлевается, пока идёт опрос: отправки уведомлений могут занять дольше TTL
+            async with singleton_lock(K_LOCK) as acquired:
+                if acquired:
+                    started = time.monotonic()
+                    processed = await poll_once(sender)
+                    if processed:
+                        logging.info("Notifier: %s history entries in %.1fs", processed, time.monotonic() - started)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logging.exception("Notifier poll failed")
+        await asyncio.sleep(interval)
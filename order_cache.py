@@ -0,0 +1,193 @@
+import os
+import json
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+
+ORDER_CACHE_TTL = float(os.getenv("ORDER_CACHE_TTL", "30"))  # сколько снимок считается свежим, сек
+ORDER_CACHE_STALE_TTL = float(os.getenv("ORDER_CACHE_STALE_TTL", "300"))  # сколько ещё можно отдавать устаревший снимок
+ORDER_CACHE_SIZE = int(os.getenv("ORDER_CACHE_SIZE", "5000"))
+ORDER_CACHE_REDIS = os.getenv("ORDER_CACHE_REDIS", "false").lower() == "true"
+
+class SnapshotCache:
+    """LRU-кэш снимков из CRM с TTL, stale-while-revalidate и single-flight.
+
+    Опционально дублирует значения в Redis (общий пул из redis_client),
+    чтобы соседние реплики не ходили в CRM за тем же заказом.
+    """
+
+    def __init__(self, name: str, ttl: float = ORDER_CACHE_TTL, stale_ttl: float = ORDER_CACHE_STALE_TTL,
+                 maxsize: int = ORDER_CACHE_SIZE, use_redis: bool = ORDER_CACHE_REDIS,
+                 encode=None, decode=None):
+        self.name = name
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.maxsize = maxsize
+        self.use_redis = use_redis
+        # encode/decode — как класть значение в Redis (JSON) и доставать обратно
+        self.encode = encode or (lambda v: v)
+        self.decode = decode or (lambda v: v)
+        self._local: OrderedDict = OrderedDict()  # key -> (value, fresh_until, stale_until)
+        self._inflight: dict = {}
+        self._epoch: dict = {}    # key -> номер инвалидации; только пока ключ грузится
+        self._loading: dict = {}  # key -> сколько загрузок идёт (после invalidate старая может ещё работать)
+        self.counters = {"hits": 0, "stale_hits": 0, "misses": 0, "redis_hits": 0,
+                         "coalesced": 0, "loads": 0, "load_errors": 0, "refreshes": 0, "invalidations": 0}
+
+    def _redis_key(self, key) -> str:
+        return f"cache:{self.name}:{key}"
+
+    def _store_local(self, key, value, age: float = 0.0):
+        now = time.monotonic()
+        self._local[key] = (value, now + self.ttl - age, now + self.ttl + self.stale_ttl - age)
+        self._local.move_to_end(key)
+        while len(self._local) > self.maxsize:
+            self._local.popitem(last=False)
+
+    async def _redis_get(self, key):
+        if not self.use_redis:
+            return None
+        from redis_client import ar
+        try:
+            raw = await ar.get(self._redis_key(key))
+        except Exception as e:
+            logging.warning("Cache %s: redis get failed: %s", self.name, e)
+            return None
+        if not raw:
+            return None
+        try:
+            doc = json.loads(raw)
+            return self.decode(doc["v"]), max(0.0, time.time() - doc["t"])
+        except Exception:
+            return None
+
+    async def _redis_set(self, key, value):
+        if not self.use_redis:
+            return
+        from redis_client import ar
+        try:
+            raw = json.dumps({"v": self.encode(value), "t": time.time()}, ensure_ascii=False, separators=(",", ":"))
+            await ar.set(self._redis_key(key), raw, ex=int(self.ttl + self.stale_ttl) or 1)
+        except Exception as e:
+            logging.warning("Cache %s: redis set failed: %s", self.name, e)
+
+    async def _redis_delete(self, key):
+        if not self.use_redis:
+            return
+        from redis_client import ar
+        try:
+            await ar.delete(self._redis_key(key))
+        except Exception as e:
+            logging.warning("Cache %s: redis delete failed: %s", self.name, e)
+
+    async def _fetch_and_store(self, key, loader):
+        self._loading[key] = self._loading.get(key, 0) + 1
+        epoch = self._epoch.get(key, 0)
+        self.counters["loads"] += 1
+        try:
+            try:
+                value = await loader()
+            except Exception:
+                self.counters["load_errors"] += 1
+                raise
+            # если пока мы грузили, ключ инвалидировали — не кладём в кэш потенциально старые данные
+            if self._epoch.get(key, 0) == epoch:
+                self._store_local(key, value)
+                await self._redis_set(key, value)
+            return value
+        finally:
+            left = self._loading.pop(key) - 1
+            if left:
+                self._loading[key] = left
+            else:
+                self._epoch.pop(key, None)
+
+    def _load(self, key, loader) -> asyncio.Future:
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._fetch_and_store(key, loader))
+            self._inflight[key] = task
+            task.add_done_callback(lambda t, k=key: self._inflight.pop(k, None) if self._inflight.get(k) is t else None)
+        return task
+
+    def _refresh_in_background(self, key, loader):
+        if key in self._inflight:
+            return
+        self.counters["refreshes"] += 1
+        task = self._load(key, loader)
+
+        def _done(t: asyncio.Future):
+            if not t.cancelled() and t.exception() is not None:
+                logging.warning("Cache %s: background refresh of %s failed: %s", self.name, key, t.exception())
+        task.add_done_callback(_done)
+
+    async def get(self, key, loader):
+        """Вернуть значение по ключу; loader — корутинная фабрика без аргументов."""
+        now = time.monotonic()
+        entry = self._local.get(key)
+        if entry is not None:
+            value, fresh_until, stale_until = entry
+            if now < fresh_until:
+                self.counters["hits"] += 1
+                self._local.move_to_end(key)
+                return value
+            if now < stale_until:
+                self.counters["stale_hits"] += 1
+                self._refresh_in_background(key, loader)
+                return value
+            self._local.pop(key, None)
+
+        cached = await self._redis_get(key)
+        if cached is not None:
+            value, age = cached
+            if age < self.ttl + self.stale_ttl:
+                self.counters["redis_hits"] += 1
+                self._store_local(key, value, age=age)
+                if age >= self.ttl:
+                    self._refresh_in_background(key, loader)
+                return value
+
+        self.counters["misses"] += 1
+        if key in self._inflight:
+            self.counters["coalesced"] += 1
+        # shield: отмена одного ожидающего не должна отменять общую загрузку
+        return await asyncio.shield(self._load(key, loader))
+
+    async def peek(self, key, loader=None):
+        """Значение из кэша (в том числе устаревшее) без похода в источник; с loader устаревшее обновится в фоне."""
+        entry = self._local.get(key)
+        if entry is not None and time.monotonic() < entry[2]:
+            self.counters["hits" if time.monotonic() < entry[1] else "stale_hits"] += 1
+            if loader is not None and time.monotonic() >= entry[1]:
+                self._refresh_in_background(key, loader)
+            return entry[0]
+        cached = await self._redis_get(key)
+        if cached is not None and cached[1] < self.ttl + self.stale_ttl:
+            value, age = cached
+            self.counters["redis_hits"] += 1
+            self._store_local(key, value, age=age)
+            if loader is not None and age >= self.ttl:
+                self._refresh_in_background(key, loader)
+            return value
+        return None
+
+    async def put(self, key, value):
+        self._store_local(key, value)
+        await self._redis_set(key, value)
+
+    async def invalidate(self, key):
+        self.counters["invalidations"] += 1
+        if key in self._loading:
+            self._epoch[key] = self._epoch.get(key, 0) + 1
+        self._local.pop(key, None)
+        self._inflight.pop(key, None)
+        await self._redis_delete(key)
+
+    def stats(self) -> dict:
+        out = dict(self.counters)
+        out["size"] = len(self._local)
+        out["inflight"] = len(self._inflight)
+        lookups = out["hits"] + out["stale_hits"] + out["redis_hits"] + out["misses"]
+        out["hit_ratio"] = round((lookups - out["misses"]) / lookups, 4) if lookups else None
+        return out
@@ -1,15 +1,26 @@
-import os
+import time
+import uuid
+import asyncio
+import logging
+import contextlib
 import redis
-from config import REDIS_HOST, REDIS_PORT, REDIS_DB, REDIS_PASSWORD
-
-_pool = redis.ConnectionPool(
-    host=REDIS_HOST,
-    port=REDIS_PORT,
-    db=REDIS_DB,
-    password=REDIS_PASSWORD,
-    decode_responses=True,
-    health_check_interval=30,
-)
+import redis.asyncio as aioredis
+import metrics
+from config import REDIS_URL, REDIS_HOST, REDIS_PORT, REDIS_DB, REDIS_PASSWORD
+
+def _pool_kwargs() -> dict:
+    return {"decode_responses": True, "health_check_interval": 30}
+
+if REDIS_URL:
+    _pool = redis.ConnectionPool.from_url(REDIS_URL, **_pool_kwargs())
+else:
+    _pool = redis.ConnectionPool(
+        host=REDIS_HOST,
+        port=REDIS_PORT,
+        db=REDIS_DB,
+        password=REDIS_PASSWORD,
+        **_pool_kwargs(),
+    )
 r = redis.Redis(connection_pool=_pool)
 
 def is_authorized(user_id: int) -> bool:
@@ -31,3 +42,90 @@ def get_order_id(user_id: int):
 
 def clear_auth(user_id: int):
     r.delete(f"user:{user_id}")
+
+# Асинхронный клиент для кода, работающего в event loop бота (кэш, FSM и т.д.)
+if REDIS_URL:
+    _async_pool = aioredis.ConnectionPool.from_url(REDIS_URL, **_pool_kwargs())
+else:
+    _async_pool = aioredis.ConnectionPool(
+        host=REDIS_HOST,
+        port=REDIS_PORT,
+        db=REDIS_DB,
+        password=REDIS_PASSWORD,
+        **_pool_kwargs(),
+    )
+class _TimedPipeline(aioredis.client.Pipeline):
+    async def execute(self, raise_on_error: bool = True):
+        with metrics.REDIS_LATENCY.time("PIPELINE"):
+            return await super().execute(raise_on_error)
+
+class _TimedRedis(aioredis.Redis):
+    # время каждой команды уходит в /metrics (redis_command_duration_seconds)
+    async def execute_command(self, *args, **options):
+        command = str(args[0]).upper() if args else "?"
+        started = time.perf_counter()
+        try:
+            return await super().execute_command(*args, **options)
+        except Exception:
+            metrics.REDIS_ERRORS.inc(command)
+            raise
+        finally:
+            metrics.REDIS_LATENCY.observe(time.perf_counter() - started, command)
+
+    def pipeline(self, transaction: bool = True, shard_hint=None):
+        return _TimedPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+ar = _TimedRedis(connection_pool=_async_pool)
+
+# Лок «один исполнитель на все реплики»: значение — токен владельца, пока работа идёт, лок продлевается,
+# снимается только свой (чужой лок после истечения TTL не трогаем).
+_EXTEND_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('pexpire', KEYS[1], ARGV[2]) end
+return 0
+"""
+_RELEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('del', KEYS[1]) end
+return 0
+"""
+_extend = ar.register_script(_EXTEND_SCRIPT)
+_release = ar.register_script(_RELEASE_SCRIPT)
+
+@contextlib.asynccontextmanager
+async def singleton_lock(key: str, ttl: float = 60.0):
+    """async with singleton_lock(key) as acquired: — acquired=False, если лок держит другой процесс."""
+    token = uuid.uuid4().hex
+    ttl_ms = int(ttl * 1000)
+    if not await ar.set(key, token, nx=True, px=ttl_ms):
+        yield False
+        return
+
+    async def _renew():
+        while True:
+            await asyncio.sleep(ttl / 3)
+            try:
+                if not await _extend(keys=[key], args=[token, ttl_ms]):
+                    logging.warning("Lock %s lost: taken over after expiry", key)
+                    return
+            except Exception as e:
+                logging.warning("Lock %s renewal failed: %s", key, e)
+
+    renew = asyncio.create_task(_renew(), name=f"lock-renew:{key}")
+    try:
+        yield True
+    finally:
+        renew.cancel()
+        try:
+            await _release(keys=[key], args=[token])
+        except Exception as e:
+            logging.warning("Lock %s release failed: %s", key, e)
+
+async def ping() -> dict:
+    started = time.perf_counter()
+    try:
+        await ar.ping()
+        return {"ok": True, "latency_ms": round((time.perf_counter() - started) * 1000, 1)}
+    except Exception as e:
+        return {"ok": False, "error": f"{type(e).__name__}: {e}"[:200]}
+
+async def close_async():
+    await _async_pool.disconnect()
@@ -0,0 +1,233 @@
+import os
+import time
+import heapq
+import asyncio
+import logging
+import itertools
+from contextvars import ContextVar
+
+from aiogram import Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramRetryAfter
+
+# Планировщик исходящих сообщений: общий лимит Telegram (~30 сообщений/с),
+# не чаще одного сообщения в секунду в один чат для рассылок, повтор после RetryAfter.
+# Через него идут все отправки и правки сообщений бота (SchedulerMiddleware на сессии Bot),
+# интерактивные ответы обгоняют массовые рассылки.
+TG_GLOBAL_RATE = float(os.getenv("TG_GLOBAL_RATE", "30"))
+# лимит Telegram — на токен бота, а bucket у каждого процесса-воркера (BOT_WORKERS, workers.py) свой — делим на них
+_WORKER_SHARE = max(1, int(os.getenv("BOT_WORKERS", "1")))
+TG_CHAT_INTERVAL = float(os.getenv("TG_CHAT_INTERVAL", "1.0"))
+TG_SEND_WORKERS = int(os.getenv("TG_SEND_WORKERS", "8"))
+TG_SEND_RETRIES = int(os.getenv("TG_SEND_RETRIES", "5"))
+TG_BROADCAST_WINDOW = int(os.getenv("TG_BROADCAST_WINDOW", "500"))  # сколько сообщений рассылки держим в очереди одновременно
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BULK = 1
+
+# методы Bot API, которые упираются в лимиты Telegram на сообщения
+PACED_PREFIXES = ("send", "edit", "copy", "forward", "deleteMessage")
+
+_in_scheduler: ContextVar[bool] = ContextVar("tg_in_scheduler", default=False)  # вызов уже из воркера планировщика
+
+SUBSCRIBERS_KEY = "tg:subscribers"
+TG_SUBSCRIBERS = os.getenv("TG_SUBSCRIBERS", "true" if os.getenv("REDIS_URL") else "false").lower() == "true"
+
+async def add_subscriber(chat_id: int):
+    from redis_client import ar
+    await ar.sadd(SUBSCRIBERS_KEY, str(chat_id))
+
+class _Job:
+    __slots__ = ("chat_id", "call", "future", "attempts")
+
+    def __init__(self, chat_id, call, future):
+        self.chat_id = chat_id
+        self.call = call  # () -> корутина вызова Bot API
+        self.future = future
+        self.attempts = 0
+
+class SendScheduler:
+    def __init__(self, bot: Bot, global_rate: float = TG_GLOBAL_RATE / _WORKER_SHARE, chat_interval: float = TG_CHAT_INTERVAL,
+                 workers: int = TG_SEND_WORKERS):
+        self.bot = bot
+        self.global_rate = global_rate
+        self.chat_interval = chat_interval
+        self.workers = workers
+        self._queue: asyncio.PriorityQueue | None = None
+        self._delayed: list = []  # heap: (ready_at, priority, seq, job) — ждут своей очереди в чате
+        self._seq = itertools.count()
+        self._tokens = global_rate
+        self._tokens_ts = time.monotonic()
+        self._chat_next: dict = {}     # chat_id -> когда можно следующее сообщение рассылки
+        self._chat_blocked: dict = {}  # chat_id -> до какого времени Telegram просил подождать (RetryAfter)
+        self._tasks: list[asyncio.Task] = []
+        self.counters = {"sent": 0, "failed": 0, "retry_after": 0}
+
+    # ---------- публичный API ----------
+
+    def submit(self, chat_id, text: str, priority: int = PRIORITY_INTERACTIVE, **kwargs) -> asyncio.Future:
+        return self.enqueue(chat_id, lambda: self.bot.send_message(chat_id, text, **kwargs), priority)
+
+    def enqueue(self, chat_id, call, priority: int = PRIORITY_INTERACTIVE) -> asyncio.Future:
+        """Поставить произвольный вызов Bot API в очередь чата; call — функция без аргументов, возвращающая корутину."""
+        future = asyncio.get_running_loop().create_future()
+        job = _Job(chat_id, call, future)
+        if self._queue is None:
+            # планировщик не запущен (например, в локальной отладке) — отправляем напрямую
+            asyncio.ensure_future(self._send_direct(job))
+        else:
+            self._queue.put_nowait((priority, next(self._seq), job))
+        return future
+
+    async def send_message(self, chat_id, text: str, priority: int = PRIORITY_INTERACTIVE, **kwargs):
+        return await self.submit(chat_id, text, priority=priority, **kwargs)
+
+    async def broadcast(self, text: str, key: str = SUBSCRIBERS_KEY, **kwargs) -> dict:
+        """Разослать сообщение всем chat_id из Redis-множества, читая его порциями через SSCAN."""
+        from redis_client import ar
+        window = asyncio.Semaphore(TG_BROADCAST_WINDOW)
+        stats = {"sent": 0, "failed": 0}
+        pending: set = set()
+
+        def _done(f: asyncio.Future):
+            window.release()
+            pending.discard(f)
+            stats["failed" if f.cancelled() or f.exception() else "sent"] += 1
+
+        async for raw in ar.sscan_iter(key, count=500):
+            await window.acquire()
+            f = self.submit(int(raw), text, priority=PRIORITY_BULK, **kwargs)
+            pending.add(f)
+            f.add_done_callback(_done)
+        if pending:
+            await asyncio.wait(pending)
+        return stats
+
+    def stats(self) -> dict:
+        out = dict(self.counters)
+        out["queued"] = self._queue.qsize() if self._queue is not None else 0
+        out["delayed"] = len(self._delayed)
+        return out
+
+    # ---------- жизненный цикл ----------
+
+    async def start(self):
+        if self._queue is not None:
+            return
+        self._queue = asyncio.PriorityQueue()
+        self._tasks = [asyncio.create_task(self._worker(), name=f"tg-sender-{i}") for i in range(self.workers)]
+        self._tasks.append(asyncio.create_task(self._release_delayed(), name="tg-sender-delayed"))
+
+    async def stop(self, timeout: float = 10.0):
+        if self._queue is None:
+            return
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout=timeout)
+        except asyncio.TimeoutError:
+            logging.warning("Send scheduler stopped with %s messages queued", self._queue.qsize())
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        for _, _, _, job in self._delayed:
+            job.future.cancel()
+        self._delayed = []
+        self._tasks = []
+        self._queue = None
+
+    # ---------- внутреннее ----------
+
+    @staticmethod
+    def _resolve(job: _Job, result=None, error: Exception | None = None):
+        if job.future.done():  # ожидающий уже отменился
+            return
+        if error is not None:
+            job.future.set_exception(error)
+        else:
+            job.future.set_result(result)
+
+    async def _send_direct(self, job: _Job):
+        _in_scheduler.set(True)
+        try:
+            result = await job.call()
+        except Exception as e:
+            self._resolve(job, error=e)
+            return
+        self._resolve(job, result=result)
+
+    async def _take_global_token(self):
+        while True:
+            now = time.monotonic()
+            self._tokens = min(self.global_rate, self._tokens + (now - self._tokens_ts) * self.global_rate)
+            self._tokens_ts = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((1 - self._tokens) / self.global_rate)
+
+    def _defer(self, ready_at: float, priority: int, seq: int, job: _Job):
+        heapq.heappush(self._delayed, (ready_at, priority, seq, job))
+        self._queue.task_done()
+
+    async def _release_delayed(self):
+        while True:
+            now = time.monotonic()
+            while self._delayed and self._delayed[0][0] <= now:
+                _, priority, seq, job = heapq.heappop(self._delayed)
+                self._queue.put_nowait((priority, seq, job))
+            if len(self._chat_next) > 10000:
+                self._chat_next = {k: v for k, v in self._chat_next.items() if v > now}
+            if len(self._chat_blocked) > 1000:
+                self._chat_blocked = {k: v for k, v in self._chat_blocked.items() if v > now}
+            await asyncio.sleep(0.05)
+
+    async def _worker(self):
+        _in_scheduler.set(True)  # вызовы Bot API из воркера не возвращаются в очередь через SchedulerMiddleware
+        while True:
+            priority, seq, job = await self._queue.get()
+            if job.future.done():  # отменили, пока ждали
+                self._queue.task_done()
+                continue
+            now = time.monotonic()
+            ready_at = self._chat_blocked.get(job.chat_id, 0.0)
+            if priority == PRIORITY_BULK:
+                # ответ пользователю не ждёт паузы между сообщениями — Telegram терпит короткие всплески в чате
+                ready_at = max(ready_at, self._chat_next.get(job.chat_id, 0.0))
+            if ready_at > now:
+                self._defer(ready_at, priority, seq, job)
+                continue
+            self._chat_next[job.chat_id] = now + self.chat_interval
+            await self._take_global_token()
+            try:
+                result = await job.call()
+            except TelegramRetryAfter as e:
+                self.counters["retry_after"] += 1
+                job.attempts += 1
+                if job.attempts <= TG_SEND_RETRIES:
+                    logging.warning("Telegram RetryAfter %ss for chat %s", e.retry_after, job.chat_id)
+                    ready_at = time.monotonic() + e.retry_after
+                    self._chat_blocked[job.chat_id] = ready_at
+                    self._defer(ready_at, priority, seq, job)
+                    continue
+                self.counters["failed"] += 1
+                self._resolve(job, error=e)
+            except Exception as e:
+                self.counters["failed"] += 1
+                self._resolve(job, error=e)
+            else:
+                self.counters["sent"] += 1
+                self._resolve(job, result=result)
+            self._queue.task_done()
+
+class SchedulerMiddleware(BaseRequestMiddleware):
+    """Middleware сессии Bot: отправки и правки сообщений (message.answer, edit_text, send_document…)
+    идут через SendScheduler — под общий лимит и с повтором после RetryAfter."""
+
+    def __init__(self, scheduler: SendScheduler):
+        self.scheduler = scheduler
+
+    async def __call__(self, make_request, bot, method):
+        chat_id = getattr(method, "chat_id", None)
+        if (_in_scheduler.get() or chat_id is None
+                or not getattr(method, "__api_method__", "").startswith(PACED_PREFIXES)):
+            return await make_request(bot, method)
+        return await self.scheduler.enqueue(chat_id, lambda: make_request(bot, method))
@@ -0,0 +1,243 @@
+import os
+import time
+import logging
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram import BaseMiddleware
+from aiogram.types import CallbackQuery, Message, TelegramObject
+
+import metrics
+
+# Защита от повторных нажатий и флуда: одинаковые нажатия кнопки, пришедшие, пока
+# первое ещё выполняется, склеиваются; на пользователя и на действие — лимит за окно;
+# после серии неудачных входов — блокировка с экспоненциально растущим сроком.
+# Состояние общее для реплик через Redis, если он есть (иначе — в памяти процесса).
+THROTTLE_ENABLED = os.getenv("THROTTLE_ENABLED", "true").lower() == "true"
+THROTTLE_REDIS = os.getenv("THROTTLE_REDIS", "true" if os.getenv("REDIS_URL") else "false").lower() == "true"
+THROTTLE_WINDOW = int(os.getenv("THROTTLE_WINDOW", "60"))            # окно лимитов, сек
+THROTTLE_USER_LIMIT = int(os.getenv("THROTTLE_USER_LIMIT", "40"))    # событий от пользователя за окно
+THROTTLE_ACTION_LIMIT = int(os.getenv("THROTTLE_ACTION_LIMIT", "12"))  # одинаковых действий за окно
+CALLBACK_BUSY_TTL = 30    # если обработчик завис, отметка «выполняется» сама снимется через столько секунд
+CALLBACK_DONE_TTL = 60    # сколько помним время завершения, чтобы отсечь нажатия, пришедшие во время работы
+AUTH_FREE_ATTEMPTS = int(os.getenv("AUTH_FREE_ATTEMPTS", "5"))
+AUTH_LOCKOUT_BASE = int(os.getenv("AUTH_LOCKOUT_BASE", "60"))
+AUTH_LOCKOUT_MAX = int(os.getenv("AUTH_LOCKOUT_MAX", "3600"))
+AUTH_FAIL_WINDOW = 24 * 3600  # через сутки без попыток счётчик неудач обнуляется
+
+SLOW_DOWN_TEXT = "Слишком много запросов подряд. Подождите немного, пожалуйста 🤍"
+BUSY_TEXT = "⏳ Уже выполняю, секунду…"
+
+_BUSY = "busy"
+
+def auth_locked_text(seconds: float) -> str:
+    minutes = max(1, int(seconds + 59) // 60)
+    return f"🔒 Слишком много неудачных попыток входа. Попробуйте снова через {minutes} мин 🤍"
+
+class _LocalState:
+    def __init__(self, maxsize: int = 100000):
+        self.maxsize = maxsize
+        self.counters: dict = {}  # key -> count (ключ уже содержит номер окна)
+        self.marks: dict = {}     # key -> (value, expires_at)
+
+    def _prune(self, store: dict, now: float, expired):
+        if len(store) > self.maxsize:
+            for key in [k for k, v in store.items() if expired(k, v, now)]:
+                del store[key]
+
+    def hit(self, key: str) -> int:
+        window = int(time.time() // THROTTLE_WINDOW)
+        self._prune(self.counters, window, lambda k, v, w: not k.endswith(f":{w}"))
+        full = f"{key}:{window}"
+        self.counters[full] = self.counters.get(full, 0) + 1
+        return self.counters[full]
+
+    def get(self, key: str):
+        item = self.marks.get(key)
+        if item is None or item[1] < time.time():
+            return None
+        return item[0]
+
+    def set(self, key: str, value, ttl: float):
+        self._prune(self.marks, time.time(), lambda k, v, now: v[1] < now)
+        self.marks[key] = (value, time.time() + ttl)
+
+    def delete(self, key: str):
+        self.marks.pop(key, None)
+
+_local = _LocalState()
+
+def _redis():
+    from redis_client import ar
+    return ar
+
+async def _hit(key: str) -> int:
+    if THROTTLE_REDIS:
+        try:
+            full = f"thr:rl:{key}:{int(time.time() // THROTTLE_WINDOW)}"
+            pipe = _redis().pipeline(transaction=False)
+            pipe.incr(full)
+            pipe.expire(full, THROTTLE_WINDOW + 1)
+            count, _ = await pipe.execute()
+            return int(count)
+        except Exception as e:
+            logging.warning("Throttle: redis unavailable, using local counters: %s", e)
+    return _local.hit(key)
+
+async def _begin(key: str):
+    """Поставить отметку «выполняется». None — отметка наша, иначе прежнее значение (busy или время завершения)."""
+    if THROTTLE_REDIS:
+        try:
+            r = _redis()
+            if await r.set(f"thr:cb:{key}", _BUSY, nx=True, ex=CALLBACK_BUSY_TTL):
+                return None
+            return await r.get(f"thr:cb:{key}") or _BUSY
+        except Exception as e:
+            logging.warning("Throttle: redis unavailable, using local marks: %s", e)
+    prev = _local.get(key)
+    if prev is None:
+        _local.set(key, _BUSY, CALLBACK_BUSY_TTL)
+    return prev
+
+async def _set_mark(key: str, value, ttl: int):
+    if THROTTLE_REDIS:
+        try:
+            await _redis().set(f"thr:cb:{key}", value, ex=ttl)
+            return
+        except Exception as e:
+            logging.warning("Throttle: redis unavailable, using local marks: %s", e)
+    _local.set(key, value, ttl)
+
+# ---------- блокировка входа ----------
+
+async def _auth_state(user_id: int) -> tuple[int, float]:
+    if THROTTLE_REDIS:
+        try:
+            raw = await _redis().hmget(f"thr:auth:{user_id}", ["fails", "until"])
+            return int(raw[0] or 0), float(raw[1] or 0)
+        except Exception as e:
+            logging.warning("Throttle: redis unavailable, using local auth state: %s", e)
+    return _local.get(f"auth:{user_id}") or (0, 0.0)
+
+async def auth_lockout_left(user_id: int) -> float:
+    _, until = await _auth_state(user_id)
+    return max(0.0, until - time.time())
+
+# KEYS[1] — thr:auth:{user}; ARGV: free attempts, lockout base, lockout max, fail window, now (сек)
+# Счётчик растёт атомарно (HINCRBY), срок блокировки считается от полученного значения
+# и не укорачивается, если параллельная попытка уже выставила более поздний. Возвращает блокировку, сек.
+_AUTH_FAILED_SCRIPT = """
+local free = tonumber(ARGV[1])
+local fails = redis.call('HINCRBY', KEYS[1], 'fails', 1)
+local lockout = 0
+if fails >= free then
+  lockout = math.min(tonumber(ARGV[3]), tonumber(ARGV[2]) * 2 ^ (fails - free))
+end
+if lockout > 0 then
+  local prev = tonumber(redis.call('HGET', KEYS[1], 'until')) or 0
+  redis.call('HSET', KEYS[1], 'until', math.max(prev, tonumber(ARGV[5]) + lockout))
+end
+redis.call('EXPIRE', KEYS[1], tonumber(ARGV[4]) + math.ceil(lockout))
+return lockout
+"""
+_auth_script = None
+
+def _auth_lockout(fails: int) -> float:
+    if fails < AUTH_FREE_ATTEMPTS:
+        return 0.0
+    return float(min(AUTH_LOCKOUT_MAX, AUTH_LOCKOUT_BASE * 2 ** (fails - AUTH_FREE_ATTEMPTS)))
+
+async def auth_failed(user_id: int) -> float:
+    """Учесть неудачный вход. Возвращает срок блокировки в секундах (0 — ещё можно пробовать)."""
+    global _auth_script
+    if THROTTLE_REDIS:
+        try:
+            if _auth_script is None:
+                _auth_script = _redis().register_script(_AUTH_FAILED_SCRIPT)
+            lockout = await _auth_script(keys=[f"thr:auth:{user_id}"], args=[
+                AUTH_FREE_ATTEMPTS, AUTH_LOCKOUT_BASE, AUTH_LOCKOUT_MAX, AUTH_FAIL_WINDOW, time.time()])
+            return float(lockout)
+        except Exception as e:
+            logging.warning("Throttle: redis unavailable, using local auth state: %s", e)
+    fails, _ = _local.get(f"auth:{user_id}") or (0, 0.0)
+    fails += 1
+    lockout = _auth_lockout(fails)
+    until = time.time() + lockout if lockout else 0.0
+    _local.set(f"auth:{user_id}", (fails, until), AUTH_FAIL_WINDOW + lockout)
+    return lockout
+
+async def auth_succeeded(user_id: int):
+    if THROTTLE_REDIS:
+        try:
+            await _redis().delete(f"thr:auth:{user_id}")
+            return
+        except Exception as e:
+            logging.warning("Throttle: redis unavailable, using local auth state: %s", e)
+    _local.delete(f"auth:{user_id}")
+
+# ---------- middleware ----------
+
+class ThrottleMiddleware(BaseMiddleware):
+    """Outer-middleware для message и callback_query.
+
+    auth_state — состояние FSM, в котором сообщение считается попыткой входа
+    (во время блокировки такие сообщения не доходят до обработчика).
+    """
+
+    def __init__(self, auth_state: str | None = None):
+        self.auth_state = auth_state
+
+    async def __call__(self, handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+                       event: TelegramObject, data: Dict[str, Any]) -> Any:
+        user = data.get("event_from_user")
+        if not THROTTLE_ENABLED or user is None:
+            return await handler(event, data)
+
+        if isinstance(event, CallbackQuery):
+            action = "cb:" + (event.data or "").split(":")[0]
+        elif self.auth_state and data.get("raw_state") == self.auth_state:
+            action = "auth"
+            left = await auth_lockout_left(user.id)
+            if left > 0:
+                metrics.THROTTLED.inc("auth_lockout")
+                await event.answer(auth_locked_text(left))
+                return None
+        elif isinstance(event, Message) and (event.text or "").startswith("/"):
+            action = "cmd:" + event.text.split()[0]
+        else:
+            action = "msg"
+
+        user_count = await _hit(str(user.id))
+        action_count = await _hit(f"{user.id}:{action}")
+        if user_count > THROTTLE_USER_LIMIT or action_count > THROTTLE_ACTION_LIMIT:
+            metrics.THROTTLED.inc("rate_limit")
+            if isinstance(event, CallbackQuery):
+                await event.answer(SLOW_DOWN_TEXT)
+            elif user_count == THROTTLE_USER_LIMIT + 1 or action_count == THROTTLE_ACTION_LIMIT + 1:
+                # предупреждаем один раз за окно, дальше молча отбрасываем
+                await event.answer(SLOW_DOWN_TEXT)
+            return None
+
+        if isinstance(event, CallbackQuery):
+            return await self._collapse(handler, event, data, user.id)
+        return await handler(event, data)
+
+    async def _collapse(self, handler, event: CallbackQuery, data: Dict[str, Any], user_id: int):
+        key = f"{user_id}:{event.data}"
+        # received_at проставляет ingest: апдейты одного чата идут по очереди, поэтому повтор
+        # доходит сюда уже после первого нажатия — отсекаем его по времени получения
+        received_at = data.get("received_at") or time.time()
+        prev = await _begin(key)
+        if prev == _BUSY:
+            metrics.THROTTLED.inc("duplicate")
+            await event.answer(BUSY_TEXT)
+            return None
+        if prev is not None:
+            if float(prev) >= received_at:
+                metrics.THROTTLED.inc("duplicate")
+                await event.answer()
+                return None
+            await _set_mark(key, _BUSY, CALLBACK_BUSY_TTL)
+        try:
+            return await handler(event, data)
+        finally:
+            await _set_mark(key, repr(time.time()), CALLBACK_DONE_TTL)
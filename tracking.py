@@ -0,0 +1,339 @@
+import os
+import time
+import asyncio
+import logging
+from dataclasses import dataclass, asdict
+
+import aiohttp
+
+import metrics
+from order_cache import SnapshotCache
+
+# Статусы отправлений от служб доставки: кнопка «Трек-номер» показывает последнюю точку
+# маршрута из кэша, а фоновый опрос держит кэш свежим для треков, которые недавно смотрели.
+# Службы подключаются через Carrier; запросы к службе склеиваются в пачки по batch_size.
+CDEK_API_URL = os.getenv("CDEK_API_URL", "https://api.cdek.ru").rstrip("/")
+CDEK_CLIENT_ID = os.getenv("CDEK_CLIENT_ID")
+CDEK_CLIENT_SECRET = os.getenv("CDEK_CLIENT_SECRET")
+# коды типов доставки RetailCRM, которые везёт СДЭК; без типа доставки считаем СДЭК треки из одних цифр
+CDEK_DELIVERY_CODES = [c.strip() for c in os.getenv("CDEK_DELIVERY_CODES", "cdek,sdek").split(",") if c.strip()]
+TRACKING_POLL_INTERVAL = float(os.getenv("TRACKING_POLL_INTERVAL", "900"))  # как часто обновлять отслеживаемые треки, сек
+TRACKING_WATCH_TTL = float(os.getenv("TRACKING_WATCH_TTL", str(14 * 24 * 3600)))  # сколько опрашивать трек после просмотра
+TRACKING_INLINE_TIMEOUT = float(os.getenv("TRACKING_INLINE_TIMEOUT", "2"))  # сколько кнопка ждёт службу, если в кэше пусто
+TRACKING_REDIS = os.getenv("TRACKING_REDIS", "true" if os.getenv("REDIS_URL") else "false").lower() == "true"
+TRACKING_BATCH_WINDOW = 0.05  # сколько собирать запросы в пачку, сек
+TRACKING_EVENTS = 5           # сколько последних точек маршрута храним
+K_WATCH = "trk:watch"         # zset "carrier:track" -> время последнего просмотра
+
+@dataclass(slots=True, frozen=True)
+class Checkpoint:
+    code: str | None = None
+    name: str | None = None
+    city: str | None = None
+    at: str | None = None  # ISO 8601 от службы доставки
+
+@dataclass(slots=True, frozen=True)
+class TrackInfo:
+    carrier: str
+    track: str
+    delivered: bool = False
+    events: tuple = ()  # Checkpoint, сначала самые новые
+
+    @property
+    def latest(self) -> Checkpoint | None:
+        return self.events[0] if self.events else None
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+    @classmethod
+    def from_dict(cls, d: dict) -> "TrackInfo":
+        return cls(carrier=d["carrier"], track=d["track"], delivered=d.get("delivered", False),
+                   events=tuple(Checkpoint(**e) for e in d.get("events") or ()))
+
+class Carrier:
+    """Служба доставки. fetch получает до batch_size треков и возвращает {трек: TrackInfo | None}."""
+    name = "carrier"
+    batch_size = 1
+    concurrency = 4
+    ttl = 1800.0        # сколько статус считается свежим
+    stale_ttl = 6 * 3600.0
+
+    def matches(self, track: str, delivery_type: str | None) -> bool:
+        raise NotImplementedError
+
+    async def fetch(self, session: aiohttp.ClientSession, tracks: list) -> dict:
+        raise NotImplementedError
+
+class CdekCarrier(Carrier):
+    """СДЭК API v2: OAuth client_credentials и GET /v2/orders?cdek_number= (пакетного запроса нет)."""
+    name = "cdek"
+    batch_size = 1
+    concurrency = 4
+    ttl = 1800.0
+
+    def __init__(self, base_url: str = CDEK_API_URL, client_id: str | None = CDEK_CLIENT_ID,
+                 client_secret: str | None = CDEK_CLIENT_SECRET):
+        self.base_url = base_url
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self._token: str | None = None
+        self._token_until = 0.0
+        self._token_lock = asyncio.Lock()
+
+    def matches(self, track: str, delivery_type: str | None) -> bool:
+        if delivery_type:
+            return any(code in delivery_type.lower() for code in CDEK_DELIVERY_CODES)
+        return track.isdigit()
+
+    async def _auth(self, session: aiohttp.ClientSession) -> str:
+        async with self._token_lock:
+            if self._token and time.time() < self._token_until:
+                return self._token
+            params = {"grant_type": "client_credentials", "client_id": self.client_id,
+                      "client_secret": self.client_secret}
+            async with session.post(f"{self.base_url}/v2/oauth/token", params=params) as r:
+                r.raise_for_status()
+                data = await r.json()
+            self._token = data["access_token"]
+            # обновляем токен заранее, чтобы не ловить 401 на границе срока
+            self._token_until = time.time() + float(data.get("expires_in", 3600)) - 60
+            return self._token
+
+    async def fetch(self, session: aiohttp.ClientSession, tracks: list) -> dict:
+        result = {}
+        for track in tracks:
+            token = await self._auth(session)
+            async with session.get(f"{self.base_url}/v2/orders", params={"cdek_number": track},
+                                   headers={"Authorization": f"Bearer {token}"}) as r:
+                if r.status == 401:
+                    self._token = None
+                if r.status in (400, 404):
+                    # СДЭК отвечает 400 с v2_entity_not_found, если заказа с таким номером нет
+                    result[track] = None
+                    continue
+                r.raise_for_status()
+                data = await r.json()
+            result[track] = self._parse(track, (data or {}).get("entity") or {})
+        return result
+
+    def _parse(self, track: str, entity: dict) -> TrackInfo:
+        statuses = sorted(entity.get("statuses") or [], key=lambda s: s.get("date_time") or "", reverse=True)
+        events = tuple(Checkpoint(code=s.get("code"), name=s.get("name"), city=s.get("city"), at=s.get("date_time"))
+                       for s in statuses[:TRACKING_EVENTS])
+        return TrackInfo(carrier=self.name, track=track,
+                         delivered=any(s.get("code") == "DELIVERED" for s in statuses), events=events)
+
+class _Batcher:
+    """Склеивает одновременные запросы треков одной службы в пачки и ограничивает параллелизм."""
+
+    def __init__(self, carrier: Carrier, session_factory):
+        self.carrier = carrier
+        self.session_factory = session_factory
+        self._pending: dict = {}  # track -> future
+        self._flush_timer: asyncio.TimerHandle | None = None
+        self._sem = asyncio.Semaphore(carrier.concurrency)
+
+    def lookup(self, track: str) -> asyncio.Future:
+        fut = self._pending.get(track)
+        if fut is None:
+            fut = asyncio.get_running_loop().create_future()
+            self._pending[track] = fut
+        if len(self._pending) >= self.carrier.batch_size:
+            self._flush()
+        elif self._flush_timer is None:
+            self._flush_timer = asyncio.get_running_loop().call_later(TRACKING_BATCH_WINDOW, self._flush)
+        return fut
+
+    def _flush(self):
+        if self._flush_timer is not None:
+            self._flush_timer.cancel()
+            self._flush_timer = None
+        pending, self._pending = self._pending, {}
+        items = list(pending.items())
+        for i in range(0, len(items), self.carrier.batch_size):
+            asyncio.ensure_future(self._run(dict(items[i:i + self.carrier.batch_size])))
+
+    async def _run(self, batch: dict):
+        async with self._sem:
+            started = time.monotonic()
+            status = "ok"
+            try:
+                found = await self.carrier.fetch(self.session_factory(), list(batch))
+            except Exception as e:
+                status = "error"
+                for fut in batch.values():
+                    if not fut.done():
+                        fut.set_exception(e)
+                return
+            finally:
+                metrics.CARRIER_LATENCY.observe(time.monotonic() - started, self.carrier.name, status)
+            for track, fut in batch.items():
+                if not fut.done():
+                    fut.set_result(found.get(track))
+
+def _carriers() -> list:
+    carriers = []
+    if CDEK_CLIENT_ID and CDEK_CLIENT_SECRET:
+        carriers.append(CdekCarrier())
+    return carriers
+
+CARRIERS: list = _carriers()
+TRACKING_ENABLED = bool(CARRIERS)
+
+_session: aiohttp.ClientSession | None = None
+_batchers: dict = {}
+_caches: dict = {}
+_local_watch: dict = {}  # "carrier:track" -> время просмотра (без Redis)
+
+def _get_session() -> aiohttp.ClientSession:
+    global _session
+    if _session is None or _session.closed:
+        _session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=15, connect=5))
+    return _session
+
+async def close_session():
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
+
+def register(carrier: Carrier):
+    """Подключить ещё одну службу доставки (проверяются в порядке регистрации)."""
+    global TRACKING_ENABLED
+    CARRIERS.append(carrier)
+    TRACKING_ENABLED = True
+
+def _carrier_for(track: str | None, delivery_type: str | None = None) -> Carrier | None:
+    if not track:
+        return None
+    return next((c for c in CARRIERS if c.matches(track, delivery_type)), None)
+
+def _cache(carrier: Carrier) -> SnapshotCache:
+    cache = _caches.get(carrier.name)
+    if cache is None:
+        cache = _caches[carrier.name] = SnapshotCache(
+            f"track_{carrier.name}", ttl=carrier.ttl, stale_ttl=carrier.stale_ttl, maxsize=20000,
+            use_redis=TRACKING_REDIS,
+            encode=lambda v: v.to_dict() if v else None,
+            decode=lambda d: TrackInfo.from_dict(d) if d else None,
+        )
+    return cache
+
+def _loader(carrier: Carrier, track: str):
+    batcher = _batchers.get(carrier.name)
+    if batcher is None:
+        batcher = _batchers[carrier.name] = _Batcher(carrier, _get_session)
+    return lambda: batcher.lookup(track)
+
+async def _watch(carrier: Carrier, track: str):
+    member = f"{carrier.name}:{track}"
+    if TRACKING_REDIS:
+        try:
+            from redis_client import ar
+            await ar.zadd(K_WATCH, {member: time.time()})
+            return
+        except Exception as e:
+            logging.warning("Tracking: redis unavailable, watching locally: %s", e)
+    _local_watch[member] = time.time()
+
+async def latest(track: str | None, delivery_type: str | None = None,
+                 wait: float = TRACKING_INLINE_TIMEOUT) -> TrackInfo | None:
+    """Статус отправления: из кэша сразу (устаревший обновится в фоне), иначе ждём службу не дольше wait."""
+    carrier = _carrier_for(track, delivery_type)
+    if carrier is None:
+        return None
+    await _watch(carrier, track)
+    cache = _cache(carrier)
+    loader = _loader(carrier, track)
+    info = await cache.peek(track, loader)
+    if info is not None:
+        return info
+    try:
+        return await asyncio.wait_for(asyncio.shield(cache.get(track, loader)), timeout=wait)
+    except asyncio.TimeoutError:
+        # загрузка продолжится и положит результат в кэш к следующему нажатию
+        return None
+    except Exception as e:
+        logging.warning("Tracking %s %s failed: %s", carrier.name, track, e)
+        return None
+
+def checkpoint_text(info: TrackInfo | None) -> str | None:
+    cp = info.latest if info else None
+    if cp is None:
+        return None
+    when = ""
+    if cp.at and len(cp.at) >= 16:
+        when = f" — {cp.at[8:10]}.{cp.at[5:7]} {cp.at[11:16]}"
+    place = f", {cp.city}" if cp.city else ""
+    prefix = "✅" if info.delivered else "📍"
+    return f"{prefix} {cp.name or cp.code}{place}{when}"
+
+# ---------- фоновый опрос ----------
+
+async def _watched() -> list:
+    since = time.time() - TRACKING_WATCH_TTL
+    if TRACKING_REDIS:
+        try:
+            from redis_client import ar
+            await ar.zremrangebyscore(K_WATCH, "-inf", since)
+            return await ar.zrangebyscore(K_WATCH, since, "+inf")
+        except Exception as e:
+            logging.warning("Tracking: redis unavailable, polling local watch list: %s", e)
+    for member in [m for m, at in _local_watch.items() if at < since]:
+        del _local_watch[member]
+    return list(_local_watch)
+
+async def _unwatch(member: str):
+    _local_watch.pop(member, None)
+    if TRACKING_REDIS:
+        try:
+            from redis_client import ar
+            await ar.zrem(K_WATCH, member)
+        except Exception as e:
+            logging.warning("Tracking: failed to unwatch %s: %s", member, e)
+
+async def poll_once() -> int:
+    """Обновить статусы всех недавно просмотренных и ещё не доставленных отправлений."""
+    by_name = {c.name: c for c in CARRIERS}
+    jobs = []
+    for member in await _watched():
+        name, _, track = member.partition(":")
+        carrier = by_name.get(name)
+        if carrier is None:
+            continue
+        cache = _cache(carrier)
+        cached = await cache.peek(track)
+        if cached is not None and cached.delivered:
+            await _unwatch(member)
+            continue
+        jobs.append((member, cache, track, _loader(carrier, track)()))
+    refreshed = 0
+    for member, cache, track, fut in jobs:
+        try:
+            info = await fut
+        except Exception as e:
+            logging.warning("Tracking poll %s failed: %s", track, e)
+            continue
+        if info is None:
+            # служба не знает такой трек — не опрашиваем, пока его снова не откроют
+            await _unwatch(member)
+            continue
+        await cache.put(track, info)
+        refreshed += 1
+    return refreshed
+
+async def run_poller(interval: float = TRACKING_POLL_INTERVAL):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            refreshed = await poll_once()
+            if refreshed:
+                logging.info("Tracking poll: %s shipments refreshed", refreshed)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logging.exception("Tracking poll failed")
+
+def stats() -> dict:
+    return {name: cache.stats() for name, cache in _caches.items()}
@@ -0,0 +1,252 @@
+import os
+import sys
+import hmac
+import json
+import time
+import signal
+import asyncio
+import logging
+import tempfile
+
+import aiohttp
+from aiohttp import web
+
+from ingest import SECRET_HEADER, update_chat_id
+
+# Многопроцессный режим: фронт-процесс принимает вебхуки и раздаёт апдейты
+# BOT_WORKERS процессам bot.py по chat.id — состояние и порядок апдейтов одного
+# пользователя остаются в одном воркере. Упавший или зависший воркер перезапускается.
+BOT_WORKERS = int(os.getenv("BOT_WORKERS", "1"))
+WORKER_HEALTH_INTERVAL = float(os.getenv("WORKER_HEALTH_INTERVAL", "10"))
+WORKER_HEALTH_FAILURES = 3      # подряд неудачных проверок до принудительного перезапуска
+WORKER_BOOT_GRACE = 30.0        # столько секунд после старта воркер может не отвечать на /healthz
+WORKER_RESTART_MAX_DELAY = 30.0
+WORKER_SOCKET_DIR = os.getenv("BOT_WORKER_SOCKET_DIR") or tempfile.gettempdir()
+
+def shard_for(data: dict, workers: int) -> int:
+    """Номер воркера для апдейта: по chat.id (для апдейтов без чата — по update_id)."""
+    key = update_chat_id(data)
+    if not isinstance(key, int):
+        key = data.get("update_id") or 0
+    return key % workers
+
+class _Worker:
+    def __init__(self, index: int, socket_path: str):
+        self.index = index
+        self.socket_path = socket_path
+        self.proc: asyncio.subprocess.Process | None = None
+        self.session: aiohttp.ClientSession | None = None
+        self.started_at = 0.0
+        self.healthy = False
+        self.failures = 0
+        self.restarts = 0
+
+    def stats(self) -> dict:
+        return {
+            "pid": self.proc.pid if self.proc else None,
+            "alive": self.proc is not None and self.proc.returncode is None,
+            "healthy": self.healthy,
+            "restarts": self.restarts,
+            "uptime_seconds": round(time.monotonic() - self.started_at, 1) if self.started_at else 0.0,
+        }
+
+class WorkerPool:
+    def __init__(self, count: int, script: str, webhook_path: str, secret: str | None = None):
+        self.count = count
+        self.script = script
+        self.webhook_path = webhook_path
+        self.secret = secret
+        self.workers = [_Worker(i, os.path.join(WORKER_SOCKET_DIR, f"missis-bot-{os.getpid()}-{i}.sock"))
+                        for i in range(count)]
+        self._tasks: list[asyncio.Task] = []
+        self._stopping = False
+        self.counters = {"forwarded": 0, "unavailable": 0}
+
+    # ---------- процессы ----------
+
+    async def _spawn(self, w: _Worker):
+        if os.path.exists(w.socket_path):
+            os.unlink(w.socket_path)
+        env = dict(os.environ, BOT_WORKER_INDEX=str(w.index), BOT_WORKER_SOCKET=w.socket_path,
+                   BOT_FRONT_PID=str(os.getpid()))
+        w.proc = await asyncio.create_subprocess_exec(sys.executable, self.script, env=env)
+        w.started_at = time.monotonic()
+        w.healthy = False
+        w.failures = 0
+        if w.session is None:
+            w.session = aiohttp.ClientSession(connector=aiohttp.UnixConnector(path=w.socket_path),
+                                              timeout=aiohttp.ClientTimeout(total=60))
+        logging.info("Worker %s started, pid %s", w.index, w.proc.pid)
+
+    async def _supervise(self, w: _Worker):
+        delay = 1.0
+        while True:
+            code = await w.proc.wait()
+            w.healthy = False
+            if self._stopping:
+                return
+            uptime = time.monotonic() - w.started_at
+            logging.error("Worker %s (pid %s) exited with code %s after %.0fs", w.index, w.proc.pid, code, uptime)
+            # воркер, падающий сразу после старта, перезапускаем всё реже
+            delay = 1.0 if uptime > 60 else min(delay * 2, WORKER_RESTART_MAX_DELAY)
+            await asyncio.sleep(delay)
+            if self._stopping:
+                return
+            w.restarts += 1
+            await self._spawn(w)
+
+    async def _check(self, w: _Worker):
+        if w.proc is None or w.proc.returncode is not None:
+            return
+        try:
+            async with w.session.get("http://worker/healthz", timeout=aiohttp.ClientTimeout(total=5)) as r:
+                ok = r.status == 200
+        except Exception:
+            ok = False
+        if ok:
+            w.healthy = True
+            w.failures = 0
+            return
+        if not w.healthy and time.monotonic() - w.started_at < WORKER_BOOT_GRACE:
+            return
+        w.healthy = False
+        w.failures += 1
+        if w.failures >= WORKER_HEALTH_FAILURES:
+            logging.error("Worker %s is not responding, killing pid %s", w.index, w.proc.pid)
+            w.proc.kill()
+
+    async def _health_loop(self):
+        while True:
+            await asyncio.gather(*(self._check(w) for w in self.workers))
+            # пока кто-то не поднялся, проверяем чаще
+            await asyncio.sleep(WORKER_HEALTH_INTERVAL if all(w.healthy for w in self.workers) else 0.5)
+
+    async def start(self):
+        for w in self.workers:
+            await self._spawn(w)
+        self._tasks = [asyncio.create_task(self._supervise(w), name=f"worker-supervisor-{w.index}")
+                       for w in self.workers]
+        self._tasks.append(asyncio.create_task(self._health_loop(), name="worker-health"))
+
+    async def stop(self, timeout: float):
+        self._stopping = True
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        alive = [w for w in self.workers if w.proc and w.proc.returncode is None]
+        for w in alive:
+            w.proc.send_signal(signal.SIGTERM)
+        try:
+            await asyncio.wait_for(asyncio.gather(*(w.proc.wait() for w in alive)), timeout=timeout)
+        except asyncio.TimeoutError:
+            for w in alive:
+                if w.proc.returncode is None:
+                    logging.warning("Worker %s did not stop in time, killing", w.index)
+                    w.proc.kill()
+        for w in self.workers:
+            if w.session is not None:
+                await w.session.close()
+            if os.path.exists(w.socket_path):
+                os.unlink(w.socket_path)
+
+    # ---------- HTTP ----------
+
+    async def handle(self, request: web.Request) -> web.Response:
+        if self.secret and not hmac.compare_digest(request.headers.get(SECRET_HEADER, ""), self.secret):
+            return web.Response(status=401)
+        body = await request.read()
+        try:
+            data = json.loads(body)
+        except ValueError:
+            return web.Response(status=400)
+        w = self.workers[shard_for(data, self.count)]
+        headers = {"Content-Type": "application/json"}
+        if SECRET_HEADER in request.headers:
+            headers[SECRET_HEADER] = request.headers[SECRET_HEADER]
+        try:
+            async with w.session.post(f"http://worker{self.webhook_path}", data=body, headers=headers) as r:
+                self.counters["forwarded"] += 1
+                return web.Response(status=r.status)
+        except Exception as e:
+            # воркер перезапускается — Telegram повторит доставку
+            self.counters["unavailable"] += 1
+            logging.warning("Worker %s unavailable: %s", w.index, e)
+            return web.Response(status=503)
+
+    async def health(self, request: web.Request) -> web.Response:
+        workers = [w.stats() for w in self.workers]
+        ok = all(w["healthy"] for w in workers)
+        payload = {"ok": ok, "workers": workers, **self.counters}
+        if request.query.get("deep"):
+            payload["worker_health"] = await asyncio.gather(*(self._fetch(w, "/healthz?deep=1", json_body=True)
+                                                              for w in self.workers))
+        return web.json_response(payload, status=200 if ok else 503)
+
+    async def _fetch(self, w: _Worker, path: str, json_body: bool = False):
+        try:
+            async with w.session.get(f"http://worker{path}", timeout=aiohttp.ClientTimeout(total=10)) as r:
+                return await r.json() if json_body else await r.text()
+        except Exception as e:
+            return {"error": str(e)} if json_body else ""
+
+    async def metrics(self, request: web.Request) -> web.Response:
+        texts = await asyncio.gather(*(self._fetch(w, "/metrics") for w in self.workers))
+        body = _merge_metrics(list(zip((w.index for w in self.workers), texts)))
+        return web.Response(body=body.encode(), headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+async def watch_front(interval: float = 2.0):
+    """В воркере: завершиться, если фронт-процесс умер (например, убит по SIGKILL) и не остановил нас сам."""
+    front = int(os.getenv("BOT_FRONT_PID") or 0)
+    while True:
+        await asyncio.sleep(interval)
+        if front and os.getppid() != front:
+            logging.error("Front process %s is gone, shutting down worker", front)
+            os.kill(os.getpid(), signal.SIGTERM)
+            return
+
+def _relabel(line: str, worker: int) -> str:
+    series, _, value = line.rpartition(" ")
+    if series.endswith("}"):
+        series = series[:-1] + f',worker="{worker}"}}'
+    else:
+        series += f'{{worker="{worker}"}}'
+    return f"{series} {value}"
+
+def _merge_metrics(texts: list) -> str:
+    """Склеить /metrics воркеров: одно семейство — один блок HELP/TYPE, у каждой точки метка worker."""
+    families: dict = {}  # name -> [заголовки, точки]
+    for worker, text in texts:
+        current = None
+        for line in text.splitlines():
+            if line.startswith("# HELP ") or line.startswith("# TYPE "):
+                name = line.split()[2]
+                current = families.setdefault(name, [[], []])
+                if len(current[0]) < 2 and line not in current[0]:
+                    current[0].append(line)
+            elif line and current is not None:
+                current[1].append(_relabel(line, worker))
+    lines = []
+    for headers, samples in families.values():
+        lines.extend(headers)
+        lines.extend(samples)
+    return "\n".join(lines) + "\n"
+
+def run_front(script: str, port: int, webhook_path: str, secret: str | None, shutdown_timeout: float,
+              workers: int = BOT_WORKERS):
+    pool = WorkerPool(workers, script, webhook_path, secret)
+    app = web.Application()
+    for path in (webhook_path, "/"):
+        app.router.add_post(path, pool.handle)
+    app.router.add_get("/healthz", pool.health)
+    app.router.add_get("/metrics", pool.metrics)
+
+    async def on_startup(app):
+        await pool.start()
+
+    async def on_shutdown(app):
+        await pool.stop(timeout=shutdown_timeout + 5)
+
+    app.on_startup.append(on_startup)
+    app.on_shutdown.append(on_shutdown)
+    logging.info("Starting front process with %s workers", workers)
+    web.run_app(app, host="0.0.0.0", port=port, shutdown_timeout=shutdown_timeout)